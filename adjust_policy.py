@@ -0,0 +1,68 @@
+from image_metrics import frame_stats
+
+
+# adaptive per-tile adjustment: rerun auto signal / autofocus only when needed
+#   every_n:        adjust at least every n tiles
+#   signal_tol:     max shift of the 1 % / 99 % intensity percentiles, relative to the reference range
+#   sharpness_tol:  max relative drop of the sharpness from the reference
+# The frame captured right after an adjustment becomes the reference, following frames
+# are compared to it (observe). Sharpness is compared at the same sampling step only,
+# so it is only meaningful between tiles of the same sample region.
+class AdjustPolicy:
+
+    def __init__(self, every_n = 10, signal_tol = 0.05, sharpness_tol = 0.2, step = 4):
+        self.every_n = every_n
+        self.signal_tol = signal_tol
+        self.sharpness_tol = sharpness_tol
+        self.step = step
+        self.reset()
+
+    # forget references, next tile is adjusted
+    def reset(self):
+        self.ref_signal = None
+        self.ref_focus = None
+        self.n_signal = 0       # tiles since the last adjustment
+        self.n_focus = 0
+        self.signal_drift = True
+        self.focus_drift = True
+        self.new_signal = False  # next frame becomes the reference
+        self.new_focus = False
+        self.last = None
+
+    # stats of the frame just captured (2D array)
+    def observe(self, img):
+        st = frame_stats(img, self.step)
+        self.last = st
+        if self.new_signal or self.ref_signal is None:
+            self.ref_signal = st
+            self.new_signal = False
+        if self.new_focus or self.ref_focus is None:
+            self.ref_focus = st
+            self.new_focus = False
+
+        ref = self.ref_signal
+        span = max(ref['p99'] - ref['p1'], 1e-9)
+        shift = max(abs(st['p1'] - ref['p1']), abs(st['p99'] - ref['p99'])) / span
+        self.signal_drift = shift > self.signal_tol
+
+        ref = self.ref_focus
+        drop = 1 - st['sharpness'] / ref['sharpness'] if ref['sharpness'] > 0 else 0.0
+        self.focus_drift = drop > self.sharpness_tol
+        return st
+
+    def need_signal(self):
+        return self.signal_drift or self.ref_signal is None or self.n_signal >= self.every_n - 1
+
+    def need_focus(self):
+        return self.focus_drift or self.ref_focus is None or self.n_focus >= self.every_n - 1
+
+    # call once per tile, after adjusting (or not)
+    def signal_done(self, adjusted):
+        self.n_signal = 0 if adjusted else self.n_signal + 1
+        if adjusted:
+            self.new_signal = True
+
+    def focus_done(self, adjusted):
+        self.n_focus = 0 if adjusted else self.n_focus + 1
+        if adjusted:
+            self.new_focus = True
@@ -0,0 +1,137 @@
+import math
+
+import numpy as np
+
+from sem import Sem
+from sem_conn import wtflgC
+from image_metrics import SHARPNESS
+
+_GOLDEN = (math.sqrt(5) - 1) / 2
+
+
+# grab a small sub-frame: centre window x window pixels of a size x size scan
+# Sem's own methods are called (not the SemControl overrides, which restart GUI scanning).
+def grab_window(m, channel = 0, size = 512, window = 128, dwell_ns = 100, bpp = 8):
+    left = (size - window) // 2
+    top = (size - window) // 2
+    Sem.SetWaitFlags(m, wtflgC)
+    Sem.ScScanXY(m, 0, size, size, left, top, left + window - 1, top + window - 1, 1, int(dwell_ns))
+    return m.FetchImage(channel, window * window, bpp, window, window)
+
+
+# vertex of the parabola through 3 points, None if they do not form a maximum
+def parabola_peak(x, y):
+    x0, x1, x2 = x
+    y0, y1, y2 = y
+    d = (x0 - x1) * (x0 - x2) * (x1 - x2)
+    if d == 0:
+        return None
+    a = (x2 * (y1 - y0) + x1 * (y0 - y2) + x0 * (y2 - y1)) / d
+    b = (x2 * x2 * (y0 - y1) + x1 * x1 * (y2 - y0) + x0 * x0 * (y1 - y2)) / d
+    if a >= 0:
+        return None
+    return -b / (2 * a)
+
+
+# maximum of f on [lo, hi] by golden-section search, till the bracket is < tol
+# Returns dict {x: f(x)} of all evaluated points, at least one.
+def golden_section(f, lo, hi, tol, max_iter = 40):
+    ev = {}
+    def fx(x):
+        if x not in ev:
+            ev[x] = f(x)
+        return ev[x]
+    a, b = lo, hi
+    c = b - _GOLDEN * (b - a)
+    d = a + _GOLDEN * (b - a)
+    for i in range(max_iter):
+        if b - a < tol:
+            break
+        if fx(c) > fx(d):
+            b, d = d, c
+            c = b - _GOLDEN * (b - a)
+        else:
+            a, c = c, d
+            d = a + _GOLDEN * (b - a)
+    if not ev:
+        fx((a + b) / 2)     # bracket already < tol, evaluate the midpoint
+    return ev
+
+
+# maximum of f on [lo, hi]: n equally spaced points, then 3 points around the parabola vertex
+# of the best 3 points, zooming in till the range is < tol or the vertex moves less than tol
+def parabolic_search(f, lo, hi, tol, n = 5, shrink = 0.3, max_iter = 10):
+    ev = {}
+    xs = [float(x) for x in np.linspace(lo, hi, n)]
+    half = (hi - lo) / (n - 1)
+    last = None
+    for i in range(max_iter):
+        for x in xs:
+            if x not in ev:
+                ev[x] = f(x)
+        pts = sorted(ev)
+        k = int(np.argmax([ev[x] for x in pts]))
+        peak = pts[k]
+        if 0 < k < len(pts) - 1:
+            v = parabola_peak(pts[k - 1:k + 2], [ev[x] for x in pts[k - 1:k + 2]])
+            if v is not None and pts[k - 1] <= v <= pts[k + 1]:
+                peak = v
+        if 2 * half < tol or (last is not None and abs(peak - last) < tol):
+            break
+        last = peak
+        half *= shrink
+        xs = [max(lo, peak - half), peak, min(hi, peak + half)]
+    return ev
+
+
+# software autofocus with small, fast sub-frame scans
+#   m:          Sem instance (connected), view field set by the caller
+#   metric:     sharpness metric, see image_metrics.SHARPNESS
+#   search:     'golden' (golden-section) or 'parabolic'
+#   size, window, dwell_ns, bpp:    sub-frame scan, see grab_window
+#   tol:        WD tolerance (mm)
+class SoftwareAutofocus:
+
+    def __init__(self, m, channel = 0, metric = 'gradient', search = 'golden',
+                 size = 512, window = 128, dwell_ns = 100, bpp = 8, tol = 0.002):
+        self.m = m
+        self.channel = channel
+        self.metric = SHARPNESS[metric]
+        self.search = search
+        self.size = size
+        self.window = window
+        self.dwell_ns = dwell_ns
+        self.bpp = bpp
+        self.tol = tol
+        self.evaluations = {}
+
+    # sharpness at WD
+    def score(self, wd):
+        Sem.SetWaitFlags(self.m, wtflgC)
+        Sem.SetWD(self.m, wd)
+        img = grab_window(self.m, self.channel, self.size, self.window, self.dwell_ns, self.bpp)
+        return self.metric(img)
+
+    # search WD in [lo, hi] (mm), set and return the sharpest WD
+    def run(self, lo, hi):
+        saved = self.m.connection.wait_flags
+        Sem.ScStopScan(self.m)
+        try:
+            if self.search == 'golden':
+                ev = golden_section(self.score, lo, hi, self.tol)
+            else:
+                ev = parabolic_search(self.score, lo, hi, self.tol)
+            xs = sorted(ev)
+            k = int(np.argmax([ev[x] for x in xs]))
+            best = xs[k]
+            # refine with the parabola through the best point and its neighbours
+            if 0 < k < len(xs) - 1:
+                peak = parabola_peak(xs[k - 1:k + 2], [ev[x] for x in xs[k - 1:k + 2]])
+                if peak is not None and xs[k - 1] < peak < xs[k + 1]:
+                    best = peak
+            self.evaluations = ev
+            Sem.SetWaitFlags(self.m, wtflgC)
+            Sem.SetWD(self.m, best)
+            return best
+        finally:
+            Sem.SetWaitFlags(self.m, saved)
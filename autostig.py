@@ -0,0 +1,99 @@
+from sem import Sem
+from sem_conn import wtflgC
+from image_metrics import stig_score
+from autofocus import grab_window, parabolic_search
+
+
+# find the stigmator among the SEM geometries / centerings (EnumGeometries, EnumCenterings)
+# The enumerations are lines 'xxx.N.name=...', the first name containing 'stig' is taken.
+# Returns ('geometry' or 'centering', index), or None if there is no stigmator.
+def find_stigmator(m):
+    for kind, enum in (('geometry', m.EnumGeometries), ('centering', m.EnumCenterings)):
+        try:
+            s = enum()
+        except Exception:
+            continue
+        for line in (s or '').split('\n'):
+            key, sep, name = line.partition('=')
+            parts = key.split('.')
+            if sep and len(parts) == 3 and parts[2] == 'name' and 'stig' in name.lower():
+                return (kind, int(parts[1]))
+    return None
+
+
+# image-based autostigmation, replaces the MiraTC GUI automation
+#   m:          Sem instance (connected), view field and focus set by the caller
+#   stigmator:  (kind, index) from find_stigmator(), None = find it
+#   step:       initial search range +-step around the current value (stigmator units, as GetGeometry)
+#   tol:        stop when no axis changes more than tol in a round
+#   min_gain:   relative score gain needed to move an axis (noise guard)
+# Coordinate search: stigmator X, then Y, each by parabolic search on small sub-frame scans
+# scored by image_metrics.stig_score (FFT anisotropy). The range is halved every round.
+class ImageAutostig:
+
+    def __init__(self, m, channel = 0, stigmator = None, step = 10.0, tol = 0.2, max_rounds = 4, min_gain = 0.01,
+                 size = 512, window = 128, dwell_ns = 100, bpp = 8):
+        if stigmator is None:
+            stigmator = find_stigmator(m)
+        if stigmator is None:
+            raise RuntimeError("No stigmator found in EnumGeometries / EnumCenterings")
+        self.m = m
+        self.channel = channel
+        self.kind, self.index = stigmator
+        self.step = step
+        self.tol = tol
+        self.max_rounds = max_rounds
+        self.min_gain = min_gain
+        self.size = size
+        self.window = window
+        self.dwell_ns = dwell_ns
+        self.bpp = bpp
+        self.n_frames = 0
+
+    def get(self):
+        if self.kind == 'geometry':
+            return list(self.m.GetGeometry(self.index))
+        return list(self.m.GetCentering(self.index))
+
+    def set(self, xy):
+        Sem.SetWaitFlags(self.m, wtflgC)
+        if self.kind == 'geometry':
+            self.m.SetGeometry(self.index, xy[0], xy[1])
+        else:
+            self.m.SetCentering(self.index, xy[0], xy[1])
+
+    # score with the stigmator at xy
+    def score(self, xy):
+        self.set(xy)
+        img = grab_window(self.m, self.channel, self.size, self.window, self.dwell_ns, self.bpp)
+        self.n_frames += 1
+        return stig_score(img)
+
+    # optimize, set and return the stigmator (x, y)
+    def run(self):
+        saved = self.m.connection.wait_flags
+        Sem.ScStopScan(self.m)
+        try:
+            xy = self.get()
+            step = self.step
+            for r in range(self.max_rounds):
+                moved = 0.0
+                for axis in range(2):
+                    def f(v):
+                        p = list(xy)
+                        p[axis] = v
+                        return self.score(p)
+                    ev = parabolic_search(f, xy[axis] - step, xy[axis] + step, self.tol, n = 3)
+                    best = max(ev, key = ev.get)
+                    current = min(ev, key = lambda v: abs(v - xy[axis]))
+                    if ev[best] <= ev[current] * (1 + self.min_gain):
+                        best = xy[axis]
+                    moved = max(moved, abs(best - xy[axis]))
+                    xy[axis] = best
+                self.set(xy)
+                if moved < self.tol:
+                    break
+                step /= 2
+            return xy
+        finally:
+            Sem.SetWaitFlags(self.m, saved)
@@ -0,0 +1,191 @@
+import select
+import struct
+import threading
+
+import numpy as np
+
+from sem_conn import BufferPool, DecodeString, ImageAssembler, wtflgA, wtflgC
+
+
+# split a list of beam positions into scan segments
+#   x, y:           beam positions, virtual image coordinates 0.0 - 1.0 (as ScSetBeamPos)
+#   dwell_ns:       dwell time per point (ns), scalar or array
+#   width, height:  scan window (pxl) used for ScScanLine segments
+#   min_line:       min # of points to send a run of points as one ScScanLine
+# Points on the pixel grid of the window are scanned by ScScanLine: runs of equally spaced
+# points with equal dwell become one line, isolated points become a 1-pixel line.
+# Other points are scanned by ScSetBeamPos + Delay, which has ms resolution: their dwell is
+# rounded to whole ms, a dwell between 0 and 1 ms cannot be done that way and raises ValueError
+# (put such points on the pixel grid of a larger window instead).
+# Returns list of segments:
+#   ('line', x0, y0, x1, y1, pixel_count, dwell_ns, first_point_index)
+#   ('point', x, y, dwell_ns, point_index)
+def plan_beam_path(x, y, dwell_ns, width, height, min_line = 8, tol = 1e-6):
+    x = np.asarray(x, dtype = float).ravel()
+    y = np.asarray(y, dtype = float).ravel()
+    dwell = np.broadcast_to(np.asarray(dwell_ns, dtype = float), x.shape)
+    n = len(x)
+    if n == 0:
+        return []
+
+    # pixel coordinates, and whether the point is on the pixel grid
+    fx = x * width
+    fy = y * height
+    ix = np.rint(fx)
+    iy = np.rint(fy)
+    on_grid = ((np.abs(fx - ix) <= tol * width) & (np.abs(fy - iy) <= tol * height)
+               & (ix >= 0) & (ix < width) & (iy >= 0) & (iy < height))
+    short = ~on_grid & (dwell > 0) & (dwell < 1e6)
+    if short.any():
+        raise ValueError("{} points are off the {} x {} pixel grid with dwell < 1 ms (Delay has ms resolution), first: #{}".format(
+            int(short.sum()), width, height, int(np.flatnonzero(short)[0])))
+
+    # step k goes from point k to k+1; a run is a sequence of equal, linkable steps
+    dx = np.diff(ix)
+    dy = np.diff(iy)
+    link = on_grid[:-1] & on_grid[1:] & (dwell[:-1] == dwell[1:]) & ((dx != 0) | (dy != 0))
+    same = np.zeros(n - 1, dtype = bool)
+    if n > 2:
+        same[1:] = link[1:] & link[:-1] & (dx[1:] == dx[:-1]) & (dy[1:] == dy[:-1])
+    run_starts = np.flatnonzero(link & ~same)
+
+    # run of steps [a, b) covers points a .. b
+    runs = []
+    for a in run_starts:
+        b = a + 1
+        while b < n - 1 and same[b]:
+            b += 1
+        runs.append((a, b))
+
+    segments = []
+    i = 0
+    for a, b in runs:
+        a = max(a, i)
+        if b - a + 1 < min_line:
+            continue
+        segments.extend(_point_segments(x, y, ix, iy, dwell, on_grid, i, a))
+        segments.append(('line', int(ix[a]), int(iy[a]), int(ix[b]), int(iy[b]), int(b - a + 1), float(dwell[a]), int(a)))
+        i = b + 1
+    segments.extend(_point_segments(x, y, ix, iy, dwell, on_grid, i, n))
+    return segments
+
+
+# single point segments for points [i0, i1)
+def _point_segments(x, y, ix, iy, dwell, on_grid, i0, i1):
+    segments = []
+    for k in range(i0, i1):
+        if on_grid[k]:
+            segments.append(('line', int(ix[k]), int(iy[k]), int(ix[k]), int(iy[k]), 1, float(dwell[k]), k))
+        else:
+            segments.append(('point', float(x[k]), float(y[k]), float(dwell[k]), k))
+    return segments
+
+
+# scan segments from plan_beam_path, using Sem instance m
+# All requests are pipelined (see Sem.Batch): up to 'chunk' segments are sent back-to-back
+# in one write, and executed in order by the SEM command queue. Wait flags A|C make each
+# request wait for the previous line scan / Delay to finish, so there is no round trip per point.
+# Line segment i is started with frameid = i, its data come as ScData on the data connection.
+# They are read by a thread while the batch runs (the SEM would stall on a full data
+# connection otherwise), for the channels in channel_list, which must be enabled.
+# Returns (results, lines):
+#   results:    list of ScScanLine return values (0 = ok), one per line segment
+#   lines:      {segment index: list of pixel buffers (bytearray) per channel}, line segments
+#               which returned an error have no entry
+def scan_beam_path(m, segments, width, height, chunk = 1000, channel_list = (0,), timeout = 10.0):
+    results = []
+    lines = {}
+    for start in range(0, len(segments), chunk):
+        b = m.Batch()
+        b.SetWaitFlags(wtflgA | wtflgC)
+        frames = {}
+        for i in range(start, min(start + chunk, len(segments))):
+            seg = segments[i]
+            if seg[0] == 'line':
+                kind, x0, y0, x1, y1, count, dwell_ns, k = seg
+                b.ScScanLine(i, width, height, x0, y0, x1, y1, int(round(dwell_ns)), count, 1)
+                frames[i] = ImageAssembler(channel_list, count)
+            else:
+                kind, px, py, dwell_ns, k = seg
+                b.ScSetBeamPos(px, py)
+                delay_ms = int(round(dwell_ns / 1e6))
+                if delay_ms > 0:
+                    b.Delay(delay_ms)
+        reader = _LineReader(m.connection, frames)
+        reader.start()
+        try:
+            r = b.Execute()
+        except BaseException:
+            reader.stop()
+            raise
+        # line scans which failed send no data
+        reader.expect([i for i, res in zip(sorted(frames), r) if res == 0])
+        if not reader.join(timeout):
+            raise TimeoutError("Beam path data incomplete after {} s".format(timeout))
+        results.extend(r)
+        lines.update((i, frames[i].img) for i in reader.expected)
+    return (results, lines)
+
+
+# thread reading the ScData of the line segments (frame id -> ImageAssembler) from the data connection
+# Reads whole messages only, so it stops at a message boundary; it has its own header and buffers,
+# the control connection is used by the batch at the same time.
+class _LineReader(threading.Thread):
+
+    def __init__(self, conn, frames):
+        threading.Thread.__init__(self, daemon = True)
+        self.conn = conn
+        self.frames = frames
+        self.expected = None        # frame ids which send data, None = not known yet
+        self.stopped = threading.Event()
+        self.error = None
+
+    def expect(self, frame_ids):
+        self.expected = frame_ids
+
+    def stop(self):
+        self.stopped.set()
+        threading.Thread.join(self)
+
+    def join(self, timeout = None):
+        threading.Thread.join(self, timeout)
+        if self.is_alive():
+            self.stop()
+            return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+    def _done(self):
+        expected = self.expected
+        return expected is not None and all(self.frames[i].Done() for i in expected)
+
+    def run(self):
+        sock = self.conn.socket_d
+        hdr = memoryview(bytearray(32))
+        pool = BufferPool()
+        try:
+            while not self.stopped.is_set() and not self._done():
+                if not select.select([sock], [], [], 0.05)[0]:
+                    continue
+                self.conn._RecvInto(sock, hdr)
+                body_size = struct.unpack_from("<I", hdr, 16)[0]
+                buf = pool.Get(body_size)
+                body = memoryview(buf)[0:body_size]
+                self.conn._RecvInto(sock, body)
+                if DecodeString(hdr[0:16]) == 'ScData' and body_size >= 20:
+                    frame_id, channel, index, bpp, size = struct.unpack_from("<IIIII", body, 0)
+                    asm = self.frames.get(frame_id)
+                    if asm is not None and channel in asm.ch_lookup:
+                        asm.Add(channel, index, bpp, body[20:(20 + size)])
+                pool.Release(buf)
+        except Exception as e:
+            self.error = e
+
+
+# scan list of beam positions with per-point dwell times (ns), see plan_beam_path
+# Returns (segments, results, lines) of plan_beam_path and scan_beam_path.
+def scan_points(m, x, y, dwell_ns, width = 4096, height = 4096, min_line = 8, chunk = 1000, channel_list = (0,)):
+    segments = plan_beam_path(x, y, dwell_ns, width, height, min_line)
+    results, lines = scan_beam_path(m, segments, width, height, chunk, channel_list)
+    return (segments, results, lines)
@@ -0,0 +1,137 @@
+import threading
+
+import numpy as np
+
+
+# closed-loop stage drift correction from tile registration
+#   gain:           filter gain of the drift estimate per observed tile (0 .. 1)
+#   max_correction: max correction (mm) per axis
+#   rate_gain:      filter gain of the drift rate (mm per observed tile), 0: drift only
+#   min_peak:       registrations with a lower correlation peak (weight) are not used
+#   agree:          max difference (mm) of the error estimates of a tile from its registered neighbours
+#   gate:           max difference (mm) of a tile drift from the predicted drift, None = no limit;
+#                   if max_rejects tiles in a row are rejected with drifts agreeing with each other,
+#                   the last one is accepted (drift step)
+# The stage error of each tile (actual - nominal position, mm) is derived from the
+# registration against its neighbours: error = neighbour error - (measured - nominal offset).
+# The correction c applied when moving to that tile (target = nominal + c, by the stage or by
+# image shift) is subtracted, which gives the drift; the filtered drift is corrected on the
+# following moves. The first tile (record_applied, or observe if none was recorded) is the
+# reference (error 0).
+# The filter tracks drift and drift rate (alpha-beta filter), so a steady (thermal) ramp is
+# followed without lag; with rate_gain = 0 it is proportional only and lags a ramp by about
+# rate / gain per tile.
+# observe() may be called from writer threads, in any order, while correction() is called by
+# the stage loop. A registration relates both tiles, so it is kept for both: a tile gets its
+# error as soon as any registered neighbour has one, whichever of the two was observed first.
+# Registrations which do not agree, and tiles far off the prediction, are rejected as outliers
+# (e.g. a periodic or featureless sample), so they do not steer the stage. A rejected tile gets
+# the predicted error instead, so its neighbours can still be measured against it.
+class DriftCorrector:
+
+    def __init__(self, gain = 0.5, max_correction = 0.05, rate_gain = 0.1, min_peak = 0.3, agree = 0.002,
+                 gate = 0.01, max_rejects = 3):
+        self.gain = gain
+        self.rate_gain = rate_gain
+        self.max_correction = max_correction
+        self.min_peak = min_peak
+        self.agree = agree
+        self.gate = gate
+        self.max_rejects = max_rejects
+        self.drift = np.zeros(2)    # (x, y) estimated drift (mm)
+        self.rate = np.zeros(2)     # (x, y) estimated drift per observed tile (mm)
+        self.reference = None       # key of the reference tile
+        self.applied = {}           # key -> correction (x, y) applied when the tile was acquired
+        self.errors = {}            # key -> error (x, y) of the tile
+        self.links = {}             # key -> {neighbour key: ((x, y) measured - nominal offset of the neighbour, weight)}
+        self.rejected = set()       # keys of the tiles rejected as outliers
+        self.last_rejects = []      # drifts of the tiles rejected by the gate in a row
+        self.lock = threading.Lock()
+
+    # correction (x, y) to add to the next nominal stage target (mm), predicted one tile ahead
+    def correction(self):
+        with self.lock:
+            return np.clip(-(self.drift + self.rate), -self.max_correction, self.max_correction)
+
+    # record the correction used for tile 'key'
+    def record_applied(self, key, c):
+        with self.lock:
+            self.applied[key] = np.asarray(c, dtype = float)
+            if self.reference is None:
+                self._set_reference(key)
+
+    # tile 'key' registered to neighbours: deltas = {neighbour key: ((x, y) measured - nominal offset
+    # of the neighbour from this tile (mm), weight)}. Returns the error of the tile (predicted if it
+    # was rejected), None if not known yet (no registered neighbour has an error).
+    def observe(self, key, deltas):
+        with self.lock:
+            if self.reference is None:
+                self._set_reference(key)
+            self.links.setdefault(key, {})
+            for nkey, (d, weight) in deltas.items():
+                if weight < self.min_peak:
+                    continue
+                d = np.asarray(d, dtype = float)
+                self.links[key][nkey] = (d, weight)
+                self.links.setdefault(nkey, {})[key] = (-d, weight)
+            self._resolve()
+            return self.errors.get(key)
+
+    # tiles observed, but without error (no registered neighbour has one)
+    def unresolved(self):
+        with self.lock:
+            return sorted(k for k in self.links if k not in self.errors)
+
+    def _set_reference(self, key):
+        self.reference = key
+        self.errors[key] = np.zeros(2)
+
+    # give an error to every tile with a linked neighbour error, till none is left to resolve
+    def _resolve(self):
+        changed = True
+        while changed:
+            changed = False
+            for key, links in self.links.items():
+                if key in self.errors:
+                    continue
+                if any(nkey in self.errors for nkey in links):
+                    self._update(key, links)
+                    changed = True
+
+    # error of tile 'key' from the known neighbour errors, update the filter; rejected if the
+    # estimates disagree, or the drift is off the prediction by more than 'gate'
+    def _update(self, key, links):
+        applied = self.applied.get(key, np.zeros(2))
+        est = []
+        w = []
+        for nkey, (d, weight) in links.items():
+            if nkey in self.errors:
+                est.append(self.errors[nkey] - d)
+                w.append(weight)
+        est = np.array(est)
+        w = np.array(w)
+        if len(est) > 1:
+            ok = np.abs(est - np.median(est, axis = 0)).max(axis = 1) <= self.agree
+            if ok.sum() < 2:
+                self._reject(key, applied)
+                return
+            est = est[ok]
+            w = w[ok]
+        e = np.average(est, axis = 0, weights = w)
+        measured = e - applied
+        r = measured - (self.drift + self.rate)
+        if self.gate is not None and np.abs(r).max() > self.gate:
+            self.last_rejects = (self.last_rejects + [measured])[-self.max_rejects:]
+            steps = np.array(self.last_rejects)
+            if len(steps) < self.max_rejects or np.abs(steps - np.median(steps, axis = 0)).max() > self.agree:
+                self._reject(key, applied)
+                return
+        self.last_rejects = []
+        self.errors[key] = e
+        self.drift += self.rate + self.gain * r
+        self.rate += self.rate_gain * r
+
+    # outlier: the tile gets the predicted error, the filter is not updated
+    def _reject(self, key, applied):
+        self.rejected.add(key)
+        self.errors[key] = self.drift + self.rate + applied
@@ -0,0 +1,139 @@
+import numpy as np
+
+
+# polynomial terms of degree 1 (plane) or 2 at normalized positions u, v
+def _poly_terms(u, v, degree):
+    terms = [np.ones_like(u), u, v]
+    if degree >= 2:
+        terms += [u * u, u * v, v * v]
+    return np.stack(terms, axis = -1)
+
+
+# thin-plate spline kernel r^2 log r, from squared distance r2
+def _tps_kernel(r2):
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        k = 0.5 * r2 * np.log(r2)
+    return np.where(r2 > 0, k, 0.0)
+
+
+# focus map: WD surface over the stage, fitted to sparse autofocus samples
+#   method:     'plane', 'poly' (2nd order polynomial) or 'tps' (thin-plate spline)
+#   smooth:     TPS regularization, 0 = interpolate the samples exactly
+#   scale:      typical size of the mapped area (mm), positions are normalized by it
+# Samples are added by add(), the surface is refitted after each sample: plane / poly
+# accumulate their normal equations, so a refit does not revisit older samples.
+# With too few samples for the method, a lower order fit is used (mean WD, then plane).
+class FocusMap:
+
+    def __init__(self, method = 'tps', smooth = 0.0, center = (0.0, 0.0), scale = 1.0):
+        if method not in ('plane', 'poly', 'tps'):
+            raise ValueError("Unknown focus map method: {}".format(method))
+        self.method = method
+        self.smooth = smooth
+        self.center = np.asarray(center, dtype = float)
+        self.scale = float(scale) if scale > 0 else 1.0
+        self.xy = np.zeros((0, 2))
+        self.wd = np.zeros(0)
+        self.ata = {d: np.zeros((n, n)) for d, n in ((1, 3), (2, 6))}    # normal equations per degree
+        self.atb = {d: np.zeros(n) for d, n in ((1, 3), (2, 6))}
+        self.coef = None
+
+    def _norm(self, x, y):
+        return ((np.asarray(x, dtype = float) - self.center[0]) / self.scale,
+                (np.asarray(y, dtype = float) - self.center[1]) / self.scale)
+
+    # add autofocus result(s) wd at stage position(s) x, y and refit
+    def add(self, x, y, wd):
+        x = np.atleast_1d(np.asarray(x, dtype = float))
+        y = np.atleast_1d(np.asarray(y, dtype = float))
+        wd = np.atleast_1d(np.asarray(wd, dtype = float))
+        self.xy = np.concatenate((self.xy, np.stack((x, y), axis = -1)))
+        self.wd = np.concatenate((self.wd, wd))
+        u, v = self._norm(x, y)
+        for d in (1, 2):
+            a = _poly_terms(u, v, d)
+            self.ata[d] += a.T @ a
+            self.atb[d] += a.T @ wd
+        self.fit()
+
+    # number of samples
+    def __len__(self):
+        return len(self.wd)
+
+    # fit the surface to the current samples
+    def fit(self):
+        n = len(self.wd)
+        if n == 0:
+            self.coef = None
+            return
+        degree = {'plane': 1, 'poly': 2, 'tps': 1}[self.method]
+        if degree == 2 and n < 6:
+            degree = 1
+        if n < 3:
+            self.coef = ('const', self.wd.mean())
+        elif self.method == 'tps' and n > 3:
+            self.coef = ('tps', self._fit_tps())
+        else:
+            c, res, rank, sv = np.linalg.lstsq(self.ata[degree], self.atb[degree], rcond = None)
+            self.coef = ('poly', degree, c)
+
+    def _fit_tps(self):
+        u, v = self._norm(self.xy[:, 0], self.xy[:, 1])
+        p = np.stack((u, v), axis = -1)
+        n = len(p)
+        k = _tps_kernel(((p[:, None, :] - p[None, :, :]) ** 2).sum(-1)) + self.smooth * np.eye(n)
+        pm = _poly_terms(u, v, 1)
+        a = np.zeros((n + 3, n + 3))
+        a[:n, :n] = k
+        a[:n, n:] = pm
+        a[n:, :n] = pm.T
+        b = np.r_[self.wd, np.zeros(3)]
+        sol = np.linalg.lstsq(a, b, rcond = None)[0]
+        return (p, sol[:n], sol[n:])
+
+    # predicted WD at stage position(s) x, y (scalar or arrays), None without samples
+    def predict(self, x, y):
+        if self.coef is None:
+            return None
+        u, v = self._norm(x, y)
+        if self.coef[0] == 'const':
+            wd = np.full(np.shape(u), self.coef[1])
+        elif self.coef[0] == 'poly':
+            wd = _poly_terms(u, v, self.coef[1]) @ self.coef[2]
+        else:
+            p, w, a = self.coef[1]
+            q = np.stack((u, v), axis = -1)
+            r2 = ((q[..., None, :] - p) ** 2).sum(-1)
+            wd = _tps_kernel(r2) @ w + _poly_terms(u, v, 1) @ a
+        return float(wd) if np.ndim(wd) == 0 else wd
+
+    # rms of the fit residuals at the samples (mm)
+    def residual(self):
+        if len(self.wd) == 0:
+            return 0.0
+        return float(np.sqrt(np.mean((self.predict(self.xy[:, 0], self.xy[:, 1]) - self.wd) ** 2)))
+
+
+# choose n sample tiles spread over the positions xy (N x 2) by farthest point sampling.
+# known: positions (M x 2) with known WD, e.g. the grid corners; the samples are chosen far
+# from them, tiles at a known position are never chosen. Without known positions, sampling
+# starts with the tile nearest to a corner. Returns indices into xy.
+def select_samples(xy, n, known = None):
+    xy = np.asarray(xy, dtype = float).reshape(-1, 2)
+    if len(xy) == 0 or n <= 0:
+        return np.zeros(0, dtype = int)
+    chosen = []
+    if known is not None and len(known):
+        known = np.asarray(known, dtype = float).reshape(-1, 2)
+        dist = np.hypot(xy[:, None, 0] - known[None, :, 0], xy[:, None, 1] - known[None, :, 1]).min(axis = 1)
+    else:
+        first = int(np.argmin(xy.sum(axis = 1)))
+        chosen.append(first)
+        dist = np.hypot(*(xy - xy[first]).T)
+    while len(chosen) < min(n, len(xy)):
+        nxt = int(np.argmax(dist))
+        if dist[nxt] <= 1e-9:
+            break
+        chosen.append(nxt)
+        dist = np.minimum(dist, np.hypot(*(xy - xy[nxt]).T))
+    return np.array(chosen, dtype = int)
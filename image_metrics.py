@@ -0,0 +1,84 @@
+import numpy as np
+
+
+# Image quality metrics for 2D numpy arrays (any integer / float dtype).
+# Sharpness metrics are divided by the squared mean intensity, so they do not
+# change with brightness / contrast settings (e.g. after DtAutoSignal).
+
+def _float(img):
+    return np.asarray(img, dtype = np.float32)
+
+
+def _norm(img):
+    m = float(img.mean())
+    return m * m if m > 0 else 1.0
+
+
+# mean squared intensity gradient (Tenengrad without threshold)
+def gradient_energy(img):
+    a = _float(img)
+    gx = a[:, 1:] - a[:, :-1]
+    gy = a[1:, :] - a[:-1, :]
+    return float(((gx * gx).mean() + (gy * gy).mean()) / _norm(a))
+
+
+# variance of the 4-neighbour Laplacian
+def laplacian_variance(img):
+    a = _float(img)
+    lap = a[1:-1, :-2] + a[1:-1, 2:] + a[:-2, 1:-1] + a[2:, 1:-1] - 4 * a[1:-1, 1:-1]
+    return float(lap.var() / _norm(a))
+
+
+# power spectrum (fftshift-ed, DC at the centre) and radial / angular frequency coordinates
+def power_spectrum(img):
+    a = _float(img)
+    a = (a - a.mean()) * np.outer(np.hanning(a.shape[0]), np.hanning(a.shape[1]))
+    p = np.abs(np.fft.fftshift(np.fft.fft2(a))) ** 2
+    fy = np.fft.fftshift(np.fft.fftfreq(a.shape[0]))[:, None]
+    fx = np.fft.fftshift(np.fft.fftfreq(a.shape[1]))[None, :]
+    return (p, np.hypot(fx, fy), np.arctan2(fy, fx))
+
+
+# fraction of the spectral power above 'cutoff' (cycles / pxl, Nyquist = 0.5)
+def fft_high_power(img, cutoff = 0.15):
+    p, f, theta = power_spectrum(img)
+    total = p.sum()
+    if total <= 0:
+        return 0.0
+    return float(p[f > cutoff].sum() / total)
+
+
+SHARPNESS = {
+    'gradient': gradient_energy,
+    'laplacian': laplacian_variance,
+    'fft': fft_high_power,
+}
+
+
+
+# anisotropy of the power spectrum in the frequency band (cycles / pxl), 0 = isotropic .. 1
+# Astigmatism blurs the image along one direction, which makes the spectrum elongated.
+def fft_anisotropy(img, band = (0.05, 0.35)):
+    p, f, theta = power_spectrum(img)
+    sel = (f > band[0]) & (f < band[1])
+    w = p[sel]
+    total = w.sum()
+    if total <= 0:
+        return 0.0
+    c = (w * np.cos(2 * theta[sel])).sum()
+    s = (w * np.sin(2 * theta[sel])).sum()
+    return float(np.hypot(c, s) / total)
+
+
+# stigmation score, higher is better: high frequency power, reduced by the anisotropy
+# (a defocused image is isotropic too, so anisotropy alone is not enough)
+def stig_score(img):
+    return fft_high_power(img) * (1 - fft_anisotropy(img))
+
+
+# cheap statistics of a frame for drift detection, from every step-th pixel in each direction:
+# intensity percentiles (1, 50, 99 %) and gradient energy sharpness
+def frame_stats(img, step = 4):
+    a = np.asarray(img)[::step, ::step]
+    p1, p50, p99 = np.percentile(a, (1, 50, 99))
+    return {'p1': float(p1), 'p50': float(p50), 'p99': float(p99), 'sharpness': gradient_energy(a)}
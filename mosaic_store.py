@@ -0,0 +1,120 @@
+import json
+import threading
+
+import numpy as np
+
+
+# mosaic store: all tiles of a grid in one chunked, compressed array, indexed [iR, iC, y, x]
+#   path:       store path, '.zarr' directory (requires zarr) or '.h5' / '.hdf5' file (requires h5py)
+#   nR, nC:     grid size
+#   height, width, dtype:   tile size and pixel type
+#   chunk:      chunk size (pxl), chunks are (1, 1, chunk, chunk), so a reader can fetch
+#               parts of a tile without decoding the whole grid
+#   backend:    'zarr' or 'hdf5', None = from the path extension
+#   levels:     number of reduced resolution levels stored with the tiles (see pyramid)
+# Datasets:
+#   tiles       (nR, nC, height, width) tile data
+#   acquired    (nR, nC) 1 if the tile was written, 2 if it was written again
+#   tiles_A     (nR, nC, height, width) tiles written again (created when needed)
+#   level{k}    (nR, nC, height >> k, width >> k) tiles downsampled 2^k times, k = 1 .. levels
+# Per-tile metadata are JSON strings in the attributes (key 'r{iR}c{iC}', 'r{iR}c{iC}_A').
+# A tile written again does not replace the first one: like the '_A' files of the file-per-tile
+# output, it goes to tiles_A (without levels), a further repeat replaces the tiles_A tile.
+# An existing store is opened for appending (resume), its shape must match.
+# write() may be called from several writer threads, updates are serialized by a lock.
+class MosaicStore:
+
+    def __init__(self, path, nR, nC, height, width, dtype = 'uint16', chunk = 512, backend = None, levels = 0):
+        if backend is None:
+            backend = 'hdf5' if path.lower().endswith(('.h5', '.hdf5')) else 'zarr'
+        self.path = path
+        self.backend = backend
+        self.shape = (int(nR), int(nC), int(height), int(width))
+        self.dtype = np.dtype(dtype)
+        self.chunks = (1, 1, min(chunk, self.shape[2]), min(chunk, self.shape[3]))
+        self.lock = threading.Lock()
+
+        if backend == 'zarr':
+            import zarr
+            self.root = zarr.open_group(path, mode = 'a')
+            self.meta = self.root.attrs
+        elif backend == 'hdf5':
+            import h5py
+            self.root = h5py.File(path, 'a')
+            self.meta = self.root.require_group('meta').attrs
+        else:
+            raise ValueError("Unknown mosaic store backend: {}".format(backend))
+        self.tiles = self.require('tiles', self.shape, self.chunks, self.dtype)
+        self.tiles_A = self.root['tiles_A'] if 'tiles_A' in self.root else None
+        self.acquired = self.require('acquired', self.shape[:2], self.shape[:2], np.uint8)
+        self.levels = []
+        for k in range(1, levels + 1):
+            shape = self.shape[:2] + (self.shape[2] >> k, self.shape[3] >> k)
+            if min(shape[2:]) < 1:
+                break
+            chunks = (1, 1, min(chunk, shape[2]), min(chunk, shape[3]))
+            self.levels.append(self.require('level{}'.format(k), shape, chunks, self.dtype))
+
+    # dataset 'name', created if missing
+    def require(self, name, shape, chunks, dtype):
+        if name in self.root:
+            ds = self.root[name]
+            if tuple(ds.shape) != tuple(shape):
+                raise ValueError("Mosaic store {}: '{}' has shape {}, expected {}".format(self.path, name, tuple(ds.shape), tuple(shape)))
+            return ds
+        if self.backend == 'hdf5':
+            return self.root.create_dataset(name, shape = shape, chunks = chunks, dtype = dtype,
+                                            compression = 'gzip', compression_opts = 4, shuffle = True, fillvalue = 0)
+        if hasattr(self.root, 'create_array'):
+            # zarr 3, default compressor (zstd)
+            return self.root.create_array(name, shape = shape, chunks = chunks, dtype = dtype, fill_value = 0)
+        # zarr 2, default compressor (blosc)
+        return self.root.create_dataset(name, shape = shape, chunks = chunks, dtype = dtype, fill_value = 0)
+
+    # store tile (iR, iC), 2D array of the tile shape, with metadata dict (JSON serializable)
+    # and its pyramid levels (pyramid.build_pyramid), if the store has levels
+    # Returns True if the tile was written before (saved as r{iR}c{iC}_A), False otherwise.
+    def write(self, iR, iC, data, metadata = None, levels = ()):
+        data = np.asarray(data, dtype = self.dtype)
+        if data.shape != self.shape[2:]:
+            raise ValueError("Tile shape {} does not match the store {}".format(data.shape, self.shape[2:]))
+        with self.lock:
+            if self.acquired[iR, iC]:
+                if self.tiles_A is None:
+                    self.tiles_A = self.require('tiles_A', self.shape, self.chunks, self.dtype)
+                self.tiles_A[iR, iC] = data
+                self.meta['r{}c{}_A'.format(iR, iC)] = json.dumps(metadata or {})
+                self.acquired[iR, iC] = 2
+                return True
+            self.tiles[iR, iC] = data
+            for ds, a in zip(self.levels, levels):
+                ds[iR, iC] = a
+            self.meta['r{}c{}'.format(iR, iC)] = json.dumps(metadata or {})
+            self.acquired[iR, iC] = 1
+            return False
+
+    # tile (iR, iC), repeat = True: the tile written again (tiles_A)
+    def read(self, iR, iC, repeat = False):
+        if repeat:
+            return self.tiles_A[iR, iC] if self.tiles_A is not None else None
+        return self.tiles[iR, iC]
+
+    def metadata(self, iR, iC, repeat = False):
+        s = self.meta.get('r{}c{}'.format(iR, iC) + ('_A' if repeat else ''))
+        return json.loads(s) if s is not None else None
+
+    # (nR, nC) bool array of the written tiles
+    def written(self):
+        return np.asarray(self.acquired[:, :]) > 0
+
+    # store attributes of the whole run (e.g. grid corners, settings)
+    def set_attrs(self, **attrs):
+        with self.lock:
+            for k, v in attrs.items():
+                self.meta[k] = json.dumps(v)
+
+    def close(self):
+        with self.lock:
+            if self.backend == 'hdf5' and self.root is not None:
+                self.root.close()
+            self.root = None
@@ -0,0 +1,66 @@
+import threading
+
+import numpy as np
+
+
+# 2 x 2 block average of a 2D array (odd last row / column dropped), same dtype
+# Integer images are summed in 32 bits (rows, then columns) and rounded, no float copy of the tile is made.
+def downsample2(a):
+    a = np.asarray(a)
+    h = a.shape[0] // 2 * 2
+    w = a.shape[1] // 2 * 2
+    a = a[:h, :w]
+    if np.issubdtype(a.dtype, np.integer):
+        rows = a[0::2].astype(np.uint32 if a.dtype.kind == 'u' and a.dtype.itemsize <= 2 else np.int64)
+        rows += a[1::2]
+        s = rows[:, 0::2] + rows[:, 1::2]
+        s += 2
+        s >>= 2
+        return s.astype(a.dtype)
+    return a.reshape(h // 2, 2, w // 2, 2).mean(axis = (1, 3)).astype(a.dtype)
+
+
+# pyramid levels 1 .. n of a tile: 2x, 4x, ... downsampled, each from the previous level
+def build_pyramid(a, n):
+    levels = []
+    for k in range(n):
+        if min(a.shape) < 2:
+            break
+        a = downsample2(a)
+        levels.append(a)
+    return levels
+
+
+# whole-grid overview at pyramid level 'level' (2^level downsampled), tiles placed on the grid
+# without registration, filled in as tiles are added (from any thread).
+# save_lock serializes the saving of snapshots by the caller.
+class Overview:
+
+    def __init__(self, nR, nC, height, width, level = 4, dtype = 'uint16'):
+        self.level = level
+        self.th = height >> level
+        self.tw = width >> level
+        self.image = np.zeros((nR * self.th, nC * self.tw), dtype = dtype)
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.n_tiles = 0
+
+    # add tile (iR, iC), from its pyramid levels (build_pyramid) or the full-resolution tile
+    # Returns the number of tiles added so far, including this one.
+    def add(self, iR, iC, levels = None, data = None):
+        if levels is not None and len(levels) >= self.level:
+            a = levels[self.level - 1] if self.level > 0 else data
+        else:
+            a = data
+            for k in range(self.level):
+                a = downsample2(a)
+        a = a[:self.th, :self.tw]
+        with self.lock:
+            self.image[iR * self.th:iR * self.th + a.shape[0], iC * self.tw:iC * self.tw + a.shape[1]] = a
+            self.n_tiles += 1
+            return self.n_tiles
+
+    # copy of the overview image
+    def snapshot(self):
+        with self.lock:
+            return self.image.copy()
@@ -14,6 +14,19 @@
 
 import sem_conn
 
+# precompiled encoders of frequently called functions (see sem_conn.GetCodec)
+_Int = sem_conn.ArgType.Int
+_Unsigned = sem_conn.ArgType.UnsignedInt
+_Float = sem_conn.ArgType.Float
+_cGetWD = sem_conn.GetCodec('GetWD', ())
+_cSetWD = sem_conn.GetCodec('SetWD', (_Float,))
+_cStgGetPosition = sem_conn.GetCodec('StgGetPosition', ())
+_cStgIsBusy = sem_conn.GetCodec('StgIsBusy', ())
+_cScSetBeamPos = sem_conn.GetCodec('ScSetBeamPos', (_Float, _Float))
+_cScScanXY = sem_conn.GetCodec('ScScanXY', (_Unsigned,) * 7 + (_Int,))
+_cScScanXYDwell = sem_conn.GetCodec('ScScanXY', (_Unsigned,) * 7 + (_Int, _Unsigned))
+_cIsBusy = sem_conn.GetCodec('IsBusy', (_Unsigned,))
+
 class Sem:
     """Tescan SEM Control Class
     
@@ -88,21 +101,47 @@ class Sem:
         """
         self.connection.wait_flags = flags
         
-    def FetchImage(self, channel, size):
+    def Batch(self):
+        """ Pipelined requests
+        
+        Returns SemBatch object, which has the same functions as Sem. The calls 
+        are not executed immediately, they are collected and then sent back-to-back
+        by SemBatch.Execute(). Functions with a response return sem_conn.Reply 
+        objects, the 'value' is available after Execute(). Example:
+        
+            b = m.Batch()
+            speed = b.ScGetSpeed()
+            hv = b.HVGetVoltage()
+            b.Execute()
+            print(speed.value, hv.value)
+            
+        Wait flags of the batch are set by SemBatch.SetWaitFlags().
+        """
+        return SemBatch(self.connection)
+        
+    def FetchImage(self, channel, size, bpp = 8, width = -1, height = -1):
         """ Read single image
         
         channel     input video channel
         size        number of image pixels (bytes)        
+        bpp         optional, bits per pixel of the result (8, 16)
+        width, height   optional, image size (pixels), see FetchImageEx()
         
         Scanning should be initiated first. Then, call this blocking function. During
         the call, messages from data connection are collected, decoded and image is
-        stored as a 'bytes' type. The resulting image is passed as a return value.
+        stored as a 'bytearray' type. The resulting image is passed as a return value.
         
-        Image is converted to 8-bit, even if 16-bit channel is configured.
+        By default (bpp = 8), image is converted to 8-bit, even if 16-bit channel is 
+        configured - the high byte of each pixel is taken. With bpp = 16, the full 
+        16-bit data are returned (2 bytes per pixel, little-endian). 
+        
+        If width and height are specified, numpy.ndarray of shape (height, width) is
+        returned. The 8-bit conversion of a 16-bit image is then a strided view of 
+        the receive buffer, no data is copied.
         """
-        return self.connection.FetchImage('ScData', channel, size)
+        return self.connection.FetchImage('ScData', channel, size, bpp, width, height)
 
-    def FetchImageEx(self, channel_list, pxl_size):
+    def FetchImageEx(self, channel_list, pxl_size, width = -1, height = -1):
         """ Read multiple images
         
         This extends FetchImage() capabilities. More image channels can be processed,
@@ -110,17 +149,42 @@ class Sem:
         
         channel_list    zero-based list of input video channels
         pxl_size        number of image pixels (pixels)        
+        width, height   optional, image size (pixels), see below
         
         Scanning should be initiated first. Then, call this blocking function. During
         the call, messages from data connection are collected, decoded and images are
-        stored as a ('bytes', 'bytes', ...) type, each string contains one channel.
-        The resulting images are returned as a list of byte strings containing pixles.
+        stored as a ('bytearray', 'bytearray', ...) type, each buffer contains one 
+        channel. The resulting images are returned as a list of buffers containing 
+        pixels. Each buffer is allocated once, the data packets are written in place,
+        so packets can come out of order or more than once.
         
         Both 8-bit and 16-bit data are supported. In case of 16-bit image, each pixel
         occupies 2 bytes in the output buffer (instead of one byte). The byte order
         is little-endian.
+        
+        If width and height are specified, numpy.ndarray objects of shape (height, 
+        width) and dtype uint8 / uint16 are returned instead. The arrays are views
+        of the receive buffers, no copy is made. Requires numpy.
+        """
+        return self.connection.FetchImageEx('ScData', channel_list, pxl_size, width, height)
+
+    def FetchLines(self, channel_list, width, height):
+        """ Read multiple images line by line (generator)
+        
+        channel_list    zero-based list of input video channels
+        width, height   image size (pixels)
+        
+        Scanning should be initiated first. Then, iterate over this generator. Each
+        time a block of rows becomes complete (no gaps from the image top), it yields
+        a sem_conn.ScanLines object with frame_id, channel, row range (row_start, 
+        row_stop) and the pixel data of the block. This allows to process or save 
+        the image while the beam is still scanning.
+        
+        The data is a view of the image buffer, it stays valid after the iteration.
+        The complete images (as in FetchImageEx) are the return value of the 
+        generator, ie. the result of 'yield from'.
         """
-        return self.connection.FetchImageEx('ScData', channel_list, pxl_size)
+        return self.connection.FetchLines('ScData', channel_list, width, height)
 
     def FetchCameraImage(self, channel):
         """ Read single image from camera (wait till it comes)
@@ -193,7 +257,7 @@ class Sem:
         return self.connection.RecvFloat('GetViewField')
         
     def GetWD(self):
-        return self.connection.RecvFloat('GetWD')
+        return self.connection.RecvCodec(_cGetWD, (_Float,), index = 0)
     
     def Set3DBeam(self, alpha, beta):
         self.connection.Send('Set3DBeam', self._CFloat(alpha), self._CFloat(beta))
@@ -217,7 +281,7 @@ class Sem:
         self.connection.Send('SetViewField', self._CFloat(vf))
 
     def SetWD(self, wd):
-        self.connection.Send('SetWD', self._CFloat(wd))
+        self.connection.SendCodec(_cSetWD, float(wd))
 
 ################################################################################
 #
@@ -245,19 +309,16 @@ class Sem:
         self.connection.Send('StgCalibrate')
 
     def StgGetPosition(self):
-        return self.connection.Recv('StgGetPosition', (sem_conn.ArgType.Float, sem_conn.ArgType.Float, sem_conn.ArgType.Float, sem_conn.ArgType.Float, sem_conn.ArgType.Float))
+        return self.connection.RecvCodec(_cStgGetPosition, (_Float, _Float, _Float, _Float, _Float))
 
     def StgIsBusy(self):
-        return self.connection.RecvInt('StgIsBusy')
+        return self.connection.RecvCodec(_cStgIsBusy, (_Int,), index = 0)
 
     def StgIsCalibrated(self):
         return self.connection.RecvInt('StgIsCalibrated')
 
     def StgMoveTo(self, *arg):
-        f_arg = []
-        for p in arg:
-            f_arg.append(self._CFloat(p))
-        self.connection.Send('StgMoveTo', *f_arg)
+        self.connection.SendCodec(sem_conn.GetCodec('StgMoveTo', (_Float,) * len(arg)), *map(float, arg))
 
     def StgMove(self, *arg):
         f_arg = []
@@ -321,14 +382,14 @@ class Sem:
         return self.connection.RecvInt('ScGetSpeed')
 
     def ScScanLine(self, frameid, width, height, x0, y0, x1, y1, dwell_time, pixel_count, single):
-        return self.connection.RecvInt('ScScanLine', self._CInt(0), self._CInt(width), self._CInt(height), self._CInt(x0), self._CInt(y0), self._CInt(x1), self._CInt(y1), self._CInt(dwell_time), self._CInt(pixel_count), self._CInt(single))
+        return self.connection.RecvInt('ScScanLine', self._CInt(frameid), self._CInt(width), self._CInt(height), self._CInt(x0), self._CInt(y0), self._CInt(x1), self._CInt(y1), self._CInt(dwell_time), self._CInt(pixel_count), self._CInt(single))
 
     # frameid, width, height, left, top, right, bottom, single <, dwell>
     def ScScanXY(self, *arg):
         if len(arg) == 8:
-            return self.connection.RecvInt('ScScanXY', self._CUnsigned(arg[0]), self._CUnsigned(arg[1]), self._CUnsigned(arg[2]), self._CUnsigned(arg[3]), self._CUnsigned(arg[4]), self._CUnsigned(arg[5]), self._CUnsigned(arg[6]), self._CInt(arg[7]))
+            return self.connection.RecvCodec(_cScScanXY, (_Int,), *arg, index = 0)
         if len(arg) == 9:
-            return self.connection.RecvInt('ScScanXY', self._CUnsigned(arg[0]), self._CUnsigned(arg[1]), self._CUnsigned(arg[2]), self._CUnsigned(arg[3]), self._CUnsigned(arg[4]), self._CUnsigned(arg[5]), self._CUnsigned(arg[6]), self._CInt(arg[7]), self._CUnsigned(arg[8]))
+            return self.connection.RecvCodec(_cScScanXYDwell, (_Int,), *arg, index = 0)
         
     def ScScanEDXXY(self, frameid, width, height, x1, y1, x2, y2, 
             channel, thr_low, thr_high, wait_dwell, wait_count, sync_mode, 
@@ -429,7 +490,7 @@ class Sem:
         self.connection.Send('ScStopScan')
         
     def ScSetBeamPos(self, x, y):
-        self.connection.Send('ScSetBeamPos', self._CFloat(x), self._CFloat(y))
+        self.connection.SendCodec(_cScSetBeamPos, float(x), float(y))
 
     def ScSetBeamPosGSR(self, x, y, ind_map, ind_sticky, img_channel):
         self.connection.Send('ScSetBeamPosGSR', self._CFloat(x), self._CFloat(y), self._CInt(ind_map), self._CInt(ind_sticky), self._CInt(img_channel))
@@ -889,7 +950,7 @@ class Sem:
         return self.connection.RecvString('GetDeviceParams', self._CUnsigned(param_set))
  
     def IsBusy(self, flags):
-        return self.connection.RecvInt('IsBusy', self._CUnsigned(flags))
+        return self.connection.RecvCodec(_cIsBusy, (_Int,), flags, index = 0)
 
 ################################################################################
 #
@@ -922,3 +983,21 @@ class Sem:
 
     def DbgGetOptPar(self):
         return self.connection.RecvString('DbgGetOptPar')
+
+
+class SemBatch(Sem):
+    """Pipelined SEM Requests
+    
+    See Sem.Batch().
+    """
+    
+    def __init__(self, connection):
+        """Constructor"""
+        self.connection = sem_conn.RequestBatch(connection)
+        
+    def Execute(self):
+        """ Send the requests, returns list of values of the functions with response 
+        
+        Raises the error of a failed response, see RequestBatch.Execute().
+        """
+        return self.connection.Execute()
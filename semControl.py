@@ -3,15 +3,29 @@ from tkinter import messagebox, filedialog
 from PIL import Image
 import os
 import time
-import math
+import json
+import contextlib
+import numpy as np
 from sem import Sem
+from sem_trace import Tracer, TracedConnection
+from sem_wait import wait_until, wait_idle, wait_busy, wait_stage, wait_gui_scanning, wait_settled
+from tile_path import StageCostModel, plan_tile_order, PLANNERS
+from tile_grid import TileGrid, mask_polygon, parse_polygon
+from focus_map import FocusMap, select_samples
+from autofocus import SoftwareAutofocus
+from autostig import ImageAutostig, find_stigmator
+from adjust_policy import AdjustPolicy
+from tile_writer import TileWriter, write_tiff, tifffile_available
+from mosaic_store import MosaicStore
+from pyramid import build_pyramid, Overview
+from stitching import Stitcher, blend
+from drift import DriftCorrector
 from pynput.mouse import Button as MouseButton
 from pynput.mouse import Controller as MouseController
 from pynput.keyboard import Key 
 from pynput.keyboard import Controller as KeyboardController
 import win32gui
 import subprocess
-import time
 
 
 class SemControl(Sem):
@@ -49,12 +63,81 @@ class SemControl(Sem):
     # these should be defined in the app
     image_adjust_option = ''
     image_capture_option = ''
+    
+    # save tiles in background threads while the next tile is acquired
+    n_writer_threads = 2
+    max_pending_tiles = 4
+    writer = None
+    
+    # tile files: tiled, compressed (OME-)TIFF with acquisition metadata if tifffile is installed, else PIL
+    tiff_compression = 'zlib'
+    tiff_tile = 512
+    tiff_ome_TF = 1
+    tiff_workers = 2
+    use_tifffile = None
+    
+    # mosaic store: '' = one file per tile, 'zarr' / 'hdf5' = all tiles of a run in one chunked array
+    # (see mosaic_store), <sample_name>.zarr / .h5 in folder_name
+    mosaic_backend = ''
+    store = None
+    
+    # reduced resolution levels (2x, 4x, ...) of each tile, saved with the tile (TIFF SubIFDs or store levels),
+    # and a whole-grid overview at overview_level, saved every overview_every_n tiles
+    pyramid_levels = 4
+    overview_level = 4
+    overview_every_n = 10
+    overview = None
+    
+    # stitching during the run (see stitching), on pyramid level stitch_level of each tile
+    # stitch_axes: sign of image (y, x) vs. stage (y, x); result saved as <sample_name>_stitch.json / _mosaic.tiff
+    stitch_TF = 1
+    stitch_level = 2
+    stitch_axes = (1, 1)
+    stitcher = None
+    
+    # closed-loop drift correction (see drift), requires stitch_TF: the stage error measured by registering
+    # each tile to its acquired neighbours corrects the next stage targets. Corrections smaller than
+    # image_shift_max_mm are applied by image shift instead of the stage, image_shift_axes: sign of
+    # image shift (x, y) vs. stage (x, y), 0: stage only. drift_rate_gain: gain of the drift rate estimate,
+    # which follows a steady ramp. Tiles are registered by the writer, so the estimate lags 1-2 tiles.
+    # Outliers are not used: registrations below drift_min_peak, neighbours disagreeing by more than
+    # drift_agree_mm, tiles off the predicted drift by more than drift_gate_mm.
+    drift_TF = 0
+    drift_gain = 0.5
+    drift_rate_gain = 0.1
+    drift_max_mm = 0.05
+    drift_min_peak = 0.3
+    drift_agree_mm = 0.002
+    drift_gate_mm = 0.01
+    image_shift_max_mm = 0.005
+    image_shift_axes = (1, 1)
+    drift = None
+    image_shift0 = None
+    
+    # timing trace of each run, written to folder_name as <sample_name>_trace.jsonl
+    # stages of the tile loop are named 'stage.*', SharkSEM calls by the function name
+    trace_TF = 0
+    tracer = None
+    
+    # timeouts (s) of the polling waits (see sem_wait), which replace fixed sleeps
+    # scan_timeout: max wait for the GUI to report live scanning on / off (GUIGetScanning)
+    # stig_settle: the stigmator is taken as settled when it does not change for this time (s)
+    scan_timeout = 2.0
+    stig_settle = 1.0
+    stage_timeout = 120.0
+    window_timeout = 5.0
         
     # Define scan area and grids
     nR = 2
     nC = 2
     iR = 0
     iC = 0
+    
+    # tile visiting order (see tile_path), planned at the start of a run
+    path_method = 'serpentine'
+    stage_cost = StageCostModel()
+    tile_order = []
+    i_tile = 0
     pos_upper_left = [0, 0]
     pos_upper_right = [0.2, 0]
     pos_lower_left = [0, 0.2]
@@ -64,15 +147,44 @@ class SemControl(Sem):
     WD_lower_left = 90
     WD_lower_right = 90
     
-    def __init__(self, channel):
+    # tile positions and WDs of all tiles (see tile_grid), built from the corners at the start of a run
+    # overlap: overlap fraction of neighbouring tiles, nR and nC are then set from the corners (0 = use nR, nC)
+    # region_polygon: stage positions (x, y) of a polygon, only tiles inside it are imaged (None = all)
+    # tile_mask: nR x nC bool array of tiles to image (None = all), combined with region_polygon
+    grid = None
+    overlap = 0.0
+    region_polygon = None
+    tile_mask = None
+    
+    # 'focus-map' adjust option: AutoWD at n_focus_samples tiles, WD of the other tiles from
+    # a surface ('plane', 'poly', 'tps') fitted to the corner WDs and the AutoWD results
+    focus_method = 'tps'
+    n_focus_samples = 9
+    focus_map = None
+    focus_samples = set()
+    
+    # autofocus: 'builtin' (AutoWD) or 'software' (sub-frame scans scored by af_metric, see autofocus)
+    autofocus_method = 'builtin'
+    af_metric = 'gradient'
+    af_search = 'golden'
+    af_window = 128
+    af_dwell_ns = 100
+    
+    # autostigmation: 'image' (stigmator search on sub-frame scans, see autostig) or 'gui' (MiraTC mouse automation)
+    autostig_method = 'image'
+    stigmator = None
+    
+    # adaptive adjustment (see adjust_policy): rerun auto signal / 'auto' focus and stigmation only
+    # when the captured tiles drift, or every adjust_every_n tiles
+    adaptive_adjust_TF = 0
+    adjust_every_n = 10
+    policy = None
+    
+    def __init__(self, channel, sem_ip = "localhost", sem_port = 8300):
         Sem.__init__(self)
         
         self.channel = channel
         
-        # define the IP address of the SEM
-        sem_ip = "localhost"
-        sem_port = 8300
-        
         # connecting to the microscope via SharkSEM protocol
         res = self.Connect(sem_ip, sem_port)
         # handling the output
@@ -106,54 +218,100 @@ class SemControl(Sem):
         self.DtEnable(self.channel, 1, self.nbits_image) # channel(0), enbale(1) for acquisition with nbits_image data stream
 
         
+    # precompute positions and WDs of all tiles from the 4 corners, select tiles by region_polygon / tile_mask
+    def build_grid(self):
+        corners = [self.pos_upper_left, self.pos_upper_right, self.pos_lower_left, self.pos_lower_right]
+        wds = [self.WD_upper_left, self.WD_upper_right, self.WD_lower_left, self.WD_lower_right]
+        if self.overlap > 0:
+            self.grid = TileGrid.from_overlap(corners, wds, self.view_field, self.overlap)
+            self.nR, self.nC = self.grid.nR, self.grid.nC
+        else:
+            self.grid = TileGrid(corners, wds, self.nR, self.nC)
+        mask = self.grid.mask.copy()
+        if self.tile_mask is not None:
+            mask &= np.asarray(self.tile_mask, dtype = bool)
+        if self.region_polygon is not None:
+            mask &= mask_polygon(self.grid, self.region_polygon)
+        if not mask.any():
+            raise ValueError("No tile of the {} x {} grid is selected".format(self.nR, self.nC))
+        self.grid.set_mask(mask)
+        ox, oy = self.grid.overlap(self.view_field)
+        print("Grid: {} x {}, {} tiles to image, overlap {:.0f} % x {:.0f} %".format(self.nR, self.nC, len(self.grid.tiles()), ox*100, oy*100))
+    
+    # start focus map from the corner WDs, choose the tiles for AutoWD
+    def build_focus_map(self):
+        xy = self.grid.positions()
+        self.focus_map = FocusMap(self.focus_method, center = xy.mean(axis = 0), scale = max(np.ptp(xy, axis = 0).max(), self.view_field))
+        corners = self.grid.corners
+        self.focus_map.add(corners[:,0], corners[:,1], self.grid.corner_wds)
+        rc = self.grid.tiles()
+        self.focus_samples = set((int(rc[i][0]), int(rc[i][1])) for i in select_samples(xy, self.n_focus_samples, corners))
+    
     # determine stage position for index (iR,iC)
     def get_position_iRiC(self,iR,iC):
-        nR = self.nR
-        nC = self.nC
-        px = 1/(nR-1)/(nC-1) * ((nR-1-iR) * (nC-1-iC) * self.pos_upper_left[0] 
-                        + (nR-1-iR) * iC * self.pos_upper_right[0] 
-                        + iR * (nC-1-iC) * self.pos_lower_left[0]
-                        + iR * iC * self.pos_lower_right[0])
-        py = 1/(nR-1)/(nC-1) * ((nR-1-iR) * (nC-1-iC) * self.pos_upper_left[1] 
-                        + (nR-1-iR) * iC * self.pos_upper_right[1] 
-                        + iR * (nC-1-iC) * self.pos_lower_left[1]
-                        + iR * iC * self.pos_lower_right[1])
+        if self.grid is None or (self.grid.nR, self.grid.nC) != (self.nR, self.nC):
+            self.build_grid()
+        px,py,WD_target = self.grid.position(iR,iC)
         print("iR={},iC={},px={},py={}".format(iR,iC,px,py))
-        
-        WD_target = 1/(nR-1)/(nC-1) * ((nR-1-iR) * (nC-1-iC) * self.WD_upper_left 
-                + (nR-1-iR) * iC * self.WD_upper_right
-                + iR * (nC-1-iC) * self.WD_lower_left
-                + iR * iC * self.WD_lower_right)
         return (px,py,WD_target)  
     
     # move to imaging position for iR,iC
     def move_to_iRiC(self):
         px,py,WD_target = self.get_position_iRiC(self.iR, self.iC)
         self.SetWaitFlags(self.wtflgB)
+        if self.drift is not None:
+            px,py = self.correct_drift(px,py)
         self.StgMoveTo(px,py)    
         self.WD_target = WD_target
+        if not wait_stage(self, self.stage_timeout):
+            print("Warning: stage still moving after {} s".format(self.stage_timeout))
     
-    # update iR,iC for next imaging position
-    def update_next_iRiC(self):
-        # (1) If iR is even, (1.1) if iC < iC_max, then iC += 1; (1.2) else, iR += 1
-        # (2) Else iR is odd, (2.1) if iC > iC_min, then iC -= 1; (2.2) else, iR += 1
-        if math.fmod(self.iR,2) == 0:
-            if self.iC < (self.nC-1):
-                self.iC += 1
-            else:
-                self.iR += 1    
+    # stage target (px,py) corrected for the estimated drift, small corrections by image shift
+    def correct_drift(self, px, py):
+        c = self.drift.correction()
+        if max(abs(c[0]), abs(c[1])) < self.image_shift_max_mm:
+            sx, sy = self.image_shift_axes
+            self.SetImageShift(self.image_shift0[0] + sx * c[0], self.image_shift0[1] + sy * c[1])
         else:
-            if self.iC > 0:
-                self.iC -= 1
-            else:
-                self.iR += 1
+            if self.image_shift_max_mm > 0:
+                self.SetImageShift(*self.image_shift0)
+            px, py = px + c[0], py + c[1]
+        self.drift.record_applied((self.iR,self.iC), c)
+        if c.any():
+            print("Drift correction: dx={:.4f} mm, dy={:.4f} mm".format(c[0], c[1]))
+        return (px, py)
+    
+    # plan the visiting order of all tiles, using path_method, starting from current (iR,iC)
+    def plan_tiles(self):
+        if self.grid is None:
+            self.build_grid()
+        rc = [tuple(int(i) for i in t) for t in self.grid.tiles()]
+        start = rc.index((self.iR,self.iC)) if (self.iR,self.iC) in rc else 0
+        order, t = plan_tile_order(rc, self.grid.positions(), self.path_method, self.stage_cost, start)
+        self.tile_order = [rc[i] for i in order]
+        # the path starts at the current (iR,iC) ('tsp', 'hilbert'), or resume from it along the
+        # fixed serpentine order, as the earlier tiles of that order were imaged before
+        if (self.iR,self.iC) in self.tile_order:
+            self.i_tile = self.tile_order.index((self.iR,self.iC))
+        else:
+            self.i_tile = 0
+            self.iR, self.iC = self.tile_order[0]
+        print("Tile order: {}, estimated stage travel time {:.0f} s".format(self.path_method, t))
+    
+    # update iR,iC for next imaging position, along the planned tile order
+    def update_next_iRiC(self):
+        if not self.tile_order:
+            self.plan_tiles()
+        self.i_tile += 1
         
         # if not out of bound, move. Else, end.
-        if self.iR <= (self.nR-1):
+        if self.i_tile < len(self.tile_order):
+            self.iR, self.iC = self.tile_order[self.i_tile]
             return True
         else:
             self.iR = 0
             self.iC = 0
+            self.i_tile = 0
             print("Reached end of imaging position, change (iR,iC) to (0,0)")
             return False
     
@@ -164,7 +322,7 @@ class SemControl(Sem):
         # 3 = maximize, 5 = show where it was, 9 = restore
         win32gui.ShowWindow(hwnd, 5)
         win32gui.SetForegroundWindow(hwnd)
-        time.sleep(1)    
+        wait_until(lambda: win32gui.GetForegroundWindow() == hwnd, self.window_timeout)
     
     # set for live imaging using preferred setting
     def live_imaging(self):
@@ -178,7 +336,14 @@ class SemControl(Sem):
     # Modify some super class functions. add wait and wait flags
     def GUISetScanning(self, enableTF):
         super().GUISetScanning(enableTF)
-        time.sleep(0.5)
+        wait_gui_scanning(self, enableTF, self.scan_timeout)
+    
+    # wait till the e-beam procedure sent with wait flags 'flags' finishes: a request with the same
+    # flags is executed after it, so its response marks the end (an IsBusy poll is answered at
+    # once, it could come before the queued procedure has even started)
+    def wait_procedure(self, flags):
+        self.SetWaitFlags(flags)
+        self.GetWD()
     
     def ScStopScan(self):
         self.SetWaitFlags(self.wtflgC)
@@ -189,7 +354,7 @@ class SemControl(Sem):
         self.ScStopScan()
         self.SetWaitFlags(self.wtflgD) # need wtflgD 
         super().DtAutoSignal(channel)
-        self.GetWD() # need this to block progress until finish
+        self.wait_procedure(self.wtflgD)
         self.GUISetScanning(1)
     
     def AutoWD(self, *arg):
@@ -197,15 +362,27 @@ class SemControl(Sem):
         self.ScStopScan()
         self.SetWaitFlags(self.wtflgD)
         super().AutoWD(*arg)
-        self.GetWD() # need this to block progress until finish
+        self.wait_procedure(self.wtflgD)
         print("WD changed to: " + str(self.GetWD()))
         self.GUISetScanning(1)
         
+    # autofocus in WD range [lo, hi] (mm), using autofocus_method
+    def autofocus(self, lo, hi):
+        if self.autofocus_method == 'software':
+            print("Software auto focus(WD) at WD: " + str(self.GetWD()))
+            af = SoftwareAutofocus(self, self.channel, self.af_metric, self.af_search,
+                                   window = self.af_window, dwell_ns = self.af_dwell_ns)
+            wd = af.run(lo, hi)
+            print("WD changed to: {} ({} frames)".format(wd, len(af.evaluations)))
+            self.GUISetScanning(1)
+        else:
+            self.AutoWD(self.channel, lo, hi)
+        
     def SetWD(self, *arg):
         print("Set Focus(WD) to (mm): " + str(self.WD_target))
         self.SetWaitFlags(self.wtflgC)
         super().SetWD(*arg)
-        self.GetWD() # need this to block progress until finish
+        self.wait_procedure(self.wtflgC)
         print("Double check, Focus(WD) changed to: " + str(self.GetWD()))
         self.GUISetScanning(1)
         
@@ -224,54 +401,318 @@ class SemControl(Sem):
         
         # (1) make MiraTC window front
         self.make_window_front(window_name_str)
-        time.sleep(0.5)
         print("Auto Stig ...")
-        self.GetWD() # make sure to block
-        
-        # (2) right click at a target_pos
+        self.wait_procedure(self.wtflgC | self.wtflgD)
+        
+        # stigmator before the procedure, to see when it is done if IsBusy does not report it
+        if self.stigmator is None:
+            self.stigmator = find_stigmator(self)
+        get_stig = None
+        if self.stigmator is not None:
+            kind, index = self.stigmator
+            get_stig = (lambda: tuple(self.GetGeometry(index))) if kind == 'geometry' else (lambda: tuple(self.GetCentering(index)))
+            stig0 = get_stig()
+        
+        # (2) right click at a target_pos, wait for the context menu (window class '#32768')
         target_pos = [256, 256]
         mouse.move(target_pos[0]-mouse.position[0], target_pos[1]-mouse.position[1])
         mouse.click(MouseButton.right)
-        time.sleep(0.5)        
+        wait_until(lambda: win32gui.FindWindow('#32768', None), self.window_timeout)
         # (3) move to position "Auto Stigmation"
         mouse.move(40,80)
-        time.sleep(0.5)        
-        # (4) right click
+        # (4) left click, the menu closes
         mouse.click(MouseButton.left)
-        time.sleep(0.5)
-        
-        # (6) wait for auto stigmation to finish
-        print("Wait {} seconds for auto stig to finish".format(wait_time))
+        wait_until(lambda: not win32gui.FindWindow('#32768', None), self.window_timeout)
+        
+        # (6) wait for auto stigmation to finish, at most wait_time seconds
+        # if the procedure is not reported by IsBusy, wait till the stigmator has changed and settled;
+        # without a known stigmator there is nothing to poll, wait_time is waited out
+        print("Wait up to {} seconds for auto stig to finish".format(wait_time))
+        start = time.time()
+        if wait_busy(self, self.wtflgD, min(2.0, wait_time)):
+            wait_idle(self, self.wtflgD, max(0, wait_time - (time.time() - start)))
+        elif get_stig is not None:
+            wait_settled(get_stig, stig0, self.stig_settle, max(0, wait_time - (time.time() - start)))
+        else:
+            time.sleep(max(0, wait_time - (time.time() - start)))
         self.GUISetScanning(1)
-        time.sleep(wait_time)
         
     
+    # stigmation using autostig_method, 'image' falls back to the GUI if the SEM reports no stigmator
+    def autostig(self):
+        if self.autostig_method == 'image':
+            if self.stigmator is None:
+                self.stigmator = find_stigmator(self)
+            if self.stigmator is not None:
+                print("Auto Stig ...")
+                st = ImageAutostig(self, self.channel, self.stigmator, window = self.af_window, dwell_ns = self.af_dwell_ns)
+                xy = st.run()
+                print("Stigmator changed to: {} ({} frames)".format(xy, st.n_frames))
+                self.GUISetScanning(1)
+                return
+            print("No stigmator found, using MiraTC GUI")
+        self.AutoStig(15, "MiraTC")
+    
     # adjust brightness, contrast, focus, stigmation
     def adjust_imaging(self):
         # set to target view field, stop scan before auto adjustment
         self.SetViewField(self.view_field)
         
         # (1) Auto B&C
-        self.DtAutoSignal(self.channel)
+        do_signal = self.policy is None or self.policy.need_signal()
+        if do_signal:
+            with self.span('stage.autosignal'):
+                self.DtAutoSignal(self.channel)
+        if self.policy is not None:
+            self.policy.signal_done(do_signal)
         
         if self.image_adjust_option.get() == 'manual':
-            messagebox.showinfo('Message','Adjust focus, stigmation, then continue', icon='warning')
+            with self.span('stage.manual_adjust'):
+                messagebox.showinfo('Message','Adjust focus, stigmation, then continue', icon='warning')
         elif self.image_adjust_option.get() == 'interp':
-            self.SetWD(self.WD_target)
+            with self.span('stage.setwd'):
+                self.SetWD(self.WD_target)
         elif self.image_adjust_option.get() == 'auto':
+            do_focus = self.policy is None or self.policy.need_focus()
+            if self.policy is not None:
+                self.policy.focus_done(do_focus)
+            if not do_focus:
+                print("Focus and stigmation kept from previous tile")
+                self.SetViewField(self.view_field)
+                return
+            
             # (2) Auto focus after zoom in
-            self.SetViewField(self.view_field/10)
-            wd = self.GetWD()
-            self.AutoWD(self.channel, wd-1, wd+1)
+            with self.span('stage.autowd'):
+                self.SetViewField(self.view_field/10)
+                wd = self.GetWD()
+                self.autofocus(wd-1, wd+1)
 
             # (3) Auto stigmation. 
             # Note (a) if we set vf between AutoWD and AutoStig, then stig finish early bad
             # (b) if we GUISetScanning(1), sometime we cannot find window
-            self.AutoStig(15, "MiraTC")
+            with self.span('stage.autostig'):
+                self.autostig()
+        elif self.image_adjust_option.get() == 'focus-map':
+            px,py,wd = self.grid.position(self.iR,self.iC)
+            self.WD_target = self.focus_map.predict(px,py)
+            if (self.iR,self.iC) in self.focus_samples:
+                # (2) Auto focus after zoom in, starting from the predicted WD, and refit
+                with self.span('stage.focus_sample'):
+                    self.SetViewField(self.view_field/10)
+                    self.SetWD(self.WD_target)
+                    self.autofocus(self.WD_target-1, self.WD_target+1)
+                    wd = self.GetWD()
+                    self.focus_map.add(px, py, wd)
+                    print("Focus map: {} samples, rms residual {:.4f} mm".format(len(self.focus_map), self.focus_map.residual()))
+            else:
+                with self.span('stage.setwd'):
+                    self.SetWD(self.WD_target)
         
         # (4) Change back to desired view_field to image
         self.SetViewField(self.view_field)
         
+    # output file <sample_name><suffix> in folder_name
+    def output_path(self, suffix):
+        return os.path.join(self.folder_name, self.sample_name + suffix)
+    
+    # check if tile file exists, or is still queued in the writer
+    def tile_exists(self, fp):
+        if self.writer is not None:
+            return self.writer.exists(fp)
+        return os.path.exists(fp)
+    
+    # start background writer for a multi-tile run, open mosaic store if used
+    def start_writer(self):
+        if self.mosaic_backend:
+            ext = '.h5' if self.mosaic_backend == 'hdf5' else '.zarr'
+            fp = self.output_path(ext)
+            self.store = MosaicStore(fp, self.nR, self.nC, self.image_resolution, self.image_resolution,
+                                     'uint16' if self.nbits_image == 16 else 'uint8', self.tiff_tile, self.mosaic_backend, self.pyramid_levels)
+            self.store.set_attrs(corners = self.grid.corners.tolist(), corner_wds = self.grid.corner_wds.tolist(),
+                                 view_field_mm = self.view_field, dwell_ns = self.dwell_ns)
+            print("Mosaic store: " + fp)
+        self.overview = Overview(self.nR, self.nC, self.image_resolution, self.image_resolution, self.overview_level,
+                                 'uint16' if self.nbits_image == 16 else 'uint8')
+        if self.stitch_TF:
+            n = self.image_resolution >> self.stitch_level
+            self.stitcher = Stitcher((n, n))
+            if self.drift_TF:
+                self.drift = DriftCorrector(self.drift_gain, self.drift_max_mm, self.drift_rate_gain,
+                                            self.drift_min_peak, self.drift_agree_mm, self.drift_gate_mm)
+                self.image_shift0 = list(self.GetImageShift())
+        self.writer = TileWriter(self.n_writer_threads, self.max_pending_tiles, self.tracer)
+    
+    # wait till all tiles are saved, stop background writer
+    def stop_writer(self):
+        try:
+            if self.writer is not None:
+                writer = self.writer
+                self.writer = None
+                writer.close()
+        finally:
+            try:
+                if self.stitcher is not None:
+                    self.finish_stitching()
+                if self.overview is not None:
+                    self.save_overview()
+            finally:
+                if self.drift is not None:
+                    print("Drift: {} tiles measured, {} rejected as outliers, {} not registered".format(
+                        len(self.drift.errors) - len(self.drift.rejected), len(self.drift.rejected), len(self.drift.unresolved())))
+                    if self.image_shift_max_mm > 0:
+                        self.SetImageShift(*self.image_shift0)
+                self.drift = None
+                self.stitcher = None
+                self.overview = None
+                if self.store is not None:
+                    store = self.store
+                    self.store = None
+                    store.close()
+    
+    # timing span of a run stage (see sem_trace), no-op if tracing is off
+    def span(self, name, **args):
+        if self.tracer is None:
+            return contextlib.nullcontext()
+        return self.tracer.span(name, **args)
+    
+    # start timing trace, every SharkSEM call is recorded too
+    def start_trace(self):
+        if not self.trace_TF:
+            return
+        fp = self.output_path('_trace.jsonl')
+        self.tracer = Tracer(fp)
+        self.connection = TracedConnection(self.connection, self.tracer)
+        print("Timing trace: " + fp)
+    
+    # stop timing trace, print summary table
+    def stop_trace(self):
+        if self.tracer is not None:
+            tracer = self.tracer
+            self.tracer = None
+            self.connection = self.connection.conn
+            print(tracer.summary())
+            tracer.close()
+    
+    # acquisition metadata of the current tile, embedded in the tile file
+    def tile_metadata(self):
+        pos, wd = self.get_position_wd()
+        return {
+            'sample': self.sample_name,
+            'iR': self.iR,
+            'iC': self.iC,
+            'stage_x_mm': pos[0],
+            'stage_y_mm': pos[1],
+            'stage_position': list(pos),
+            'wd_mm': wd,
+            'view_field_mm': self.view_field,
+            'pixel_size_um': self.view_field / self.image_resolution * 1000,
+            'dwell_ns': self.dwell_ns,
+            'voltage_V': self.voltage,
+            'beam_intensity': self.beam_intensity,
+            'channel': self.channel,
+            'detector': self.detector,
+            'bits': self.nbits_image,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+    
+    # save tile (2D array) as fp (or into the mosaic store), in the background if the writer is running
+    def save_tile(self, data, fp):
+        if self.use_tifffile is None:
+            self.use_tifffile = tifffile_available()
+            if not self.use_tifffile and self.store is None:
+                print("tifffile not installed, tiles are saved by PIL without compression / metadata")
+        metadata = self.tile_metadata() if (self.use_tifffile or self.store is not None) else None
+        if self.writer is not None:
+            for f, e in self.writer.take_errors():
+                print("Failed to save {}: {}".format(f, e))
+            key = self.store.path + ':r{}c{}'.format(self.iR, self.iC) if self.store is not None else fp
+            with self.span('stage.queue_save'):
+                self.writer.submit(key, self.write_tile, self.iR, self.iC, data, fp, metadata)
+        else:
+            with self.span('stage.save', fp = fp):
+                self.write_tile(self.iR, self.iC, data, fp, metadata)
+    
+    # nominal position (y, x) of tile (iR,iC) in image pixels at pyramid level 'level'
+    def tile_position_px(self, iR, iC, level):
+        px,py,wd = self.grid.position(iR,iC)
+        pxl_mm = self.view_field / self.image_resolution * 2**level
+        return (self.stitch_axes[0] * py / pxl_mm, self.stitch_axes[1] * px / pxl_mm)
+    
+    # register tile (iR,iC) to its acquired neighbours, from its pyramid level stitch_level
+    def stitch_tile(self, iR, iC, data, levels):
+        if self.stitch_level > len(levels):
+            return
+        img = levels[self.stitch_level - 1] if self.stitch_level > 0 else data
+        neighbours = {}
+        for (r, c) in ((iR-1,iC), (iR+1,iC), (iR,iC-1), (iR,iC+1)):
+            if 0 <= r < self.grid.nR and 0 <= c < self.grid.nC and self.grid.mask[r,c]:
+                neighbours[(r,c)] = self.tile_position_px(r, c, self.stitch_level)
+        pos = self.tile_position_px(iR, iC, self.stitch_level)
+        found = self.stitcher.add_tile((iR,iC), img, pos, neighbours)
+        if self.drift is not None:
+            # measured - nominal neighbour offset, image pixels -> stage mm
+            pxl_mm = self.view_field / self.image_resolution * 2**self.stitch_level
+            deltas = {}
+            for (key, nkey), (m, peak) in found.items():
+                dy = m[0] - (neighbours[nkey][0] - pos[0])
+                dx = m[1] - (neighbours[nkey][1] - pos[1])
+                deltas[nkey] = ((self.stitch_axes[1] * dx * pxl_mm, self.stitch_axes[0] * dy * pxl_mm), peak)
+            self.drift.observe((iR,iC), deltas)
+    
+    # place all tiles, save positions (full resolution pixels) and a blended mosaic at the overview level
+    def finish_stitching(self):
+        positions = self.stitcher.solve()
+        if not positions:
+            return
+        print("Stitching: {} tiles, {} pairs, rms residual {:.2f} pxl".format(len(positions), len(self.stitcher.pairs), self.stitcher.residual(positions)))
+        scale = 2**self.stitch_level
+        fp = self.output_path('_stitch.json')
+        with open(fp, 'w') as f:
+            json.dump({'r{}c{}'.format(*k): [float(v) * scale for v in p] for k, p in positions.items()}, f, indent = 1)
+        if self.overview is not None:
+            ov = self.overview
+            img = ov.snapshot()
+            tiles = {k: img[k[0]*ov.th:(k[0]+1)*ov.th, k[1]*ov.tw:(k[1]+1)*ov.tw] for k in positions}
+            f = 2.0**(self.stitch_level - ov.level)
+            mosaic, origin = blend(tiles, {k: p * f for k, p in positions.items()})
+            fp = self.output_path('_mosaic.tiff')
+            Image.frombuffer(mode=self.image_mode, size=(mosaic.shape[1],mosaic.shape[0]), data=mosaic, decoder_name='raw').save(fp)
+    
+    # write tile with its pyramid levels, update the overview and stitching (runs in a writer thread)
+    # PIL saves the tile only, then levels are built just as far as stitching / overview need them.
+    def write_tile(self, iR, iC, data, fp, metadata):
+        if self.store is not None or self.use_tifffile:
+            n_levels = self.pyramid_levels
+        else:
+            n_levels = max(self.stitch_level if self.stitcher is not None else 0,
+                           self.overview.level if self.overview is not None else 0)
+        levels = build_pyramid(data, n_levels)
+        if self.stitcher is not None:
+            self.stitch_tile(iR, iC, data, levels)
+        if self.overview is not None:
+            n = self.overview.add(iR, iC, levels, data)
+            if n % self.overview_every_n == 0:
+                self.save_overview()
+        if self.store is not None:
+            if self.store.write(iR, iC, data, metadata, levels):
+                print("Mosaic store: tile r{}c{} written again, saved as r{}c{}_A".format(iR, iC, iR, iC))
+        elif self.use_tifffile:
+            write_tiff(fp, data, metadata, self.tiff_tile, self.tiff_compression, bool(self.tiff_ome_TF), self.tiff_workers, levels)
+        else:
+            img = Image.frombuffer(mode=self.image_mode, size=(data.shape[1],data.shape[0]), data=data, decoder_name='raw')
+            img.save(fp)
+    
+    # save the whole-grid overview as <sample_name>_overview.tiff
+    # One save at a time (writer threads), the snapshot is taken inside, so the last save is the latest.
+    def save_overview(self):
+        overview = self.overview
+        if overview is None:
+            return
+        with overview.save_lock:
+            img = overview.snapshot()
+            fp = self.output_path('_overview.tiff')
+            Image.frombuffer(mode=self.image_mode, size=(img.shape[1],img.shape[0]), data=img, decoder_name='raw').save(fp)
+    
     # capture a single image
     def capture_image(self):  
         if self.image_capture_option.get() == 'auto':
@@ -283,19 +724,22 @@ class SemControl(Sem):
             bottom = self.image_resolution- 1
             frameid = 0
 
-            self.ScStopScan()
-            self.SetWaitFlags(self.wtflgB)
-            self.ScScanXY(frameid, width, height, left, top, right, bottom, self.single_frame_TF, self.dwell_ns)
+            with self.span('stage.scan_fetch', width = width, height = height, dwell_ns = self.dwell_ns):
+                self.ScStopScan()
+                self.SetWaitFlags(self.wtflgB)
+                self.ScScanXY(frameid, width, height, left, top, right, bottom, self.single_frame_TF, self.dwell_ns)
 
-            img_str = self.FetchImageEx([self.channel], int(width * height))[0]
-            self.ScStopScan()
+                img_str = self.FetchImage(self.channel, int(width * height), self.nbits_image)
+                self.ScStopScan()
 
-            img = Image.frombuffer(mode=self.image_mode, size=(width,height), data=img_str, decoder_name='raw')
-            fp = self.folder_name + '\\'+ self.sample_name + '_r' + str(self.iR) + 'c' + str(self.iC) + '.tiff'
+            data = np.frombuffer(img_str, dtype = '<u2' if self.nbits_image == 16 else 'u1').reshape(height, width)
+            if self.policy is not None:
+                self.policy.observe(data)
+            fp = self.output_path('_r' + str(self.iR) + 'c' + str(self.iC) + '.tiff')
             # if exist, save image pair as '...A.tiff'
-            if os.path.exists(fp):
+            if self.tile_exists(fp):
                 fp = fp.split('.tiff')[0] + '_A.tiff'
-            img.save(fp)
+            self.save_tile(data, fp)
 
         elif self.image_capture_option.get() == 'external':
             width = self.image_resolution
@@ -306,7 +750,7 @@ class SemControl(Sem):
 
             print('Imaging ...')
             # Call externalscan.exe, compiled from cpp, to run external scan controller for imaging
-            args = self.external_exe_name + " -w " + str(width) + " -h " + str(height) + " -s " + str(dwell_us) + " -o " + self.folder_name + '\\'+ self.sample_name + '_r' + str(self.iR) + 'c' + str(self.iC) + '.tiff'
+            args = self.external_exe_name + " -w " + str(width) + " -h " + str(height) + " -s " + str(dwell_us) + " -o " + self.output_path('_r' + str(self.iR) + 'c' + str(self.iC) + '.tiff')
             
             success = 0
             while(not success):
@@ -325,22 +769,19 @@ class SemControl(Sem):
             self.make_window_front('MiraTC')
             
             keyboard = KeyboardController()
-            # press 'shift + a'
-            time.sleep(2)
+            # press 'shift + a', once MiraTC is in front and live scanning
+            wait_gui_scanning(self, 1, self.scan_timeout)
             with keyboard.pressed(Key.shift):
                 keyboard.press('a')
                 keyboard.release('a')
             
             # detect window, then click 'enter' to save
-            time.sleep(2)
-            while not win32gui.FindWindow(0,'Header of Save Window'):
-                time.sleep(1)
+            wait_until(lambda: win32gui.FindWindow(0,'Header of Save Window'), timeout = None, interval = 0.1, max_interval = 1)
             
             self.make_window_front('Header of Save Window')
-            time.sleep(1)
             keyboard.press(Key.enter)
             keyboard.release(Key.enter)
-            time.sleep(1)
+            wait_until(lambda: not win32gui.FindWindow(0,'Header of Save Window'), self.window_timeout)
 
             
         elif self.image_capture_option.get() == 'manual':
@@ -397,7 +838,7 @@ class SemControl(Sem):
         Label(self.app, text = "Image adjust option").grid(row = 7, column = 0, padx = 5, pady = 5, sticky = 'E')
         self.image_adjust_option = StringVar(self.app)
         self.image_adjust_option.set('interp')
-        self.image_adjust_option_menu = OptionMenu(self.app, self.image_adjust_option, 'auto', 'interp', 'manual')
+        self.image_adjust_option_menu = OptionMenu(self.app, self.image_adjust_option, 'auto', 'interp', 'focus-map', 'manual')
         self.image_adjust_option_menu.grid(row = 7, column = 1, columnspan = 2, ipadx = 15, pady = 5, sticky = 'W')
         
         # Image capture option
@@ -407,6 +848,36 @@ class SemControl(Sem):
         self.image_capture_option_menu = OptionMenu(self.app, self.image_capture_option, 'auto', 'built-in', 'manual', 'external')
         self.image_capture_option_menu.grid(row = 7, column = 6, columnspan = 2, ipadx = 15, pady = 5, sticky = 'W')
         
+        # Tile order option
+        Label(self.app, text = "Tile order").grid(row = 8, column = 0, padx = 5, pady = 5, sticky = 'E')
+        self.path_method_option = StringVar(self.app)
+        self.path_method_option.set(self.path_method)
+        self.path_method_option_menu = OptionMenu(self.app, self.path_method_option, *PLANNERS.keys())
+        self.path_method_option_menu.grid(row = 8, column = 1, columnspan = 2, ipadx = 15, pady = 5, sticky = 'W')
+        
+        # Autofocus option
+        Label(self.app, text = "Autofocus").grid(row = 8, column = 5, padx = 5, pady = 5, sticky = 'E')
+        self.autofocus_option = StringVar(self.app)
+        self.autofocus_option.set(self.autofocus_method)
+        self.autofocus_option_menu = OptionMenu(self.app, self.autofocus_option, 'builtin', 'software')
+        self.autofocus_option_menu.grid(row = 8, column = 6, columnspan = 2, ipadx = 15, pady = 5, sticky = 'W')
+        
+        # Adaptive adjust option
+        self.adaptive_adjust_input = IntVar(self.app, self.adaptive_adjust_TF)
+        Checkbutton(self.app, text = "Adaptive adjust (skip when tiles are stable)", variable = self.adaptive_adjust_input).grid(row = 9, column = 1, columnspan = 4, pady = 5, sticky = 'W')
+        
+        # Overlap, sets nR and nC from the corners if not blank
+        overlap_label = Label(self.app, text = "Overlap (%, blank = use nR, nC) = ")
+        overlap_label.grid(row = 9, column = 5, padx = 5, pady = 5, sticky = 'E')
+        self.overlap_input = Entry(self.app, width = 10, borderwidth = 5)
+        self.overlap_input.grid(row = 9, column = 6, padx = 5, pady = 5, sticky = 'W')
+        
+        # Region to image, tiles outside the polygon are skipped
+        region_label = Label(self.app, text = "Region (x1, y1; x2, y2; ...) = ")
+        region_label.grid(row = 10, column = 0, padx = 5, pady = 5, sticky = 'E')
+        self.region_input = Entry(self.app, width = 75, borderwidth = 5)
+        self.region_input.grid(row = 10, column = 1, columnspan = 9, padx = 5, pady = 5, sticky = 'W')
+        
         name_label = Label(self.app, text = "Image name prefix = ")
         name_label.grid(row = 11, column = 0, padx = 5, pady = 5, sticky = 'E')
         self.sample_name_input = Entry(self.app, width = 75, borderwidth = 5)
@@ -583,63 +1054,82 @@ class SemControl(Sem):
         
         self.image_adjust_option
         self.image_capture_option
+        self.path_method = self.path_method_option.get()
+        self.autofocus_method = self.autofocus_option.get()
+        self.adaptive_adjust_TF = self.adaptive_adjust_input.get()
+        self.overlap = float(self.overlap_input.get() or 0) / 100
+        self.region_polygon = parse_polygon(self.region_input.get())
         self.sample_name = self.sample_name_input.get()
         self.folder_name = self.folder_name_input.get()
         self.external_exe_name = self.external_exe_name_input.get()
     
-        # update read-onlys
-        self.scan_speed = self.ScGetSpeed()
+        # update read-onlys, read out in a single round trip
+        b = self.Batch()
+        scan_speed = b.ScGetSpeed()
+        pc_index = b.GetPCIndex()
+        voltage = b.HVGetVoltage()
+        b.Execute()
+        
+        self.scan_speed = scan_speed.value
         self.scan_speed_input.configure(state = 'normal')
         self.scan_speed_input.delete(0, END)        
         self.scan_speed_input.insert(0, self.scan_speed)
         self.scan_speed_input.configure(state = 'readonly')
         
-        self.beam_intensity = 21 - self.GetPCIndex()
+        self.beam_intensity = 21 - pc_index.value
         self.beam_intensity_input.configure(state = 'normal')
         self.beam_intensity_input.delete(0, END)        
         self.beam_intensity_input.insert(0, self.beam_intensity)
         self.beam_intensity_input.configure(state = 'readonly')
         
-        self.voltage = self.HVGetVoltage()
+        self.voltage = voltage.value
         self.voltage_input.configure(state = 'normal')
         self.voltage_input.delete(0, END)        
         self.voltage_input.insert(0, self.voltage)
         self.voltage_input.configure(state = 'readonly')
         
+    # read current stage position and WD, in a single round trip
+    def get_position_wd(self):
+        b = self.Batch()
+        pos = b.StgGetPosition()
+        wd = b.GetWD()
+        b.Execute()
+        return (pos.value, wd.value)
+    
     # read current stage position, and put it into the App
     def read_position(self, pos_str):
         if pos_str == 'ul':
-            pos = self.StgGetPosition()
+            pos, wd = self.get_position_wd()
             self.pos_upper_left = [pos[0], pos[1]]
             self.x_upper_left_input.delete(0, END)
             self.x_upper_left_input.insert(0, pos[0])
             self.y_upper_left_input.delete(0, END)
             self.y_upper_left_input.insert(0, pos[1]) 
-            self.WD_upper_left = self.GetWD()
+            self.WD_upper_left = wd
         elif pos_str == 'ur':
-            pos = self.StgGetPosition()
+            pos, wd = self.get_position_wd()
             self.pos_upper_right = [pos[0], pos[1]]
             self.x_upper_right_input.delete(0, END)
             self.x_upper_right_input.insert(0, pos[0])
             self.y_upper_right_input.delete(0, END)
             self.y_upper_right_input.insert(0, pos[1])
-            self.WD_upper_right = self.GetWD()
+            self.WD_upper_right = wd
         elif pos_str == 'll':
-            pos = self.StgGetPosition()
+            pos, wd = self.get_position_wd()
             self.pos_lower_left = [pos[0], pos[1]]
             self.x_lower_left_input.delete(0, END)
             self.x_lower_left_input.insert(0, pos[0])
             self.y_lower_left_input.delete(0, END)
             self.y_lower_left_input.insert(0, pos[1])
-            self.WD_lower_left = self.GetWD()
+            self.WD_lower_left = wd
         elif pos_str == 'lr':
-            pos = self.StgGetPosition()
+            pos, wd = self.get_position_wd()
             self.pos_lower_right = [pos[0], pos[1]]
             self.x_lower_right_input.delete(0, END)
             self.x_lower_right_input.insert(0, pos[0])
             self.y_lower_right_input.delete(0, END)
             self.y_lower_right_input.insert(0, pos[1])
-            self.WD_lower_right = self.GetWD()
+            self.WD_lower_right = wd
     
     # move stage to position indicated in the App
     def go_to_position(self, pos_str):
@@ -672,19 +1162,40 @@ class SemControl(Sem):
         self.pos_lower_left = [float(self.x_lower_left_input.get()), float(self.y_lower_left_input.get())]
         self.pos_lower_right = [float(self.x_lower_right_input.get()), float(self.y_lower_right_input.get())]
         self.click_to_update()
-        
-        # iterate all positions to image
+        self.build_grid()
+        self.nR_input.delete(0, END)
+        self.nR_input.insert(0, self.nR)
+        self.nC_input.delete(0, END)
+        self.nC_input.insert(0, self.nC)
+        self.plan_tiles()
+        self.policy = AdjustPolicy(self.adjust_every_n) if self.adaptive_adjust_TF else None
+        if self.image_adjust_option.get() == 'focus-map':
+            self.build_focus_map()
+        
+        # iterate all positions to image, tile N is saved while moving to and imaging tile N+1
         self.live_imaging()
-        continueTF = True
-        while continueTF:
-            self.move_to_iRiC()
-            self.adjust_imaging()
-            self.capture_image()
-            self.live_imaging()
-            continueTF = self.update_next_iRiC()
-
-        self.move_to_iRiC()   
-        self.HVBeamOff()
+        self.start_trace()
+        self.start_writer()
+        try:
+            continueTF = True
+            while continueTF:
+                with self.span('stage.tile', iR = self.iR, iC = self.iC):
+                    with self.span('stage.move'):
+                        self.move_to_iRiC()
+                    with self.span('stage.adjust'):
+                        self.adjust_imaging()
+                    with self.span('stage.capture'):
+                        self.capture_image()
+                    self.live_imaging()
+                continueTF = self.update_next_iRiC()
+    
+            self.move_to_iRiC()   
+            self.HVBeamOff()
+        finally:
+            try:
+                self.stop_writer()
+            finally:
+                self.stop_trace()
     
     # calibration
     def start_calibration(self):
@@ -0,0 +1,245 @@
+#
+# SharkSEM asyncio client
+#
+# Requires Python 3.7+
+#
+
+import asyncio
+import socket
+import struct
+
+import sem
+from sem_conn import ArgType, DecodeString, EncodeMessage, DecodeValues, ImageAssembler
+
+
+#
+# SharkSEM connection (asyncio)
+#
+class AsyncSemConnection:
+    """Asynchronous SEM Connection Class
+
+    Counterpart of sem_conn.SemConnection running on asyncio streams. Message
+    marshaling is shared with SemConnection (EncodeMessage, DecodeValues,
+    ImageAssembler).
+
+    Control and data connections are independent. Requests with a response
+    are serialized by a lock on the control connection, so several tasks may
+    issue them concurrently, while another task reads image data from the
+    data connection.
+
+    A request whose response cannot be read (connection lost, or the task
+    cancelled, e.g. by asyncio.wait_for) closes the connection and raises:
+    the rest of the response would be read by the next request otherwise.
+    """
+
+    def __init__(self):
+        """ Constructor """
+        self.reader_c = None    # control connection
+        self.writer_c = None
+        self.reader_d = None    # data connection
+        self.writer_d = None
+        self.lock_c = None      # request / response lock, control connection
+        self.wait_flags = 0     # wait flags (bits 5:0)
+
+    async def _RecvMsg(self, reader):
+        """ Receive single message (header + body), returns (fn_name, body) """
+        hdr = await reader.readexactly(32)
+        fn_name = DecodeString(hdr[0:16])
+        v = struct.unpack_from("<IIHHI", hdr, 16)
+        body = await reader.readexactly(v[0])
+        return (fn_name, body)
+
+    async def Connect(self, address, port):
+        """ Connect to the server """
+        try:
+            self.lock_c = asyncio.Lock()
+            self.reader_c, self.writer_c = await asyncio.open_connection(address, port)
+            sock_d = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock_d.bind(('', 0))
+            loc_ep = sock_d.getsockname()
+            loc_port = loc_ep[1]
+            await self.RecvInt('TcpRegDataPort', (ArgType.Int, loc_port))
+            sock_d.setblocking(False)
+            await asyncio.get_running_loop().sock_connect(sock_d, (address, port + 1))
+            self.reader_d, self.writer_d = await asyncio.open_connection(sock = sock_d)
+            return 0
+
+        except (OSError, asyncio.IncompleteReadError):
+            self.Disconnect()
+            return -1
+        except asyncio.CancelledError:
+            self.Disconnect()
+            raise
+
+    def Disconnect(self):
+        """ Close the connection(s) """
+        for writer in (self.writer_c, self.writer_d):
+            try:
+                if writer is not None:
+                    writer.close()
+            except:
+                pass
+        self.reader_c = self.writer_c = None
+        self.reader_d = self.writer_d = None
+
+    def Send(self, fn_name, *args):
+        """ Send simple message (header + data), no response expected
+
+        The message is passed to the transport immediately, there is nothing
+        to await. See SemConnection.Send for argument types.
+        """
+        try:
+            self.writer_c.write(EncodeMessage(fn_name, self.wait_flags, *args))
+        except:
+            pass
+
+    def SendCodec(self, codec, *values):
+        """ Send simple message using precompiled encoder, see SemConnection.SendCodec """
+        try:
+            self.writer_c.write(codec.Encode(self.wait_flags, values))
+        except:
+            pass
+
+    async def Drain(self):
+        """ Wait till the messages sent by Send() are flushed """
+        await self.writer_c.drain()
+
+    async def _RecvResponse(self):
+        """ Receive the response on the control connection, close it if the read is interrupted """
+        if self.reader_c is None:
+            raise ConnectionError("Not connected")
+        try:
+            fn_recv, body = await self._RecvMsg(self.reader_c)
+        except (OSError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            self.Disconnect()
+            raise
+        return body
+
+    async def Recv(self, fn_name, retval, *args):
+        """ Send message and receive response, see SemConnection.Recv """
+        async with self.lock_c:
+            self.Send(fn_name, *args)
+            body = await self._RecvResponse()
+        return DecodeValues(body, retval)
+
+    async def RecvCodec(self, codec, retval, *values, index = -1):
+        """ Send message using precompiled encoder and receive response, see SemConnection.RecvCodec """
+        async with self.lock_c:
+            self.SendCodec(codec, *values)
+            body = await self._RecvResponse()
+        l = DecodeValues(body, retval)
+        if index >= 0:
+            return l[index]
+        return l
+
+    async def RecvInt(self, fn_name, *args):
+        """ Simple variant of Recv() - single int value is expected """
+        v = await self.Recv(fn_name, (ArgType.Int,), *args)
+        return v[0]
+
+    async def RecvUInt(self, fn_name, *args):
+        """ Simple variant of Recv() - single unsigned int value is expected """
+        v = await self.Recv(fn_name, (ArgType.UnsignedInt,), *args)
+        return v[0]
+
+    async def RecvFloat(self, fn_name, *args):
+        """ Simple variant of Recv() - single float value is expected """
+        v = await self.Recv(fn_name, (ArgType.Float,), *args)
+        return v[0]
+
+    async def RecvString(self, fn_name, *args):
+        """ Simple variant of Recv() - single string value is expected """
+        v = await self.Recv(fn_name, (ArgType.String,), *args)
+        return v[0]
+
+    async def _RecvData(self, fn_name):
+        """ Receive next image data packet, returns (frame_id, channel, index, bpp, data) """
+        while True:
+            s, body = await self._RecvMsg(self.reader_d)
+            if s != fn_name or len(body) < 20:
+                continue
+            v = struct.unpack_from("<IIIII", body, 0)
+            return (v[0], v[1], v[2], v[3], memoryview(body)[20:(20 + v[4])])
+
+    async def _FetchData(self, fn_name, asm):
+        """ Receive image data packets till the assembler 'asm' is complete """
+        while not asm.Done():
+            frame_id, channel, index, bpp, data = await self._RecvData(fn_name)
+            asm.Add(channel, index, bpp, data)
+        return asm
+
+    async def FetchImage(self, fn_name, channel, size, bpp = 8, width = -1, height = -1):
+        """ Fetch image. See Sem.FetchImage for details """
+        asm = await self._FetchData(fn_name, ImageAssembler([channel], size))
+        if width > 0 and height > 0:
+            img = asm.Arrays(width, height)[0]
+            if bpp == 8 and img.itemsize == 2:
+                img = img.view("u1")[:, 1::2]       # high bytes, strided view
+            return img
+        img = asm.img[0]
+        if bpp == 8 and asm.bytes_pp[0] == 2:
+            img = img[1::2]                         # high bytes (little-endian)
+        return img
+
+    async def FetchImageEx(self, fn_name, channel_list, pxl_size, width = -1, height = -1):
+        """ Fetch image. See Sem.FetchImageEx for details """
+        asm = await self._FetchData(fn_name, ImageAssembler(channel_list, pxl_size))
+        if width > 0 and height > 0:
+            return asm.Arrays(width, height)
+        return asm.img
+
+    async def FetchLines(self, fn_name, channel_list, width, height):
+        """ Fetch image line by line (async generator). See Sem.FetchLines
+
+        Unlike SemConnection.FetchLines, there is no return value. The data of
+        the yielded blocks are views of the complete image buffers.
+        """
+        asm = ImageAssembler(channel_list, width * height)
+        while not asm.Done():
+            frame_id, channel, index, bpp, data = await self._RecvData(fn_name)
+            if asm.Add(channel, index, bpp, data) <= 0:
+                continue
+            lines = asm.Lines(channel, frame_id, width)
+            if lines is not None:
+                yield lines
+
+    async def FetchCameraImage(self, channel):
+        """ Fetch camera image. See Sem.FetchCameraImage for details """
+        while True:
+            s, body = await self._RecvMsg(self.reader_d)
+            if s != 'CameraData' or len(body) < 20:
+                continue
+            v = struct.unpack_from("<IIIII", body, 0)
+            arg_channel = v[0]
+            arg_bpp = v[1]
+            arg_width = v[2]
+            arg_height = v[3]
+            arg_data_size = v[4]
+            if arg_channel != channel or arg_bpp != 8:
+                continue
+            return (arg_width, arg_height, body[20:])
+
+
+#
+# main SEM interface class (asyncio)
+#
+class AsyncSem(sem.Sem):
+    """Asynchronous Tescan SEM Control Class
+
+    Same interface as sem.Sem, on top of AsyncSemConnection. Functions with a
+    response (Get..., Is..., Enum..., Fetch..., Connect) return awaitables,
+    FetchLines returns an async generator. Functions without a response send
+    the request immediately and return None.
+
+    Example - poll the stage while the image is being received:
+
+        img_task = asyncio.create_task(m.FetchImageEx([0], w * h))
+        while not img_task.done():
+            print(await m.StgIsBusy(), await m.HVGetEmission())
+            await asyncio.sleep(0.5)
+        img = await img_task
+    """
+
+    def __init__(self):
+        """Constructor"""
+        self.connection = AsyncSemConnection()
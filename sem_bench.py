@@ -0,0 +1,268 @@
+#
+# Acquisition throughput benchmarks
+#
+# Runs the client stack (SemConnection / Sem) against the local SharkSEM
+# simulator (sem_sim) and reports the results as JSON, so they can be compared
+# between versions.
+#
+# Usage: python sem_bench.py [-o results.json] [--sizes 1024 4096 16384] [--quick]
+#
+
+import argparse
+import contextlib
+import importlib
+import json
+import platform
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import sem
+import sem_conn
+import sem_sim
+
+
+def _stats(samples):
+    samples = sorted(samples)
+    n = len(samples)
+    return {
+        'n': n,
+        'mean': sum(samples) / n,
+        'min': samples[0],
+        'p50': samples[n // 2],
+        'p99': samples[min(n - 1, int(n * 0.99))],
+        'max': samples[-1],
+    }
+
+
+# receive bandwidth of the ScData path (SemConnection._FetchData: pooled _RecvMsg buffers,
+# ImageAssembler) over a local socket pair, frames of frame_mb in packets of packet_kb
+def bench_recv(total_mb = 256, frame_mb = 32, packet_kb = 64):
+    conn = sem_conn.SemConnection()
+    a, b = socket.socketpair()
+    conn.socket_d = a
+    n_pixels = frame_mb * 1024 * 1024
+    n_frames = max(1, total_mb // frame_mb)
+    step = packet_kb * 1024
+    data = b'\x5a' * step
+    frame = b''.join(struct.pack("<16sIIHHI", b'ScData', 20 + step, 0, 0, 0, 0)
+                     + struct.pack("<IIIII", 0, 0, index, 8, step) + data for index in range(0, n_pixels, step))
+
+    def sender():
+        for i in range(n_frames):
+            b.sendall(frame)
+
+    t = threading.Thread(target = sender, daemon = True)
+    start = time.perf_counter()
+    t.start()
+    for i in range(n_frames):
+        conn._FetchData('ScData', sem_conn.ImageAssembler([0], n_pixels))
+    elapsed = time.perf_counter() - start
+    t.join()
+    a.close()
+    b.close()
+    return {
+        'name': 'recv_scdata',
+        'bytes': n_frames * n_pixels,
+        'packet_bytes': step,
+        'seconds': elapsed,
+        'mb_per_s': n_frames * n_pixels / elapsed / 1e6,
+    }
+
+
+# Send / Recv round trip (GetWD) against the simulator
+def bench_round_trip(m, n = 2000):
+    samples = []
+    for i in range(n):
+        start = time.perf_counter()
+        m.GetWD()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return dict(name = 'round_trip_us', **_stats(samples))
+
+
+# pipelined round trip (Sem.Batch), per request
+def bench_batch(m, n = 200, batch_size = 10):
+    samples = []
+    for i in range(n):
+        b = m.Batch()
+        for k in range(batch_size):
+            b.GetWD()
+        start = time.perf_counter()
+        b.Execute()
+        samples.append((time.perf_counter() - start) * 1e6 / batch_size)
+    return dict(name = 'batch_us_per_request', batch_size = batch_size, **_stats(samples))
+
+
+# ScScanXY + FetchImageEx, frame of size x size pixels
+def bench_fetch(m, size, bpp, repeat = 3):
+    m.DtEnable(0, 1, bpp)
+    m.ScScanXY(0, 64, 64, 0, 0, 63, 63, 1, 0)      # warm-up, not timed
+    m.FetchImageEx([0], 64 * 64)
+    samples = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        m.ScScanXY(i, size, size, 0, 0, size - 1, size - 1, 1, 0)
+        img = m.FetchImageEx([0], size * size)
+        samples.append(time.perf_counter() - start)
+        del img
+    frame_bytes = size * size * bpp // 8
+    best = min(samples)
+    return {
+        'name': 'fetch_image_ex',
+        'size': size,
+        'bpp': bpp,
+        'bytes': frame_bytes,
+        'seconds': _stats(samples),
+        'mb_per_s': frame_bytes / best / 1e6,
+    }
+
+
+# input widget of the SemControl app (Entry, StringVar, IntVar), holds a value
+class _Input:
+
+    def __init__(self, value = ''):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+    def delete(self, first, last = None):
+        self.value = ''
+
+    def insert(self, index, value):
+        self.value = value
+
+    def configure(self, **options):
+        pass
+
+
+# import semControl; the Windows GUI automation modules (win32gui, pynput: MiraTC window,
+# mouse and keyboard), which are not used by the 'interp' adjust and 'auto' capture options,
+# are replaced by empty modules if they are not installed
+def _import_sem_control():
+    stubs = {
+        'win32gui': {},
+        'pynput': {},
+        'pynput.mouse': {'Button': None, 'Controller': None},
+        'pynput.keyboard': {'Key': None, 'Controller': None},
+    }
+    for name, attrs in stubs.items():
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            module = types.ModuleType(name)
+            module.__dict__.update(attrs)
+            sys.modules[name] = module
+    return importlib.import_module('semControl')
+
+
+# end-to-end tile loop: SemControl.start_imaging on a n_rows x n_cols grid ('interp' adjust,
+# 'auto' capture), with the app inputs set directly instead of by the Tk GUI.
+# Includes everything the run does (waits, adjustment, background saving, ...).
+# drift_TF: with stage drift correction. The app output goes to stderr.
+def bench_tiles(port, sim, n_rows = 2, n_cols = 2, size = 1024, drift_TF = 0):
+    with contextlib.redirect_stdout(sys.stderr):
+        return _bench_tiles(port, sim, n_rows, n_cols, size, drift_TF)
+
+def _bench_tiles(port, sim, n_rows, n_cols, size, drift_TF):
+    semControl = _import_sem_control()
+    folder = tempfile.mkdtemp(prefix = 'sem_bench_')
+    m = semControl.SemControl(0, '127.0.0.1', port)
+    try:
+        step = 0.9 * m.view_field      # 10 % overlap
+        corners = {'upper_left': (0, 0), 'upper_right': (step * (n_cols - 1), 0),
+                   'lower_left': (0, step * (n_rows - 1)), 'lower_right': (step * (n_cols - 1), step * (n_rows - 1))}
+        for name, (x, y) in corners.items():
+            setattr(m, 'x_' + name + '_input', _Input(x))
+            setattr(m, 'y_' + name + '_input', _Input(y))
+        inputs = {
+            'nR_input': n_rows, 'nC_input': n_cols, 'view_field_input': m.view_field, 'dwell_input': 100,
+            'resolution_input': size, 'iR_input': 0, 'iC_input': 0,
+            'image_adjust_option': 'interp', 'image_capture_option': 'auto',
+            'path_method_option': 'serpentine', 'autofocus_option': 'builtin', 'adaptive_adjust_input': 0,
+            'overlap_input': '', 'region_input': '',
+            'sample_name_input': 'bench', 'folder_name_input': folder, 'external_exe_name_input': '',
+            'scan_speed_input': '', 'beam_intensity_input': '', 'voltage_input': '',
+        }
+        for name, value in inputs.items():
+            setattr(m, name, _Input(value))
+        m.trace_TF = 0
+        m.drift_TF = drift_TF
+
+        start = time.perf_counter()
+        m.start_imaging()
+        elapsed = time.perf_counter() - start
+    finally:
+        m.Disconnect()
+        shutil.rmtree(folder, ignore_errors = True)
+    n_tiles = n_rows * n_cols
+    return {
+        'name': 'tile_loop',
+        'tiles': n_tiles,
+        'size': size,
+        'bpp': m.nbits_image,
+        'drift_TF': drift_TF,
+        'sim_time_scale': sim.time_scale,
+        'seconds': elapsed,
+        'tiles_per_hour': n_tiles / elapsed * 3600,
+    }
+
+
+def run(sizes, quick = False):
+    results = [bench_recv(64 if quick else 256)]
+
+    sim = sem_sim.SemSimulator(port = 0, time_scale = 0.0)
+    port = sim.start()
+    m = sem.Sem()
+    if m.Connect('127.0.0.1', port) < 0:
+        raise RuntimeError("Unable to connect to the simulator")
+    try:
+        results.append(bench_round_trip(m, 200 if quick else 2000))
+        results.append(bench_batch(m, 20 if quick else 200))
+        for size in sizes:
+            for bpp in (8, 16):
+                results.append(bench_fetch(m, size, bpp, 1 if quick else 3))
+
+    finally:
+        m.Disconnect()
+
+    # end-to-end, stage / auto procedures at 1/100 of the simulated real time
+    try:
+        sim.time_scale = 0.01
+        results.append(bench_tiles(port, sim, 2, 2 if quick else 3))
+    finally:
+        sim.stop()
+
+    return {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'SharkSEM client throughput benchmarks (simulated server)')
+    parser.add_argument('-o', '--output', help = 'write JSON results to file (default: stdout)')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [1024, 4096, 16384], help = 'frame sizes (pxl)')
+    parser.add_argument('--quick', action = 'store_true', help = 'fewer repetitions, smaller transfers')
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.quick)
+    text = json.dumps(report, indent = 2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -21,7 +21,7 @@ def DecodeString(s_in):
     for i in range(0, len(s_in)):
         if s_in[i] == 0:
             break            
-    return s_in[0:i].decode()
+    return bytes(s_in[0:i]).decode()
 
 #
 # SharkSEM data types
@@ -33,6 +33,391 @@ class ArgType:
     """
     Int, UnsignedInt, String, Float, ArrayInt, ArrayUnsignedInt, ArrayByte = range(7)
     
+#
+# wait flags (see Sem.SetWaitFlags, Sem.IsBusy)
+#
+wtflgA = 0b1        # e-beam scanning
+wtflgB = 0b10       # stage
+wtflgC = 0b100      # e-beam optics
+wtflgD = 0b1000     # e-beam automatic procedure
+
+
+#
+# precompiled message encoders
+#
+_HDR = struct.Struct("<16sIIHHI")      # message header
+_I32 = struct.Struct("<i")
+_U32 = struct.Struct("<I")
+
+def _EncInt(v):                         # 32-bit integer
+    return _I32.pack(int(v))
+
+def _EncUnsigned(v):                    # 32-bit unsigned integer
+    return _U32.pack(int(v))
+
+def _EncString(v):                      # string, floating point
+    s = (str(v) + "\x00\x00\x00\x00").encode()
+    l = (len(s) // 4) * 4
+    return _U32.pack(l) + s[0:l]
+
+def _EncFloat(v):                       # floating point (sent as string, as given)
+    return _EncString(v)
+
+def _EncArrayByte(v):                   # byte array
+    s = str(v) + "\x00\x00\x00\x00"
+    l = (len(s) // 4) * 4
+    return _U32.pack(l) + s[0:l]
+
+def _EncArrayInt(v):                    # array of 32-bit integers
+    return struct.pack("<I%di" % (len(v)), len(v) * 4, *v)
+
+def _EncArrayUnsigned(v):               # array of 32-bit unsigned integers
+    return struct.pack("<I%dI" % (len(v)), len(v) * 4, *v)
+
+_ENCODERS = {
+    ArgType.Int: _EncInt,
+    ArgType.UnsignedInt: _EncUnsigned,
+    ArgType.String: _EncString,
+    ArgType.Float: _EncFloat,
+    ArgType.ArrayInt: _EncArrayInt,
+    ArgType.ArrayUnsignedInt: _EncArrayUnsigned,
+    ArgType.ArrayByte: _EncArrayByte,
+}
+
+class MessageCodec:
+    """Precompiled Message Encoder
+    
+    Encoder for one SharkSEM function signature (name + argument types), see
+    GetCodec(). The signature is compiled once:
+    
+        - if all arguments are Int / UnsignedInt, the whole message (header +
+          body) is a single struct.Struct, encoded by one pack() call
+        - otherwise, there is a list of per-argument encoders (format plan),
+          the parts are joined once
+          
+    Argument values are plain Python values (no type tuples). Int values
+    are converted by int(), the other values are formatted as in Send(), 
+    so a Float value should be converted by the caller (as Sem._CFloat).
+    """
+    
+    def __init__(self, fn_name, arg_types):
+        """ Constructor """
+        self.fn_name = fn_name
+        self.name = fn_name.ljust(16, "\x00").encode()   # padded fn name
+        self.arg_types = tuple(arg_types)
+        self.plan = [_ENCODERS[t] for t in self.arg_types]
+        self.msg = None
+        fmt = ""
+        for t in self.arg_types:
+            if t == ArgType.Int:
+                fmt = fmt + "i"
+            elif t == ArgType.UnsignedInt:
+                fmt = fmt + "I"
+            else:
+                return
+        self.msg = struct.Struct("<16sIIHHI" + fmt)     # fixed size message
+        self.body_size = self.msg.size - _HDR.size
+        
+    def Encode(self, wait_flags, values, ident = 0):
+        """ Build message (header + body), returns bytes """
+        if self.msg is not None:
+            return self.msg.pack(self.name, self.body_size, ident, (wait_flags << 8), 0, 0, *map(int, values))
+        parts = [b""]
+        for enc, v in zip(self.plan, values):
+            parts.append(enc(v))
+        body_size = 0
+        for part in parts:
+            body_size = body_size + len(part)
+        parts[0] = _HDR.pack(self.name, body_size, ident, (wait_flags << 8), 0, 0)
+        return b"".join(parts)
+
+_codecs = {}
+
+def GetCodec(fn_name, arg_types):
+    """ Precompiled encoder for fn_name and tuple of argument types (cached) """
+    key = (fn_name, arg_types)
+    codec = _codecs.get(key)
+    if codec is None:
+        codec = MessageCodec(fn_name, arg_types)
+        _codecs[key] = codec
+    return codec
+
+#
+# encode message (header + body)
+#
+def EncodeMessage(fn_name, wait_flags, *args, ident = 0):
+    """ Build SharkSEM request message, see SemConnection.Send for details 
+    
+    'ident' is the Identification field of the header, the server copies it 
+    to the response.
+    """
+    arg_types = tuple([pair[0] for pair in args])
+    values = [pair[1] for pair in args]
+    return GetCodec(fn_name, arg_types).Encode(wait_flags, values, ident)
+
+#
+# decode response body
+#
+def DecodeValues(body, retval):
+    """ Parse output arguments of types 'retval', see SemConnection.Recv """
+    
+    # parse return value
+    l = []
+    start = 0
+    
+    for t in retval:
+                    
+        if t == ArgType.Int:   				# 32-bit integer
+            stop = start + 4
+            v = struct.unpack("<i", body[start:stop])
+            l.append(v[0])
+            start = stop
+            
+        if t == ArgType.UnsignedInt:   		# 32-bit unsigned integer
+            stop = start + 4
+            v = struct.unpack("<I", body[start:stop])
+            l.append(v[0])
+            start = stop
+
+        if t == ArgType.Float:              # floating point
+            stop = start + 4
+            v = struct.unpack("<I", body[start:stop])
+            fl_size = v[0]
+            start = stop
+            stop = start + fl_size
+            s = DecodeString(body[start:stop])
+            l.append(float(s))
+            start = (start + fl_size + 3) // 4 * 4
+            
+        if t == ArgType.String:             # string
+            stop = start + 4
+            v = struct.unpack("<I", body[start:stop])
+            fl_size = v[0]
+            start = stop
+            stop = start + fl_size
+            s = DecodeString(body[start:stop])
+            l.append(s)
+            start = (start + fl_size + 3) // 4 * 4
+
+        if (t == ArgType.ArrayInt or t == ArgType.ArrayUnsignedInt):           # int array, unsigned int array
+            stop = start + 4
+            v = struct.unpack("<I", body[start:stop])
+            cnt = v[0] // 4
+            start = stop
+            stop = start + 4 * cnt
+            if t == ArgType.ArrayInt:
+                arr_l = struct.unpack("<%di" % (cnt), body[start:stop])
+            else:
+                arr_l = struct.unpack("<%dI" % (cnt), body[start:stop])
+            l.append(arr_l)
+            start = stop
+
+        if t == ArgType.ArrayByte:          # byte array
+            stop = start + 4
+            v = struct.unpack("<I", body[start:stop])
+            fl_size = v[0]
+            start = stop
+            stop = start + fl_size
+            l.append(bytes(body[start:stop]))
+            start = (start + fl_size + 3) // 4 * 4
+
+    return l
+
+#
+# receive buffer pool
+#
+class BufferPool:
+    """Receive Buffer Pool
+
+    Keeps a small set of preallocated buffers (bytearray), so that the receive
+    path does not allocate a new buffer for each incoming message. Buffers are
+    taken by Get() and given back by Release() when the data is not needed
+    any more.
+    """
+
+    def __init__(self, max_buffers = 8):
+        """ Constructor """
+        self.max_buffers = max_buffers      # max. number of kept free buffers
+        self.free = []                      # free buffers, sorted by size
+        
+    def Get(self, size):
+        """ Get buffer with at least 'size' bytes (smallest suitable one) """
+        for i in range(0, len(self.free)):
+            if len(self.free[i]) >= size:
+                return self.free.pop(i)
+        return bytearray(size)
+        
+    def Release(self, buf):
+        """ Give the buffer back to the pool """
+        if len(self.free) >= self.max_buffers:
+            if len(buf) <= len(self.free[0]):
+                return
+            self.free.pop(0)                # drop the smallest one
+        i = 0
+        while i < len(self.free) and len(self.free[i]) < len(buf):
+            i = i + 1
+        self.free.insert(i, buf)
+    
+
+#
+# image reassembly
+#
+class ImageAssembler:
+    """Image Reassembly
+    
+    Collects the image data packets (ScData) of one or more channels. Each
+    channel has a single buffer (bytearray) of pxl_size * bytes_pp bytes, the
+    buffer is allocated when the first packet of the channel arrives (pixel
+    size is not known before). Packets are written in place at their pixel
+    index, so packets sent more than once simply overwrite the old data.
+
+    Completion is tracked by a coverage bitmap (one byte per pixel), the
+    channel is complete when every pixel was received at least once.
+    """
+    
+    def __init__(self, channel_list, pxl_size):
+        """ Constructor """
+        self.pxl_size = pxl_size
+        self.ch_lookup = {}         # channel -> index look up table
+        for ch in channel_list:
+            self.ch_lookup[ch] = len(self.ch_lookup)
+        n_channels = len(self.ch_lookup)
+        self.img = [None] * n_channels          # image buffers
+        self.bytes_pp = [0] * n_channels        # bytes per pixel
+        self.coverage = [None] * n_channels     # coverage bitmaps
+        self.covered = [0] * n_channels         # number of received pixels
+        self.prefix = [0] * n_channels          # number of leading pixels received
+        self.rows_done = [0] * n_channels       # number of rows returned by Lines()
+        self.n_done = 0                         # number of complete channels
+        self.ones = b""                         # fill pattern for coverage bitmap
+        
+    def Add(self, channel, index, bpp, data):
+        """ Add data packet
+        
+        channel     input video channel
+        index       index of the first pixel in the packet
+        bpp         bits per pixel (8, 16)
+        data        pixel data (buffer)
+        
+        Returns the number of pixels (in the packet), which were not received 
+        before, or -1 if the packet does not belong to this image.
+        """
+        channel_index = self.ch_lookup.get(channel, -1)
+        if channel_index < 0:                           # check if we read this image
+            return -1
+        bytes_pp = bpp // 8
+        if self.img[channel_index] is None:             # first packet, allocate
+            self.img[channel_index] = bytearray(self.pxl_size * bytes_pp)
+            self.coverage[channel_index] = bytearray(self.pxl_size)
+            self.bytes_pp[channel_index] = bytes_pp
+        if bytes_pp != self.bytes_pp[channel_index]:    # wrong pixel size
+            return -1
+        
+        # clip to image size
+        start = index
+        stop = min(index + len(data) // bytes_pp, self.pxl_size)
+        if start >= stop:
+            return 0
+        n = stop - start
+        
+        # copy data in place
+        self.img[channel_index][(start * bytes_pp):(stop * bytes_pp)] = data[0:(n * bytes_pp)]
+        
+        # update coverage
+        cov = self.coverage[channel_index]
+        n_new = n - cov.count(1, start, stop)
+        if n_new > 0:
+            if len(self.ones) < n:
+                self.ones = b"\x01" * n
+            cov[start:stop] = memoryview(self.ones)[0:n]
+            self.covered[channel_index] = self.covered[channel_index] + n_new
+            if self.covered[channel_index] == self.pxl_size:
+                self.n_done = self.n_done + 1
+            if start <= self.prefix[channel_index]:     # extend the received prefix
+                p = cov.find(0, stop)
+                if p < 0:
+                    p = self.pxl_size
+                self.prefix[channel_index] = p
+        return n_new
+        
+    def Prefix(self, channel):
+        """ Number of leading pixels (from index 0) received without a gap """
+        return self.prefix[self.ch_lookup[channel]]
+        
+    def Lines(self, channel, frame_id, width):
+        """ Rows completed since the last call
+        
+        Returns ScanLines object with the rows of the channel, which are complete 
+        (no gap from the image top) and were not returned before, or None.
+        """
+        channel_index = self.ch_lookup[channel]
+        if self.img[channel_index] is None:
+            return None
+        rows = self.prefix[channel_index] // width
+        row_start = self.rows_done[channel_index]
+        if rows <= row_start:
+            return None
+        self.rows_done[channel_index] = rows
+        bytes_pp = self.bytes_pp[channel_index]
+        line_size = width * bytes_pp
+        data = memoryview(self.img[channel_index])[(row_start * line_size):(rows * line_size)]
+        return ScanLines(frame_id, channel, row_start, rows, bytes_pp, data)
+        
+    def IsComplete(self, channel):
+        """ Check if all pixels of the channel were received """
+        channel_index = self.ch_lookup[channel]
+        return self.covered[channel_index] == self.pxl_size
+        
+    def Done(self):
+        """ Check if all channels are complete """
+        return self.n_done == len(self.img)
+        
+    def Arrays(self, width, height):
+        """ Images as numpy arrays
+        
+        Returns list of numpy.ndarray, shape (height, width), dtype uint8 or
+        uint16 (little-endian). The arrays are views of the image buffers, no
+        data is copied.
+        """
+        import numpy
+        
+        l = []
+        for i in range(0, len(self.img)):
+            if self.bytes_pp[i] == 2:
+                dtype = numpy.dtype("<u2")
+            else:
+                dtype = numpy.uint8
+            a = numpy.frombuffer(self.img[i], dtype = dtype, count = width * height)
+            l.append(a.reshape((height, width)))
+        return l
+    
+
+#
+# block of scan lines
+#
+class ScanLines:
+    """Block Of Scan Lines
+    
+    Part of an image, which is complete already. Yielded by 
+    SemConnection.FetchLines() during the acquisition.
+    
+    frame_id    frame id (see ScScanXY)
+    channel     input video channel
+    row_start   first row of the block
+    row_stop    row after the last row of the block
+    bytes_pp    bytes per pixel (1, 2)
+    data        pixel data of the rows, memoryview of the image buffer
+    """
+    
+    def __init__(self, frame_id, channel, row_start, row_stop, bytes_pp, data):
+        """ Constructor """
+        self.frame_id = frame_id
+        self.channel = channel
+        self.row_start = row_start
+        self.row_stop = row_stop
+        self.bytes_pp = bytes_pp
+        self.data = data
+        
 
 #
 # SharkSEM connection
@@ -50,6 +435,12 @@ class SemConnection:
         self.socket_c = 0       # control connection
         self.socket_d = 0       # data connection
         self.wait_flags = 0     # wait flags (bits 5:0)
+        self.next_id = 1        # identification of the next pipelined request
+        self.pool = BufferPool()                # message body buffers
+        self.hdr_c = memoryview(bytearray(32))  # message header, control connection
+        self.hdr_d = memoryview(bytearray(32))  # message header, data connection
+        self.bytes_sent = 0                     # byte counters, both connections
+        self.bytes_received = 0
         
     def _SendStr(self, s):
         """ Blocking send """
@@ -58,16 +449,55 @@ class SemConnection:
         while start < size:
             res = self.socket_c.send(s[start:size])
             start = start + res
+        self.bytes_sent += size
             
-    def _RecvFully(self, sock, size):
-        """ Blocking receive - wait for all data """
+    def _RecvInto(self, sock, view):
+        """ Blocking receive into preallocated buffer - wait for all data 
+        
+        'view' is a writable buffer (memoryview, bytearray), which is filled
+        in place, no intermediate copies are made.
+        """
+        size = len(view)
         received = 0
-        str = b""
         while received < size:
-            s = sock.recv(size - received)
-            received = received + len(s)
-            str = str + s
-        return str
+            n = sock.recv_into(view[received:], size - received)
+            if n == 0:
+                raise ConnectionError("SharkSEM connection closed")
+            received = received + n
+        self.bytes_received += size
+        return view
+        
+    def _RecvFully(self, sock, size):
+        """ Blocking receive - wait for all data """
+        buf = bytearray(size)
+        self._RecvInto(sock, memoryview(buf))
+        return buf
+        
+    def _RecvMsg(self, sock, hdr):
+        """ Blocking receive - single message (header + body)
+        
+        The header is received into 'hdr' (self.hdr_c or self.hdr_d), the body
+        into a buffer taken from self.pool. Returns tuple (fn_name, body, buf), 
+        where 'body' is a memoryview of the message body and 'buf' is the pool 
+        buffer. The buffer must be given back by self.pool.Release(buf) as soon
+        as the body is processed.
+        """
+        self._RecvInto(sock, hdr)
+        fn_name = DecodeString(hdr[0:16])
+        v = struct.unpack_from("<IIHHI", hdr, 16)
+        body_size = v[0]
+        buf = self.pool.Get(body_size)
+        body = memoryview(buf)[0:body_size]
+        self._RecvInto(sock, body)
+        return (fn_name, body, buf)
+        
+    def _RecvMsgC(self):
+        """ Blocking receive - single message, control connection """
+        return self._RecvMsg(self.socket_c, self.hdr_c)
+
+    def _RecvMsgD(self):
+        """ Blocking receive - single message, data connection """
+        return self._RecvMsg(self.socket_d, self.hdr_d)
             
     def _RecvStrC(self, size):
         """ Blocking receive - control connection """
@@ -86,12 +516,14 @@ class SemConnection:
         try:
             self.socket_c = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket_c.connect((address, port))
+            self.socket_c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.socket_d = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket_d.bind(('', 0))
             loc_ep = self.socket_d.getsockname()
             loc_port = loc_ep[1]
             self._TcpRegDataPort(loc_port)
             self.socket_d.connect((address, port + 1))
+            self.socket_d.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             return 0
         
         except:
@@ -102,153 +534,94 @@ class SemConnection:
         """ Close the connection(s) """
         try:
             if self.socket_c != 0:
-                socket.close(self.socket_c)
+                self.socket_c.close()
                 self.socket_c = 0
             if self.socket_d != 0:
-                socket.close(self.socket_d)
+                self.socket_d.close()
                 self.socket_d = 0
         except:
             pass
         
-    def FetchImage(self, fn_name, channel, size):
-        """ Fetch image. See Sem.FetchImage for details """
-        img = b""
-        img_sz = 0
-        while img_sz < size:
-            # receive, parse and verify the message header
-            msg_name = self._RecvStrD(16)
-            hdr = self._RecvStrD(16)
-            v = struct.unpack("<IIHHI", hdr)
-            body_size = v[0]
-            
-            # get fn name
-            s = DecodeString(msg_name)
-            
-            # receive and parse the body
-            body = self._RecvStrD(body_size)
-            if s != fn_name:
-                continue
-            if body_size < 20:
+    def _RecvData(self, fn_name, asm):
+        """ Receive image data packets into the assembler 'asm' till it is complete 
+        
+        Generator, yields (frame_id, channel, n_new) after each packet of the image,
+        n_new is the result of asm.Add().
+        """
+        while not asm.Done():
+            # receive the message, verify the fn name
+            s, body, buf = self._RecvMsgD()
+            body_size = len(body)
+            if s != fn_name or body_size < 20:
+                self.pool.Release(buf)
                 continue
-            body_params = body[0:20]
-            body_data = body[20:]
-            v = struct.unpack("<IIIII", body_params)
+            v = struct.unpack_from("<IIIII", body, 0)
             arg_frame_id = v[0]
             arg_channel = v[1]
             arg_index = v[2]
             arg_bpp = v[3]
             arg_data_size = v[4]
-            if arg_channel != channel:
-                continue
-            if arg_index < img_sz:         # correct, can be sent more than once
-                img = img[0:arg_index]
-                img_sz = arg_index
-            if arg_index > img_sz:         # data packet lost
-                continue
-            
-            # append data
-            if arg_bpp == 8:
-                img = img + body_data[0:arg_data_size]
-                img_sz = img_sz + arg_data_size
-            else:
-                n = arg_data_size / 2
-                for i in range(0, n):
-                    img = img + body_data[2 * i + 1]
-                img_sz = img_sz + n
             
+            # put data in place (copy from the pool buffer)
+            n_new = asm.Add(arg_channel, arg_index, arg_bpp, body[20:(20 + arg_data_size)])
+            self.pool.Release(buf)
+            yield (arg_frame_id, arg_channel, n_new)
+        
+    def _FetchData(self, fn_name, asm):
+        """ Receive image data packets till the assembler 'asm' is complete """
+        for packet in self._RecvData(fn_name, asm):
+            pass
+        return asm
+        
+    def FetchImage(self, fn_name, channel, size, bpp = 8, width = -1, height = -1):
+        """ Fetch image. See Sem.FetchImage for details """
+        asm = self._FetchData(fn_name, ImageAssembler([channel], size))
+        
         # when we have complete image, terminate
+        if width > 0 and height > 0:
+            img = asm.Arrays(width, height)[0]
+            if bpp == 8 and img.itemsize == 2:
+                img = img.view("u1")[:, 1::2]       # high bytes, strided view
+            return img
+        img = asm.img[0]
+        if bpp == 8 and asm.bytes_pp[0] == 2:
+            img = img[1::2]                         # high bytes (little-endian)
         return img
       
-    def FetchImageEx(self, fn_name, channel_list, pxl_size):
+    def FetchImageEx(self, fn_name, channel_list, pxl_size, width = -1, height = -1):
         """ Fetch image. See Sem.FetchImageEx for details """
+        asm = self._FetchData(fn_name, ImageAssembler(channel_list, pxl_size))
         
-        # create channel -> index look up table
-        ch_lookup = []
-        for i in range (0, 4):
-            ch_lookup.append(-1)
-        n_channels = 0
-        for ch in channel_list:
-            ch_lookup[ch] = n_channels
-            n_channels = n_channels + 1 
-        
-        # create empty image
-        img = []
-        img_sz = []
-        img_done = []
-        for i in range(0, n_channels):
-            img.append(b"")
-            img_sz.append(0)
-            img_done.append(False)
-            
-        # process data
-        acq_done = False
-        while not acq_done:
-            # receive, parse and verify the message header
-            msg_name = self._RecvStrD(16)
-            hdr = self._RecvStrD(16)
-            v = struct.unpack("<IIHHI", hdr)
-            body_size = v[0]
-            
-            # get fn name
-            s = DecodeString(msg_name)
-            
-            # receive and parse the body
-            body = self._RecvStrD(body_size)
-            if s != fn_name:
-                continue
-            if body_size < 20:
-                continue
-            body_params = body[0:20]
-            body_data = body[20:]
-            v = struct.unpack("<IIIII", body_params)
-            arg_frame_id = v[0]
-            arg_channel = v[1]
-            arg_index = v[2]
-            arg_bpp = v[3]
-            bytes_pp = arg_bpp / 8  
-            arg_data_size = v[4]
-            channel_index = ch_lookup[arg_channel]
-            if channel_index < 0:                                   # check if we read this image
-                continue
-            if arg_index * bytes_pp < img_sz[channel_index]:        # correct, can be sent more than once
-                img[channel_index] = img[channel_index][0:(arg_index * bytes_pp)]
-                img_sz[channel_index] = arg_index * bytes_pp
-            if arg_index * bytes_pp > img_sz[channel_index]:        # data packet lost
-                continue
-            
-            # append data
-            img[channel_index] = img[channel_index] + body_data[0:arg_data_size]
-            img_sz[channel_index] = img_sz[channel_index] + arg_data_size
-            
-            # eavluate acq_done
-            if img_sz[channel_index] == pxl_size * bytes_pp:
-                img_done[channel_index] = True
-            acq_done = True
-            for i in range(0, n_channels):
-                acq_done = acq_done and img_done[i] 
-            
         # when we have complete image, terminate
-        return img
+        if width > 0 and height > 0:
+            return asm.Arrays(width, height)
+        return asm.img
+
+    def FetchLines(self, fn_name, channel_list, width, height):
+        """ Fetch image line by line. See Sem.FetchLines for details """
+        asm = ImageAssembler(channel_list, width * height)
+        
+        # yield newly completed rows
+        for frame_id, channel, n_new in self._RecvData(fn_name, asm):
+            if n_new <= 0:
+                continue
+            lines = asm.Lines(channel, frame_id, width)
+            if lines is not None:
+                yield lines
+        
+        # complete image(s) as return value of the generator
+        return asm.img
 
     def FetchCameraImage(self, channel):
         """ Fetch camera image. See Sem.FetchCameraImage for details """
         img = b""
         img_received = 0
         while not img_received:
-            # receive, parse and verify the message header
-            msg_name = self._RecvStrD(16)
-            hdr = self._RecvStrD(16)
-            v = struct.unpack("<IIHHI", hdr)
-            body_size = v[0]
-            
-            # get fn name
-            s = DecodeString(msg_name)
-                                        
-            # receive and parse the body
-            body = self._RecvStrD(body_size)
-            if s != 'CameraData':
-                continue
-            if body_size < 20:
+            # receive the message, verify the fn name
+            s, body, buf = self._RecvMsgD()
+            body_size = len(body)
+            if s != 'CameraData' or body_size < 20:
+                self.pool.Release(buf)
                 continue
             body_params = body[0:20]
             body_data = body[20:]
@@ -258,15 +631,15 @@ class SemConnection:
             arg_width = v[2]
             arg_height = v[3]
             arg_data_size = v[4]
-            if arg_channel != channel:
-                continue
-            if arg_bpp != 8:
+            if arg_channel != channel or arg_bpp != 8:
+                self.pool.Release(buf)
                 continue
             
             img_received = 1
             
             # append data
-            arg_img = body_data
+            arg_img = bytes(body_data)
+            self.pool.Release(buf)
             
         # when we have complete image, terminate
         return (arg_width, arg_height, arg_img)
@@ -300,51 +673,38 @@ class SemConnection:
             - Queue = 0
         """
         
-        # build message body
-        body = b""                           	# variable of type 'bytes'
-        for pair in args:
-            pair_type, pair_value = pair
+        msg = EncodeMessage(fn_name, self.wait_flags, *args)
+        
+        try:
+            self._SendStr(msg)                          # send header + body
             
-            if pair_type == ArgType.Int:   				# 32-bit integer
-                body = body + struct.pack("<i", pair_value)
-                
-            if pair_type == ArgType.UnsignedInt:   		# 32-bit unsigned integer
-                body = body + struct.pack("<I", pair_value)
-
-            if pair_type == ArgType.Float:              # floating point
-                s = (str(pair_value) + "\x00\x00\x00\x00").encode()
-                l = (len(s) // 4) * 4
-                body = body + struct.pack("<I", l) + s[0:l]
-        
-            if pair_type == ArgType.String:             # string
-                s = (str(pair_value) + "\x00\x00\x00\x00").encode()
-                l = (len(s) // 4) * 4
-                body = body + struct.pack("<I", l) + s[0:l]
-                
-            if pair_type == ArgType.ArrayByte:          # byte array
-                s = str(pair_value) + "\x00\x00\x00\x00"
-                l = (len(s) // 4) * 4
-                body = body + struct.pack("<I", l) + s[0:l]
-
-            if pair_type == ArgType.ArrayInt:   		# array of 32-bit integers
-                items = len(pair_value)
-                body = body + struct.pack("<I%di" % (items), items * 4, *pair_value)
-                
-            if pair_type == ArgType.ArrayUnsignedInt:   # array of 32-bit unsigned integers
-                items = len(pair_value)
-                body = body + struct.pack("<I%dI" % (items), items * 4, *pair_value)
-
-        # build message header
-        s = fn_name.ljust(16, "\x00")                   # pad fn name (string)
-        hdr = s.encode()                                # convert to bytes
-        hdr = hdr + struct.pack("<IIHHI", len(body), 0, (self.wait_flags << 8), 0, 0)       # arguments
+        except:
+            pass
+            
+    def SendCodec(self, codec, *values):
+        """ Send simple message using precompiled encoder (see GetCodec) 
         
+        Values are plain Python values in the order of codec.arg_types.
+        """
         try:
-            self._SendStr(hdr)                          # send header
-            self._SendStr(body)                         # send body
+            self._SendStr(codec.Encode(self.wait_flags, values))
             
         except:
             pass
+            
+    def _RecvResponse(self, retval):
+        """ Receive response and parse output arguments, see Recv """
+        try:
+            # receive header and body
+            fn_recv, body, buf = self._RecvMsgC()
+            
+        except:
+            return
+
+        # parse return value
+        l = DecodeValues(body, retval)
+        self.pool.Release(buf)
+        return l
     
     def Recv(self, fn_name, retval, *args):
         """ Send message and receive response
@@ -369,82 +729,18 @@ class SemConnection:
         
         # send request
         self.Send(fn_name, *args)
+        return self._RecvResponse(retval)
         
-        try:
-            # receive header
-            fn_recv = self._RecvStrC(16)
-            hdr = self._RecvStrC(16)
-            
-            # parse header
-            v = struct.unpack("<IIHHI", hdr)
-            body_size = v[0]
-            
-            # receive body
-            body = self._RecvStrC(body_size)
-            
-        except:
-            return
-
-        # parse return value
-        l = []
-        start = 0
+    def RecvCodec(self, codec, retval, *values, index = -1):
+        """ Send message using precompiled encoder and receive response
         
-        for t in retval:
-                        
-            if t == ArgType.Int:   				# 32-bit integer
-                stop = start + 4
-                v = struct.unpack("<i", body[start:stop])
-                l.append(v[0])
-                start = stop
-                
-            if t == ArgType.UnsignedInt:   		# 32-bit unsigned integer
-                stop = start + 4
-                v = struct.unpack("<I", body[start:stop])
-                l.append(v[0])
-                start = stop
-
-            if t == ArgType.Float:              # floating point
-                stop = start + 4
-                v = struct.unpack("<I", body[start:stop])
-                fl_size = v[0]
-                start = stop
-                stop = start + fl_size
-                s = DecodeString(body[start:stop])
-                l.append(float(s))
-                start = (start + fl_size + 3) // 4 * 4
-                
-            if t == ArgType.String:             # string
-                stop = start + 4
-                v = struct.unpack("<I", body[start:stop])
-                fl_size = v[0]
-                start = stop
-                stop = start + fl_size
-                s = DecodeString(body[start:stop])
-                l.append(s)
-                start = (start + fl_size + 3) // 4 * 4
-
-            if (t == ArgType.ArrayInt or t == ArgType.ArrayUnsignedInt):           # int array, unsigned int array
-                stop = start + 4
-                v = struct.unpack("<I", body[start:stop])
-                cnt = v[0] // 4
-                start = stop
-                stop = start + 4 * cnt
-                if t == ArgType.ArrayInt:
-                    arr_l = struct.unpack("<%di" % (cnt), body[start:stop])
-                else:
-                    arr_l = struct.unpack("<%dI" % (cnt), body[start:stop])
-                l.append(arr_l)
-                start = stop
-
-            if t == ArgType.ArrayByte:          # byte array
-                stop = start + 4
-                v = struct.unpack("<I", body[start:stop])
-                fl_size = v[0]
-                start = stop
-                stop = start + fl_size
-                l.append(body[start:stop])
-                start = (start + fl_size + 3) // 4 * 4
-
+        See SendCodec and Recv. If index >= 0, only the item 'index' of the
+        output list is returned.
+        """
+        self.SendCodec(codec, *values)
+        l = self._RecvResponse(retval)
+        if index >= 0:
+            return l[index]
         return l
                 
     def RecvInt(self, fn_name, *args):
@@ -466,3 +762,136 @@ class SemConnection:
         """ Simple variant of Recv() - single string value is expected """
         v = self.Recv(fn_name, (ArgType.String,), *args)
         return v[0]
+
+
+#
+# pipelined requests
+#
+class Reply:
+    """Pending Response
+    
+    Returned by RequestBatch.Recv() and its variants. The 'value' is filled 
+    in by RequestBatch.Execute(), it is None till then. If the response was
+    not received or could not be decoded, 'error' is the exception.
+    """
+    
+    def __init__(self, fn_name, retval, index):
+        """ Constructor """
+        self.fn_name = fn_name
+        self.retval = retval    # output argument types
+        self.index = index      # index of the returned item, -1 = whole list
+        self.value = None
+        self.error = None
+        
+
+class RequestBatch:
+    """Pipelined Requests
+    
+    Collects requests, which are then sent back-to-back by Execute() on the
+    control connection of 'conn' (SemConnection). Each request which expects 
+    a response gets a distinct identification, the responses are matched by
+    it. So a batch of N read-outs costs a single round trip instead of N.
+    
+    It has the same Send / Recv interface as SemConnection, so it can be used
+    as 'connection' of the Sem class (see Sem.Batch). Recv() and its variants
+    return Reply objects instead of values.
+    """
+    
+    def __init__(self, conn):
+        """ Constructor """
+        self.conn = conn
+        self.wait_flags = conn.wait_flags
+        self.messages = []      # encoded requests
+        self.replies = {}       # identification -> Reply
+        self.order = []         # replies in the order of requests
+        
+    def Send(self, fn_name, *args):
+        """ Queue simple message, no response expected """
+        self.messages.append(EncodeMessage(fn_name, self.wait_flags, *args))
+        
+    def SendCodec(self, codec, *values):
+        """ Queue simple message using precompiled encoder, no response expected """
+        self.messages.append(codec.Encode(self.wait_flags, values))
+        
+    def _Queue(self, fn_name, retval, index, encode):
+        """ Queue message with response, encode(ident) builds the message """
+        ident = self.conn.next_id
+        self.conn.next_id = (self.conn.next_id % 0xFFFFFFFF) + 1       # never 0
+        self.messages.append(encode(ident))
+        r = Reply(fn_name, retval, index)
+        self.replies[ident] = r
+        self.order.append(r)
+        return r
+        
+    def Recv(self, fn_name, retval, *args, index = -1):
+        """ Queue message with response, returns Reply """
+        return self._Queue(fn_name, retval, index,
+                    lambda ident: EncodeMessage(fn_name, self.wait_flags, *args, ident = ident))
+        
+    def RecvCodec(self, codec, retval, *values, index = -1):
+        """ Queue message with response using precompiled encoder, returns Reply """
+        return self._Queue(codec.fn_name, retval, index,
+                    lambda ident: codec.Encode(self.wait_flags, values, ident))
+        
+    def RecvInt(self, fn_name, *args):
+        """ Simple variant of Recv() - single int value is expected """
+        return self.Recv(fn_name, (ArgType.Int,), *args, index = 0)
+
+    def RecvUInt(self, fn_name, *args):
+        """ Simple variant of Recv() - single unsigned int value is expected """
+        return self.Recv(fn_name, (ArgType.UnsignedInt,), *args, index = 0)
+
+    def RecvFloat(self, fn_name, *args):
+        """ Simple variant of Recv() - single float value is expected """
+        return self.Recv(fn_name, (ArgType.Float,), *args, index = 0)
+
+    def RecvString(self, fn_name, *args):
+        """ Simple variant of Recv() - single string value is expected """
+        return self.Recv(fn_name, (ArgType.String,), *args, index = 0)
+        
+    def Execute(self):
+        """ Send all queued requests, receive and match the responses
+        
+        Returns list of values of the Recv() requests, in the order of requests.
+        The batch is empty afterwards and can be reused.
+        
+        A response which cannot be decoded is recorded in its Reply ('error'),
+        the remaining responses are still received, then the first error is
+        raised. Connection errors are raised immediately, the pending replies
+        get the error too.
+        """
+        messages = self.messages
+        replies = self.replies
+        order = self.order
+        self.messages = []
+        self.replies = {}
+        self.order = []
+        
+        try:
+            self.conn._SendStr(b"".join(messages))      # all requests at once
+            n_pending = len(replies)
+            while n_pending > 0:
+                fn_recv, body, buf = self.conn._RecvMsgC()
+                v = struct.unpack_from("<I", self.conn.hdr_c, 20)
+                r = replies.pop(v[0], None)
+                if r is not None:
+                    try:
+                        l = DecodeValues(body, r.retval)
+                        if r.index >= 0:
+                            r.value = l[r.index]
+                        else:
+                            r.value = l
+                    except (struct.error, ValueError, IndexError) as e:
+                        r.error = e
+                    n_pending = n_pending - 1
+                self.conn.pool.Release(buf)
+                
+        except OSError as e:
+            for r in replies.values():
+                r.error = e
+            raise
+        
+        for r in order:
+            if r.error is not None:
+                raise r.error
+        return [r.value for r in order]
@@ -0,0 +1,591 @@
+#
+# SharkSEM simulator
+#
+# Local stand-in for the SharkSEM server, for offline testing and benchmarking
+# of SemConnection / Sem / SemControl without a microscope.
+#
+# Usage: python sem_sim.py [port]
+#
+
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+
+from sem_conn import ArgType, DecodeString, GetCodec, wtflgA, wtflgB, wtflgC, wtflgD
+
+_Int = ArgType.Int
+_Unsigned = ArgType.UnsignedInt
+_Float = ArgType.Float
+_String = ArgType.String
+
+# argument types of the simulated functions, trailing arguments may be omitted
+_ARGS = {
+    'TcpRegDataPort': (_Int,),
+    'TcpGetVersion': (),
+    'TcpGetDevice': (),
+    'DtEnumDetectors': (),
+    'DtGetChannels': (),
+    'DtSelect': (_Int, _Int),
+    'DtGetSelected': (_Int,),
+    'DtEnable': (_Int, _Int, _Int),
+    'DtGetEnabled': (_Int,),
+    'DtAutoSignal': (_Int,),
+    'VacGetStatus': (),
+    'HVGetVoltage': (),
+    'HVSetVoltage': (_Float, _Int),
+    'HVBeamOn': (),
+    'HVBeamOff': (),
+    'HVGetBeam': (),
+    'HVGetEmission': (),
+    'GetPCIndex': (),
+    'SetPCIndex': (_Int,),
+    'GetPCContinual': (),
+    'SetPCContinual': (_Float,),
+    'GetWD': (),
+    'SetWD': (_Float,),
+    'AutoWD': (_Int, _Float, _Float),
+    'GetViewField': (),
+    'SetViewField': (_Float,),
+    'GetImageShift': (),
+    'SetImageShift': (_Float, _Float),
+    'EnumGeometries': (),
+    'GetGeometry': (_Int,),
+    'SetGeometry': (_Int, _Float, _Float),
+    'EnumCenterings': (),
+    'GetCentering': (_Int,),
+    'SetCentering': (_Int, _Float, _Float),
+    'StgGetPosition': (),
+    'StgMoveTo': (_Float, _Float, _Float, _Float, _Float),
+    'StgIsBusy': (),
+    'StgIsCalibrated': (),
+    'StgStop': (),
+    'ScGetSpeed': (),
+    'ScSetSpeed': (_Int,),
+    'ScGetExternal': (),
+    'ScSetExternal': (_Int,),
+    'ScScanXY': (_Unsigned,) * 7 + (_Int, _Unsigned),
+    'ScScanLine': (_Int,) * 10,
+    'ScStopScan': (),
+    'ScSetBeamPos': (_Float, _Float),
+    'GUIGetScanning': (),
+    'GUISetScanning': (_Int,),
+    'IsBusy': (_Unsigned,),
+    'Delay': (_Int,),
+}
+
+_HDR = struct.Struct("<16sIIHHI")
+_DATA = struct.Struct("<IIIII")
+
+# parse request arguments, stops at the end of the body (optional trailing arguments)
+def _parse_args(body, types):
+    args = []
+    start = 0
+    for t in types:
+        if start + 4 > len(body):
+            break
+        if t == _Int:
+            args.append(struct.unpack_from("<i", body, start)[0])
+            start += 4
+        elif t == _Unsigned:
+            args.append(struct.unpack_from("<I", body, start)[0])
+            start += 4
+        else:
+            size = struct.unpack_from("<I", body, start)[0]
+            s = DecodeString(body[(start + 4):(start + 4 + size)])
+            args.append(float(s) if t == _Float else s)
+            start = (start + 4 + size + 3) // 4 * 4
+    return args
+
+
+class SemSimulator:
+    """ SharkSEM server simulator
+
+    Speaks the SharkSEM protocol on two TCP ports: control (port) and data (port + 1).
+    Supports the functions listed in _ARGS: image scanning (ScScanXY, ScScanLine streaming
+    ScData packets), stage moves with simulated travel time, WD / view field, detectors,
+    HV, wait flags A-D, IsBusy and Delay. Only the functions whose handler returns a value
+    are answered, as by the SEM. Functions not listed in _ARGS are dropped with a message on
+    stderr: it is not known whether the client expects a response, and an unexpected one
+    would shift all the following responses.
+
+    Options:
+        latency         delay (s) before each response on the control connection
+        packet_size     max. ScData payload (bytes)
+        resend_prob     probability that a packet is sent twice
+        reorder_prob    probability that a packet is held back and sent at the end of the
+                        frame (out of order, like a packet resent by the SEM)
+        loss_prob       probability that a packet is dropped (never sent), the frame is then
+                        not complete: the client must time out (e.g. socket_d.settimeout)
+        time_scale      scale of all simulated durations (scanning, stage, auto procedures),
+                        0 = no waiting
+        stage_speed     stage travel speed (mm/s)
+        stage_settle    stage settling time (s) after each move
+        auto_time       duration (s) of AutoWD / DtAutoSignal
+    """
+
+    def __init__(self, address = '127.0.0.1', port = 8300, latency = 0.0, packet_size = 65536,
+                 resend_prob = 0.0, reorder_prob = 0.0, loss_prob = 0.0, time_scale = 1.0, stage_speed = 5.0,
+                 stage_settle = 0.2, auto_time = 2.0, seed = 0):
+        self.address = address
+        self.port = port
+        self.latency = latency
+        self.packet_size = packet_size
+        self.resend_prob = resend_prob
+        self.reorder_prob = reorder_prob
+        self.loss_prob = loss_prob
+        self.time_scale = time_scale
+        self.stage_speed = stage_speed
+        self.stage_settle = stage_settle
+        self.auto_time = auto_time
+        self.random = random.Random(seed)
+
+        # microscope state
+        self.detectors = ['SE', 'BSE']
+        self.selected = {0: 0, 1: 1}        # channel -> detector
+        self.enabled = {0: 8}               # channel -> bpp
+        self.voltage = 15000.0
+        self.beam_on = 0
+        self.pc_index = 10
+        self.wd = 10.0
+        self.view_field = 0.4
+        self.image_shift = [0.0, 0.0]
+        self.geometries = {'Image Shift': [0.0, 0.0], 'Stigmator': [0.0, 0.0]}
+        self.centerings = {'Gun Tilt': [0.0, 0.0]}
+        self.scan_speed = 2
+        self.external = 0
+        self.gui_scanning = 0
+        self.stage_from = [0.0, 0.0, 0.0, 0.0, 0.0]
+        self.stage_to = [0.0, 0.0, 0.0, 0.0, 0.0]
+        self.stage_start = 0.0
+        self.stage_until = 0.0      # stage busy till (time.time)
+        self.optics_until = 0.0     # optics busy till (Delay, WD change)
+        self.auto_until = 0.0       # automatic procedure busy till
+        self.n_requests = 0
+        self.n_packets = 0
+        self.n_lost = 0
+
+        self.sock_d = None
+        self.data_ready = threading.Event()
+        self.scan_thread = None
+        self.scan_stop = threading.Event()
+        self.running = False
+        self.threads = []
+        self.pattern = {}
+
+    # bind both ports and start serving in background threads
+    def start(self):
+        self.listen_c, self.listen_d = self._bind(self.port)
+        self.port = self.listen_c.getsockname()[1]
+        self.running = True
+        for target in (self._serve_control, self._serve_data):
+            t = threading.Thread(target = target, daemon = True)
+            t.start()
+            self.threads.append(t)
+        return self.port
+
+    def _bind(self, port):
+        for attempt in range(100):
+            listen_c = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listen_c.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listen_c.bind((self.address, port))
+            p = listen_c.getsockname()[1]
+            listen_d = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listen_d.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                listen_d.bind((self.address, p + 1))
+            except OSError:
+                listen_c.close()
+                listen_d.close()
+                if port != 0:
+                    raise
+                continue
+            listen_c.listen(1)
+            listen_d.listen(1)
+            return (listen_c, listen_d)
+        raise OSError("No free port pair for the simulator")
+
+    def stop(self):
+        self.running = False
+        self._stop_scan()
+        for s in (self.listen_c, self.listen_d, self.sock_d):
+            try:
+                if s is not None:
+                    s.close()
+            except OSError:
+                pass
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def _serve_data(self):
+        while self.running:
+            try:
+                sock, addr = self.listen_d.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock_d = sock
+            self.data_ready.set()
+
+    def _serve_control(self):
+        while self.running:
+            try:
+                sock, addr = self.listen_c.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                self._handle(sock)
+            except (OSError, ConnectionError):
+                pass
+            finally:
+                self._stop_scan()
+                sock.close()
+
+    def _recv(self, sock, size):
+        buf = bytearray(size)
+        view = memoryview(buf)
+        received = 0
+        while received < size:
+            n = sock.recv_into(view[received:], size - received)
+            if n == 0:
+                raise ConnectionError("client disconnected")
+            received += n
+        return buf
+
+    # request loop of one client
+    def _handle(self, sock):
+        while self.running:
+            hdr = self._recv(sock, 32)
+            name, body_size, ident, flags, queue, resvd = _HDR.unpack(hdr)
+            fn_name = DecodeString(name)
+            body = self._recv(sock, body_size)
+            self.n_requests += 1
+
+            self._wait(flags >> 8)
+            types = _ARGS.get(fn_name)
+            handler = getattr(self, 'cmd_' + fn_name, None)
+            if types is None or handler is None:
+                print("sem_sim: unknown function '{}' dropped".format(fn_name), file = sys.stderr)
+                continue
+            result = handler(*_parse_args(body, types))
+            if result is None and not (flags & 1):
+                continue
+            if result is None:
+                result = []
+
+            # response
+            self._sleep(self.latency)
+            codec = GetCodec(fn_name, tuple([t for t, v in result]))
+            msg = bytearray(codec.Encode(0, [v for t, v in result]))
+            struct.pack_into("<I", msg, 20, ident)          # identification copied from request
+            sock.sendall(msg)
+
+    # block until the subsystems given by wait flags are idle
+    def _wait(self, wait_flags):
+        while True:
+            busy = self._busy(wait_flags)
+            if not busy:
+                return
+            time.sleep(0.001)
+
+    def _busy(self, flags):
+        now = time.time()
+        busy = 0
+        if flags & wtflgA and self.scan_thread is not None and self.scan_thread.is_alive():
+            busy |= wtflgA
+        if flags & wtflgB and now < self.stage_until:
+            busy |= wtflgB
+        if flags & wtflgC and now < self.optics_until:
+            busy |= wtflgC
+        if flags & wtflgD and now < self.auto_until:
+            busy |= wtflgD
+        return busy
+
+################################################################################
+#
+# scanning
+#
+
+    # periodic test pattern, packet data are slices of it (no per-frame allocation)
+    def _pattern(self, channel, bytes_pp):
+        key = (channel, bytes_pp)
+        if key not in self.pattern:
+            period = 4093 * bytes_pp
+            p = bytes(((i * 7 + channel * 64) & 0xFF) for i in range(period))
+            self.pattern[key] = (period, p * (self.packet_size // period + 2))
+        return self.pattern[key]
+
+    def _start_scan(self, target, *args):
+        self._stop_scan()
+        self.scan_stop.clear()
+        self.scan_thread = threading.Thread(target = target, args = args, daemon = True)
+        self.scan_thread.start()
+
+    def _stop_scan(self):
+        self.scan_stop.set()
+        if self.scan_thread is not None and self.scan_thread is not threading.current_thread():
+            self.scan_thread.join()
+        self.scan_thread = None
+
+    # stream n_pixels of each enabled channel as ScData packets
+    def _stream(self, frameid, n_pixels, dwell_ns, single):
+        self.data_ready.wait(5)
+        channels = sorted(self.enabled.items())
+        max_bytes_pp = max([bpp // 8 for channel, bpp in channels] + [1])
+        step = max(1, self.packet_size // max_bytes_pp)     # pixels per packet
+        while not self.scan_stop.is_set():
+            held = []
+            for start in range(0, n_pixels, step):
+                count = min(step, n_pixels - start)
+                for channel, bpp in channels:
+                    if self.scan_stop.is_set():
+                        return
+                    packet = self._packet(frameid, channel, start, bpp, count)
+                    if self.random.random() < self.loss_prob:
+                        self.n_lost += 1
+                        continue
+                    if self.random.random() < self.reorder_prob:
+                        held.append(packet)
+                        continue
+                    self._send_data(packet)
+                    if self.random.random() < self.resend_prob:
+                        self._send_data(packet)
+                self._sleep(self.time_scale * dwell_ns * 1e-9 * count)
+            for packet in held:
+                self._send_data(packet)
+            if single:
+                return
+
+    def _packet(self, frameid, channel, index, bpp, count):
+        bytes_pp = bpp // 8
+        period, p = self._pattern(channel, bytes_pp)
+        offset = (index * bytes_pp) % period
+        size = count * bytes_pp
+        pad = (-size) % 4
+        return (_HDR.pack(b'ScData', 20 + size + pad, 0, 0, 0, 0)
+                + _DATA.pack(frameid, channel, index, bpp, size)
+                + p[offset:(offset + size)] + b'\x00' * pad)
+
+    def _send_data(self, packet):
+        try:
+            self.sock_d.sendall(packet)
+            self.n_packets += 1
+        except (OSError, AttributeError):
+            self.scan_stop.set()
+
+################################################################################
+#
+# SharkSEM functions, return list of (type, value) for the response or None
+#
+
+    def cmd_TcpRegDataPort(self, port):
+        self.data_ready.clear()
+        return [(_Int, 0)]
+
+    def cmd_TcpGetVersion(self):
+        return [(_String, 'SharkSEM simulator')]
+
+    def cmd_TcpGetDevice(self):
+        return [(_String, 'Simulator')]
+
+    def cmd_DtEnumDetectors(self):
+        s = ''
+        for i, name in enumerate(self.detectors):
+            s += 'det.{}.name={}\ndet.{}.detector={}\n'.format(i, name, i, i)
+        return [(_String, s)]
+
+    def cmd_DtGetChannels(self):
+        return [(_Int, 4)]
+
+    def cmd_DtSelect(self, channel, detector):
+        self.selected[channel] = detector
+
+    def cmd_DtGetSelected(self, channel):
+        return [(_Int, self.selected.get(channel, -1))]
+
+    def cmd_DtEnable(self, channel, enable, bpp = 8):
+        if enable:
+            self.enabled[channel] = bpp
+        else:
+            self.enabled.pop(channel, None)
+
+    def cmd_DtGetEnabled(self, channel):
+        return [(_Int, int(channel in self.enabled)), (_Int, self.enabled.get(channel, 8))]
+
+    def cmd_DtAutoSignal(self, channel):
+        self.auto_until = time.time() + self.time_scale * self.auto_time
+
+    def cmd_VacGetStatus(self):
+        return [(_Int, 0)]
+
+    def cmd_HVGetVoltage(self):
+        return [(_Float, self.voltage)]
+
+    def cmd_HVSetVoltage(self, voltage, p_async = 0):
+        self.voltage = voltage
+
+    def cmd_HVBeamOn(self):
+        self.beam_on = 1
+
+    def cmd_HVBeamOff(self):
+        self.beam_on = 0
+
+    def cmd_HVGetBeam(self):
+        return [(_Int, self.beam_on)]
+
+    def cmd_HVGetEmission(self):
+        return [(_Float, 1e-4 * self.beam_on)]
+
+    def cmd_GetPCIndex(self):
+        return [(_Int, self.pc_index)]
+
+    def cmd_SetPCIndex(self, index):
+        self.pc_index = index
+
+    def cmd_GetPCContinual(self):
+        return [(_Float, float(self.pc_index))]
+
+    def cmd_SetPCContinual(self, pc):
+        self.pc_index = int(round(pc))
+
+    def cmd_GetWD(self):
+        return [(_Float, self.wd)]
+
+    def cmd_SetWD(self, wd):
+        self.wd = wd
+        self.optics_until = time.time() + self.time_scale * 0.05
+
+    def cmd_AutoWD(self, channel, wd_min = None, wd_max = None):
+        self.auto_until = time.time() + self.time_scale * self.auto_time
+
+    def cmd_GetViewField(self):
+        return [(_Float, self.view_field)]
+
+    def cmd_SetViewField(self, vf):
+        self.view_field = vf
+
+    def cmd_GetImageShift(self):
+        return [(_Float, self.image_shift[0]), (_Float, self.image_shift[1])]
+
+    def cmd_SetImageShift(self, x, y):
+        self.image_shift = [x, y]
+
+    def cmd_EnumGeometries(self):
+        s = ''
+        for i, name in enumerate(self.geometries):
+            s += 'geom.{}.name={}\n'.format(i, name)
+        return [(_String, s)]
+
+    def cmd_GetGeometry(self, index):
+        v = list(self.geometries.values())[index]
+        return [(_Float, v[0]), (_Float, v[1])]
+
+    def cmd_SetGeometry(self, index, x, y):
+        list(self.geometries.values())[index][:] = [x, y]
+
+    def cmd_EnumCenterings(self):
+        s = ''
+        for i, name in enumerate(self.centerings):
+            s += 'cent.{}.name={}\n'.format(i, name)
+        return [(_String, s)]
+
+    def cmd_GetCentering(self, index):
+        v = list(self.centerings.values())[index]
+        return [(_Float, v[0]), (_Float, v[1])]
+
+    def cmd_SetCentering(self, index, x, y):
+        list(self.centerings.values())[index][:] = [x, y]
+
+    def cmd_StgGetPosition(self):
+        now = time.time()
+        if now >= self.stage_until or self.stage_until <= self.stage_start:
+            pos = self.stage_to
+        else:
+            f = (now - self.stage_start) / (self.stage_until - self.stage_start)
+            pos = [a + (b - a) * f for a, b in zip(self.stage_from, self.stage_to)]
+        return [(_Float, p) for p in pos]
+
+    def cmd_StgMoveTo(self, *pos):
+        now = time.time()
+        current = [v for t, v in self.cmd_StgGetPosition()]
+        target = list(pos) + current[len(pos):]
+        distance = max(abs(target[0] - current[0]), abs(target[1] - current[1]))
+        self.stage_from = current
+        self.stage_to = target
+        self.stage_start = now
+        self.stage_until = now + self.time_scale * (distance / self.stage_speed + self.stage_settle)
+
+    def cmd_StgIsBusy(self):
+        return [(_Int, int(time.time() < self.stage_until))]
+
+    def cmd_StgIsCalibrated(self):
+        return [(_Int, 1)]
+
+    def cmd_StgStop(self):
+        self.stage_to = [v for t, v in self.cmd_StgGetPosition()]
+        self.stage_until = time.time()
+
+    def cmd_ScGetSpeed(self):
+        return [(_Int, self.scan_speed)]
+
+    def cmd_ScSetSpeed(self, speed):
+        self.scan_speed = speed
+
+    def cmd_ScGetExternal(self):
+        return [(_Int, self.external)]
+
+    def cmd_ScSetExternal(self, enable):
+        self.external = enable
+
+    def cmd_ScScanXY(self, frameid, width, height, left, top, right, bottom, single, dwell = 1000):
+        if right < left or bottom < top or right >= width or bottom >= height:
+            return [(_Int, -1)]
+        n_pixels = (right - left + 1) * (bottom - top + 1)
+        self._start_scan(self._stream, frameid, n_pixels, dwell, single)
+        return [(_Int, 0)]
+
+    def cmd_ScScanLine(self, frameid, width, height, x0, y0, x1, y1, dwell, pixel_count, single):
+        if pixel_count <= 0:
+            return [(_Int, -1)]
+        self._start_scan(self._stream, frameid, pixel_count, dwell, single)
+        return [(_Int, 0)]
+
+    def cmd_ScStopScan(self):
+        self._stop_scan()
+
+    def cmd_ScSetBeamPos(self, x, y):
+        pass
+
+    def cmd_GUIGetScanning(self):
+        return [(_Int, self.gui_scanning)]
+
+    def cmd_GUISetScanning(self, enable):
+        self.gui_scanning = enable
+
+    def cmd_IsBusy(self, flags):
+        return [(_Int, self._busy(flags))]
+
+    def cmd_Delay(self, delay):
+        self.optics_until = time.time() + self.time_scale * delay * 1e-3
+
+
+def main():
+    port = 8300
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    sim = SemSimulator(port = port)
+    sim.start()
+    print("SharkSEM simulator at {}:{} (data {})".format(sim.address, sim.port, sim.port + 1))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import json
+import struct
+import threading
+import time
+
+from sem_conn import DecodeString
+
+
+class Span:
+    """ Timing span, use as context manager (see Tracer.span). Set 'bytes' inside the block if known """
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.bytes = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        self.tracer.record(self.name, self.args, self.bytes, self.start, duration, exc_type is not None)
+        return False
+
+
+class Tracer:
+    """ Timing trace of the tile loop and of the SharkSEM calls
+
+    Each span is written as one JSON line to 'fp' (if given):
+        {"name": ..., "args": {...}, "bytes": ..., "t": start (s, from tracer start),
+         "dur": duration (s), "thread": ..., "error": true/false}
+    Per-name totals are kept for summary(). Spans can be recorded from several threads.
+    SharkSEM call spans (TracedConnection) are named by the function, so other spans
+    should use names that cannot clash, e.g. 'stage.autowd'.
+    """
+
+    def __init__(self, fp = None):
+        self.lock = threading.Lock()
+        self.t0 = time.perf_counter()
+        self.file = open(fp, 'w') if fp else None
+        self.stats = {}     # name -> [count, total (s), max (s), bytes]
+
+    def span(self, name, **args):
+        return Span(self, name, args)
+
+    def record(self, name, args, nbytes, start, duration, error = False):
+        with self.lock:
+            st = self.stats.get(name)
+            if st is None:
+                st = self.stats[name] = [0, 0.0, 0.0, 0]
+            st[0] += 1
+            st[1] += duration
+            st[2] = max(st[2], duration)
+            st[3] += nbytes
+            if self.file is not None:
+                self.file.write(json.dumps({
+                    'name': name,
+                    'args': args,
+                    'bytes': nbytes,
+                    't': round(start - self.t0, 6),
+                    'dur': round(duration, 6),
+                    'thread': threading.current_thread().name,
+                    'error': error,
+                }, default = str) + '\n')
+
+    # table of per-name count, total, mean, max time and bytes, sorted by total time
+    def summary(self):
+        with self.lock:
+            items = sorted(self.stats.items(), key = lambda item: -item[1][1])
+        wall = time.perf_counter() - self.t0
+        lines = ['{:<24} {:>8} {:>11} {:>10} {:>10} {:>12}'.format('name', 'count', 'total (s)', 'mean (ms)', 'max (ms)', 'MB')]
+        for name, (count, total, longest, nbytes) in items:
+            lines.append('{:<24} {:>8} {:>11.3f} {:>10.2f} {:>10.2f} {:>12.2f}'.format(
+                name, count, total, total / count * 1e3, longest * 1e3, nbytes / 1e6))
+        lines.append('wall time {:.3f} s'.format(wall))
+        return '\n'.join(lines)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class TracedConnection:
+    """ Wrapper of SemConnection, which records a span for every SharkSEM call
+
+    Span name is the SharkSEM function name, args are the argument values, bytes are the
+    bytes sent + received during the call. Other attributes are passed to the connection.
+    A pipelined batch (sem_conn.RequestBatch, Sem.Batch) is recorded as one span 'Batch',
+    from sending the requests to the last response, args are the function names.
+    """
+
+    def __init__(self, conn, tracer):
+        object.__setattr__(self, 'conn', conn)
+        object.__setattr__(self, 'tracer', tracer)
+        object.__setattr__(self, 'batch', None)     # [names, responses pending, start, bytes at start]
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.conn, name, value)
+
+    def _traced(self, fn_name, args, fn, *a, **kw):
+        conn = self.conn
+        b0 = conn.bytes_sent + conn.bytes_received
+        with self.tracer.span(fn_name, args = args, wait_flags = conn.wait_flags) as s:
+            try:
+                return fn(*a, **kw)
+            finally:
+                s.bytes = conn.bytes_sent + conn.bytes_received - b0
+
+    def Send(self, fn_name, *args):
+        return self._traced(fn_name, [v for t, v in args], self.conn.Send, fn_name, *args)
+
+    def SendCodec(self, codec, *values):
+        return self._traced(codec.fn_name, list(values), self.conn.SendCodec, codec, *values)
+
+    def Recv(self, fn_name, retval, *args):
+        return self._traced(fn_name, [v for t, v in args], self.conn.Recv, fn_name, retval, *args)
+
+    def RecvCodec(self, codec, retval, *values, index = -1):
+        return self._traced(codec.fn_name, list(values), self.conn.RecvCodec, codec, retval, *values, index = index)
+
+    def RecvInt(self, fn_name, *args):
+        return self._traced(fn_name, [v for t, v in args], self.conn.RecvInt, fn_name, *args)
+
+    def RecvUInt(self, fn_name, *args):
+        return self._traced(fn_name, [v for t, v in args], self.conn.RecvUInt, fn_name, *args)
+
+    def RecvFloat(self, fn_name, *args):
+        return self._traced(fn_name, [v for t, v in args], self.conn.RecvFloat, fn_name, *args)
+
+    def RecvString(self, fn_name, *args):
+        return self._traced(fn_name, [v for t, v in args], self.conn.RecvString, fn_name, *args)
+
+    def FetchImage(self, fn_name, *args):
+        return self._traced('FetchImage', list(args), self.conn.FetchImage, fn_name, *args)
+
+    def FetchImageEx(self, fn_name, *args):
+        return self._traced('FetchImageEx', list(args), self.conn.FetchImageEx, fn_name, *args)
+
+    # generator, the span covers the whole iteration
+    def FetchLines(self, fn_name, channel_list, width, height):
+        conn = self.conn
+        b0 = conn.bytes_sent + conn.bytes_received
+        with self.tracer.span('FetchLines', args = [channel_list, width, height], wait_flags = conn.wait_flags) as s:
+            try:
+                return (yield from conn.FetchLines(fn_name, channel_list, width, height))
+            finally:
+                s.bytes = conn.bytes_sent + conn.bytes_received - b0
+
+    def FetchCameraImage(self, channel):
+        return self._traced('FetchCameraImage', [channel], self.conn.FetchCameraImage, channel)
+
+    # RequestBatch.Execute sends all requests at once by _SendStr, then reads the responses by _RecvMsgC
+    def _SendStr(self, data):
+        conn = self.conn
+        names = []
+        n_pending = 0
+        pos = 0
+        while pos + 32 <= len(data):
+            size, ident = struct.unpack_from("<II", data, pos + 16)
+            names.append(DecodeString(data[pos:(pos + 16)]))
+            if ident != 0:
+                n_pending += 1
+            pos += 32 + size
+        object.__setattr__(self, 'batch', [names, n_pending, time.perf_counter(), conn.bytes_sent + conn.bytes_received])
+        try:
+            conn._SendStr(data)
+        except Exception:
+            self._end_batch(True)
+            raise
+        if n_pending == 0:
+            self._end_batch(False)
+
+    def _RecvMsgC(self):
+        try:
+            msg = self.conn._RecvMsgC()
+        except Exception:
+            self._end_batch(True)
+            raise
+        if self.batch is not None:
+            self.batch[1] -= 1
+            if self.batch[1] <= 0:
+                self._end_batch(False)
+        return msg
+
+    def _end_batch(self, error):
+        batch = self.batch
+        if batch is None:
+            return
+        object.__setattr__(self, 'batch', None)
+        names, n_pending, start, b0 = batch
+        conn = self.conn
+        self.tracer.record('Batch', {'args': names, 'wait_flags': conn.wait_flags},
+                           conn.bytes_sent + conn.bytes_received - b0, start, time.perf_counter() - start, error)
@@ -0,0 +1,80 @@
+import time
+
+
+# poll cond() until it returns true, or till timeout (s, None = no limit)
+# The poll interval starts at 'interval' and grows by 'backoff' up to 'max_interval',
+# so short operations are detected quickly and long ones are not polled too often.
+# Returns True if cond() became true, False on timeout.
+def wait_until(cond, timeout = 10.0, interval = 0.01, max_interval = 0.5, backoff = 1.5):
+    start = time.perf_counter()
+    while True:
+        if cond():
+            return True
+        elapsed = time.perf_counter() - start
+        if timeout is not None:
+            if elapsed >= timeout:
+                return False
+            time.sleep(min(interval, timeout - elapsed))
+        else:
+            time.sleep(interval)
+        interval = min(interval * backoff, max_interval)
+
+
+# wait till the SEM is not busy for 'flags' (wait flag bits, see Sem.IsBusy)
+# IsBusy is sent with no wait flags, so the poll itself is answered immediately.
+def wait_idle(m, flags, timeout = 60.0, interval = 0.01, max_interval = 0.5):
+    saved = m.connection.wait_flags
+    m.SetWaitFlags(0)
+    try:
+        return wait_until(lambda: m.IsBusy(flags) == 0, timeout, interval, max_interval)
+    finally:
+        m.SetWaitFlags(saved)
+
+
+# wait till the SEM is busy for 'flags', e.g. a procedure started from the GUI is running
+def wait_busy(m, flags, timeout = 5.0, interval = 0.01, max_interval = 0.2):
+    saved = m.connection.wait_flags
+    m.SetWaitFlags(0)
+    try:
+        return wait_until(lambda: m.IsBusy(flags) != 0, timeout, interval, max_interval)
+    finally:
+        m.SetWaitFlags(saved)
+
+
+# wait till the stage stops moving
+def wait_stage(m, timeout = 120.0, interval = 0.02, max_interval = 0.5):
+    saved = m.connection.wait_flags
+    m.SetWaitFlags(0)
+    try:
+        return wait_until(lambda: m.StgIsBusy() == 0, timeout, interval, max_interval)
+    finally:
+        m.SetWaitFlags(saved)
+
+
+# wait till live scanning in the SEM GUI is on (enable = 1) or off (enable = 0), see Sem.GUIGetScanning
+def wait_gui_scanning(m, enable, timeout = 5.0, interval = 0.01, max_interval = 0.2):
+    saved = m.connection.wait_flags
+    m.SetWaitFlags(0)
+    try:
+        return wait_until(lambda: (m.GUIGetScanning() != 0) == bool(enable), timeout, interval, max_interval)
+    finally:
+        m.SetWaitFlags(saved)
+
+
+# wait till get() changes from 'initial', then till it keeps the same value for 'hold' seconds,
+# e.g. a setting adjusted by a procedure which IsBusy does not report.
+# Returns True if the value changed and settled within timeout (s, None = no limit).
+def wait_settled(get, initial, hold = 1.0, timeout = 60.0, interval = 0.05, max_interval = 0.5):
+    start = time.perf_counter()
+    if not wait_until(lambda: get() != initial, timeout, interval, max_interval):
+        return False
+    last = [get(), time.perf_counter()]
+    def settled():
+        v = get()
+        now = time.perf_counter()
+        if v != last[0]:
+            last[:] = [v, now]
+        return now - last[1] >= hold
+    if timeout is not None:
+        timeout = max(0, timeout - (time.perf_counter() - start))
+    return wait_until(settled, timeout, interval, min(max_interval, hold))
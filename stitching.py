@@ -0,0 +1,162 @@
+import threading
+
+import numpy as np
+
+
+# sub-pixel peak position from 3 samples around the maximum (parabola vertex offset, -0.5 .. 0.5)
+def _subpixel(m1, m0, p1):
+    d = m1 - 2 * m0 + p1
+    if d >= 0:
+        return 0.0
+    return float(np.clip(0.5 * (m1 - p1) / d, -0.5, 0.5))
+
+
+# shift e = (dy, dx) with a(y, x) ~ b(y - dy, x - dx), by FFT phase correlation of 2 equally sized images
+# Returns (dy, dx, peak), peak is the normalized correlation peak (~1 for a perfect match, ~0 for noise).
+def phase_correlation(a, b):
+    a = np.asarray(a, dtype = np.float32)
+    b = np.asarray(b, dtype = np.float32)
+    win = np.outer(np.hanning(a.shape[0]), np.hanning(a.shape[1])).astype(np.float32)
+    fa = np.fft.rfft2((a - a.mean()) * win)
+    fb = np.fft.rfft2((b - b.mean()) * win)
+    r = fa * np.conj(fb)
+    r /= np.abs(r) + 1e-12
+    c = np.fft.irfft2(r, a.shape)
+    py, px = np.unravel_index(int(np.argmax(c)), c.shape)
+    h, w = c.shape
+    dy = py + _subpixel(c[py - 1, px], c[py, px], c[(py + 1) % h, px])
+    dx = px + _subpixel(c[py, px - 1], c[py, px], c[py, (px + 1) % w])
+    if dy > h / 2:
+        dy -= h
+    if dx > w / 2:
+        dx -= w
+    return (float(dy), float(dx), float(c[py, px]))
+
+
+# overlap regions of tile a (origin 0, 0) and tile b (origin o = (oy, ox) in a's pixels), both of shape 'shape'
+# Returns (slices in a, slices in b), or None if the overlap is smaller than min_size pixels in either direction.
+def overlap_slices(shape, o, min_size = 16):
+    h, w = shape
+    oy, ox = int(round(o[0])), int(round(o[1]))
+    y0, y1 = max(0, oy), min(h, h + oy)
+    x0, x1 = max(0, ox), min(w, w + ox)
+    if y1 - y0 < min_size or x1 - x0 < min_size:
+        return None
+    return ((slice(y0, y1), slice(x0, x1)), (slice(y0 - oy, y1 - oy), slice(x0 - ox, x1 - ox)))
+
+
+# incremental stitching of a tile grid
+#   shape:      tile shape (pxl) at the stitching resolution
+#   min_peak:   pairs with a lower phase correlation peak are not used
+#   max_error:  pairs deviating more than this (pxl) from the nominal offset are not used
+# Tiles are added as they are acquired, with their nominal positions (pxl). The overlap
+# strips a tile shares with its grid neighbours are kept only until the neighbour is
+# added, then the pair offset is measured on the strips and they are dropped, so the
+# memory use does not grow with the grid. solve() places all tiles by least squares.
+# add_tile() may be called from several threads.
+class Stitcher:
+
+    def __init__(self, shape, min_peak = 0.05, max_error = 50.0, prior_weight = 1e-3):
+        self.shape = tuple(shape)
+        self.min_peak = min_peak
+        self.max_error = max_error
+        self.prior_weight = prior_weight
+        self.nominal = {}       # key -> nominal position (y, x)
+        self.strips = {}        # (key, neighbour key) -> overlap strip of tile 'key'
+        self.pairs = {}         # (key a, key b) -> (measured offset of b from a (dy, dx), peak)
+        self.lock = threading.Lock()
+
+    # add tile 'key' (e.g. (iR, iC)) at nominal position pos = (y, x), neighbours = {key: nominal position}
+    # of the tiles it overlaps with (acquired or not). Returns the new pair offsets.
+    def add_tile(self, key, img, pos, neighbours):
+        img = np.asarray(img)
+        pos = np.asarray(pos, dtype = float)
+        work = []
+        with self.lock:
+            self.nominal[key] = pos
+            for nkey, npos in neighbours.items():
+                o = np.asarray(npos, dtype = float) - pos     # neighbour origin in this tile
+                sl = overlap_slices(self.shape, o)
+                if sl is None:
+                    continue
+                strip = img[sl[0]]
+                other = self.strips.pop((nkey, key), None)
+                if other is not None:
+                    work.append((nkey, key, o, strip, other))
+                else:
+                    self.strips[(key, nkey)] = strip.copy()
+
+        found = {}
+        for nkey, _, o, strip, other in work:
+            # strip: this tile's part of the overlap, other: neighbour's part; offset of neighbour from this tile
+            dy, dx, peak = phase_correlation(strip, other)
+            m = (o[0] + dy, o[1] + dx)
+            if peak >= self.min_peak and np.hypot(dy, dx) <= self.max_error:
+                found[(key, nkey)] = (m, peak)
+        with self.lock:
+            self.pairs.update(found)
+        return found
+
+    # tile positions {key: (y, x)} by weighted least squares on the pair offsets
+    # Each tile is also tied weakly to its nominal position (prior_weight), which fixes the
+    # global translation and places tiles without usable pairs at their nominal positions.
+    def solve(self):
+        with self.lock:
+            keys = list(self.nominal)
+            pairs = dict(self.pairs)
+            nominal = dict(self.nominal)
+        index = {k: i for i, k in enumerate(keys)}
+        n = len(keys)
+        rows = len(pairs) + n
+        a = np.zeros((rows, n))
+        b = np.zeros((rows, 2))
+        w = np.zeros(rows)
+        for r, ((ka, kb), (m, peak)) in enumerate(pairs.items()):
+            a[r, index[kb]] = 1
+            a[r, index[ka]] = -1
+            b[r] = m
+            w[r] = peak
+        for i, k in enumerate(keys):
+            r = len(pairs) + i
+            a[r, i] = 1
+            b[r] = nominal[k]
+            w[r] = self.prior_weight
+        sw = np.sqrt(w)[:, None]
+        p = np.linalg.lstsq(a * sw, b * sw, rcond = None)[0]
+        return {k: p[index[k]] for k in keys}
+
+    # rms difference (pxl) between the measured pair offsets and the solved positions
+    def residual(self, positions):
+        if not self.pairs:
+            return 0.0
+        d = [np.subtract(positions[kb] - positions[ka], m) for (ka, kb), (m, peak) in self.pairs.items()]
+        return float(np.sqrt(np.mean(np.square(d))))
+
+
+# blend tiles {key: 2D array} at positions {key: (y, x)} (same pixel scale) into one mosaic,
+# with linear feathering towards the tile edges. Returns (mosaic, origin (y, x) of the mosaic).
+def blend(tiles, positions, dtype = None):
+    keys = [k for k in tiles if k in positions]
+    if not keys:
+        return (np.zeros((0, 0)), (0, 0))
+    pos = {k: np.round(np.asarray(positions[k], dtype = float)).astype(int) for k in keys}
+    y0 = min(pos[k][0] for k in keys)
+    x0 = min(pos[k][1] for k in keys)
+    h = max(pos[k][0] + tiles[k].shape[0] for k in keys) - y0
+    w = max(pos[k][1] + tiles[k].shape[1] for k in keys) - x0
+    acc = np.zeros((h, w), dtype = np.float32)
+    wsum = np.zeros((h, w), dtype = np.float32)
+    for k in keys:
+        t = tiles[k]
+        th, tw = t.shape
+        wy = np.minimum(np.arange(th) + 1, th - np.arange(th)).astype(np.float32)
+        wx = np.minimum(np.arange(tw) + 1, tw - np.arange(tw)).astype(np.float32)
+        wt = np.outer(wy, wx)
+        y, x = pos[k][0] - y0, pos[k][1] - x0
+        acc[y:y + th, x:x + tw] += t * wt
+        wsum[y:y + th, x:x + tw] += wt
+    mosaic = acc / np.maximum(wsum, 1e-12)
+    dtype = dtype or tiles[keys[0]].dtype
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        mosaic = np.rint(mosaic)
+    return (mosaic.astype(dtype), (y0, x0))
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sem
+from sem_sim import SemSimulator
+
+
+# simulator on a free port, no simulated waiting
+@pytest.fixture
+def sim():
+    s = SemSimulator(port = 0, time_scale = 0)
+    s.start()
+    yield s
+    s.stop()
+
+
+# Sem connected to the simulator
+@pytest.fixture
+def m(sim):
+    m = sem.Sem()
+    assert m.Connect('127.0.0.1', sim.port) == 0
+    yield m
+    m.Disconnect()
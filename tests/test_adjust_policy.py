@@ -0,0 +1,68 @@
+import numpy as np
+
+from adjust_policy import AdjustPolicy
+
+
+def frame(offset = 0.0, scale = 1.0, seed = 0):
+    rng = np.random.default_rng(seed)
+    return rng.random((64, 64)) * 100 * scale + offset
+
+
+def test_first_tile_adjusted():
+    p = AdjustPolicy()
+    assert p.need_signal() and p.need_focus()
+
+
+def test_stable_tiles_skipped():
+    p = AdjustPolicy(every_n = 10)
+    p.signal_done(True)
+    p.focus_done(True)
+    for k in range(5):
+        p.observe(frame(seed = k))
+        assert not p.need_signal() and not p.need_focus()
+        p.signal_done(False)
+        p.focus_done(False)
+
+
+def test_every_n():
+    p = AdjustPolicy(every_n = 3)
+    p.observe(frame())
+    p.signal_done(False)
+    p.observe(frame())
+    assert not p.need_signal()
+    p.signal_done(False)
+    p.observe(frame())
+    assert p.need_signal()
+
+
+def test_signal_drift():
+    p = AdjustPolicy(signal_tol = 0.05)
+    p.observe(frame())
+    p.observe(frame(offset = 20))
+    assert p.need_signal()
+
+
+def test_focus_drift():
+    p = AdjustPolicy(sharpness_tol = 0.2)
+    a = frame()
+    p.observe(a)
+    b = (a + np.roll(a, 1, 0) + np.roll(a, 1, 1) + np.roll(a, 1, (0, 1))) / 4
+    p.observe(b)
+    assert p.need_focus()
+
+
+def test_new_reference_after_adjustment():
+    p = AdjustPolicy()
+    p.observe(frame())
+    p.signal_done(True)
+    p.observe(frame(offset = 20))
+    assert not p.signal_drift
+    p.observe(frame(offset = 20, seed = 1))
+    assert not p.need_signal()
+
+
+def test_reset():
+    p = AdjustPolicy()
+    p.observe(frame())
+    p.reset()
+    assert p.ref_signal is None and p.need_signal()
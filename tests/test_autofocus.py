@@ -0,0 +1,47 @@
+import pytest
+
+from autofocus import SoftwareAutofocus, golden_section, parabola_peak, parabolic_search
+
+
+def peak_at(x0):
+    return lambda x: -(x - x0) ** 2
+
+
+def test_parabola_peak():
+    assert parabola_peak((0, 1, 2), (0, 1, 0)) == pytest.approx(1)
+    assert parabola_peak((0, 1, 2), (0, -1, 0)) is None
+    assert parabola_peak((1, 1, 2), (0, 1, 0)) is None
+
+
+@pytest.mark.parametrize('search', [golden_section, parabolic_search])
+def test_search(search):
+    ev = search(peak_at(10.37), 9, 12, 0.002)
+    assert max(ev, key = ev.get) == pytest.approx(10.37, abs = 0.002)
+
+
+def test_golden_section_small_bracket():
+    ev = golden_section(peak_at(1), 1.0, 1.001, 0.002)
+    assert list(ev) == [pytest.approx(1.0005)]
+
+
+# the simulated image does not depend on WD, the score is replaced
+@pytest.mark.parametrize('search', ['golden', 'parabolic'])
+def test_run(m, sim, search):
+    af = SoftwareAutofocus(m, search = search, size = 64, window = 16)
+    af.score = peak_at(10.3)
+    wd = af.run(9.5, 11)
+    assert wd == pytest.approx(10.3, abs = 0.002)
+    assert m.GetWD() == pytest.approx(wd)
+    assert m.connection.wait_flags == 0
+
+
+def test_run_small_range(m, sim):
+    af = SoftwareAutofocus(m, size = 64, window = 16)
+    af.score = peak_at(10)
+    assert af.run(10.0, 10.001) == pytest.approx(10.0005)
+
+
+def test_score(m):
+    m.DtEnable(0, 1, 8)
+    af = SoftwareAutofocus(m, size = 64, window = 16)
+    assert af.score(10.0) > 0
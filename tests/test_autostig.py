@@ -0,0 +1,43 @@
+import pytest
+
+from autostig import ImageAutostig, find_stigmator
+
+
+def test_find_stigmator(m, sim):
+    assert find_stigmator(m) == ('geometry', 1)
+    sim.geometries = {'Image Shift': [0.0, 0.0]}
+    sim.centerings = {'Gun Tilt': [0.0, 0.0], 'Stigmator': [0.0, 0.0]}
+    assert find_stigmator(m) == ('centering', 1)
+    sim.centerings = {}
+    assert find_stigmator(m) is None
+
+
+def test_no_stigmator(m, sim):
+    sim.geometries = {}
+    sim.centerings = {}
+    with pytest.raises(RuntimeError):
+        ImageAutostig(m)
+
+
+# the simulated image does not depend on the stigmator, the score is replaced
+def test_run(m, sim):
+    target = (3.2, -1.7)
+    st = ImageAutostig(m, size = 64, window = 16)
+    st.score = lambda xy: -((xy[0] - target[0]) ** 2 + (xy[1] - target[1]) ** 2)
+    xy = st.run()
+    assert xy == pytest.approx(target, abs = 0.2)
+    assert list(m.GetGeometry(1)) == pytest.approx(xy)
+
+
+def test_run_flat_score(m, sim):
+    sim.geometries['Stigmator'] = [1.0, 2.0]
+    st = ImageAutostig(m, size = 64, window = 16)
+    st.score = lambda xy: 1.0
+    assert st.run() == pytest.approx([1.0, 2.0])
+
+
+def test_score_counts_frames(m):
+    m.DtEnable(0, 1, 8)
+    st = ImageAutostig(m, size = 64, window = 16)
+    st.score([0.0, 0.0])
+    assert st.n_frames == 1
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from beam_scan import plan_beam_path
+
+
+def test_runs_become_lines():
+    x = np.r_[np.arange(10), 20, 30] / 64
+    y = np.full(12, 8 / 64)
+    segments = plan_beam_path(x, y, 1000, 64, 64)
+    assert segments[0] == ('line', 0, 8, 9, 8, 10, 1000.0, 0)
+    # isolated grid points are 1-pixel lines
+    assert segments[1] == ('line', 20, 8, 20, 8, 1, 1000.0, 10)
+    assert segments[2] == ('line', 30, 8, 30, 8, 1, 1000.0, 11)
+
+
+def test_short_runs_and_dwell_changes():
+    x = np.arange(12) / 64
+    y = np.zeros(12)
+    dwell = np.r_[np.full(6, 1000.0), np.full(6, 2000.0)]
+    segments = plan_beam_path(x, y, dwell, 64, 64, min_line = 8)
+    assert [s[0] for s in segments] == ['line'] * 12
+    assert all(s[5] == 1 for s in segments)
+    segments = plan_beam_path(x, y, dwell, 64, 64, min_line = 4)
+    assert [(s[5], s[6]) for s in segments] == [(6, 1000.0), (6, 2000.0)]
+
+
+def test_diagonal_run():
+    t = np.arange(16)
+    segments = plan_beam_path(t / 32, (2 * t) / 32, 500, 32, 32)
+    assert segments == [('line', 0, 0, 15, 30, 16, 500.0, 0)]
+
+
+def test_off_grid_points():
+    segments = plan_beam_path([0.1234567, 0.5], [0.5, 0.25], [2e6, 1000], 64, 64)
+    assert segments[0] == ('point', 0.1234567, 0.5, 2e6, 0)
+    assert segments[1][0] == 'line'
+
+
+# Delay has ms resolution, a shorter dwell off the grid cannot be done
+def test_off_grid_short_dwell_raises():
+    with pytest.raises(ValueError):
+        plan_beam_path([0.1234567], [0.5], [5000], 64, 64)
+    assert plan_beam_path([0.1234567], [0.5], [0], 64, 64)[0][0] == 'point'
+
+
+def test_empty():
+    assert plan_beam_path([], [], 1000, 64, 64) == []
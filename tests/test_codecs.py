@@ -0,0 +1,65 @@
+import struct
+
+import pytest
+
+from sem_conn import ArgType, DecodeValues, EncodeMessage, GetCodec
+
+
+# message as built by the original SemConnection.Send: header, then the arguments one by one
+def reference_message(fn_name, wait_flags, args, ident = 0):
+    body = b""
+    for t, v in args:
+        if t == ArgType.Int:
+            body += struct.pack("<i", v)
+        elif t == ArgType.UnsignedInt:
+            body += struct.pack("<I", v)
+        else:
+            s = (str(v) + "\x00\x00\x00\x00").encode()
+            l = (len(s) // 4) * 4
+            body += struct.pack("<I", l) + s[0:l]
+    hdr = struct.pack("<16sIIHHI", fn_name.ljust(16, "\x00").encode(), len(body), ident, wait_flags << 8, 0, 0)
+    return hdr + body
+
+
+MESSAGES = [
+    ('GetWD', 0, ()),
+    ('SetWD', 4, ((ArgType.Float, 10.123),)),
+    ('SetWD', 0, ((ArgType.Float, 7),)),
+    ('StgMoveTo', 2, ((ArgType.Float, 1.0), (ArgType.Float, -2.5))),
+    ('DtEnable', 0, ((ArgType.Int, 0), (ArgType.Int, 1), (ArgType.Int, 16))),
+    ('ScScanXY', 5, ((ArgType.UnsignedInt, 1),) + ((ArgType.UnsignedInt, 4096),) * 6 + ((ArgType.Int, 1), (ArgType.UnsignedInt, 100))),
+    ('DtSelect', 0, ((ArgType.Int, 1), (ArgType.String, 'SE'))),
+]
+
+
+@pytest.mark.parametrize('fn_name, wait_flags, args', MESSAGES)
+def test_encode_message_matches_reference(fn_name, wait_flags, args):
+    assert EncodeMessage(fn_name, wait_flags, *args) == reference_message(fn_name, wait_flags, args)
+    assert EncodeMessage(fn_name, wait_flags, *args, ident = 17) == reference_message(fn_name, wait_flags, args, 17)
+
+
+@pytest.mark.parametrize('fn_name, wait_flags, args', MESSAGES)
+def test_codec_matches_reference(fn_name, wait_flags, args):
+    codec = GetCodec(fn_name, tuple(t for t, v in args))
+    values = [v for t, v in args]
+    assert codec.fn_name == fn_name
+    assert codec.Encode(wait_flags, values) == reference_message(fn_name, wait_flags, args)
+    assert codec.Encode(wait_flags, values, 17) == reference_message(fn_name, wait_flags, args, 17)
+
+
+def test_codec_cached():
+    assert GetCodec('GetWD', ()) is GetCodec('GetWD', ())
+
+
+def test_decode_values():
+    body = (struct.pack("<i", -3) + struct.pack("<I", 7)
+            + struct.pack("<I", 8) + b"1.25\x00\x00\x00\x00"
+            + struct.pack("<I", 4) + b"SE\x00\x00"
+            + struct.pack("<I3i", 12, 1, 2, 3))
+    types = (ArgType.Int, ArgType.UnsignedInt, ArgType.Float, ArgType.String, ArgType.ArrayInt)
+    assert DecodeValues(body, types) == [-3, 7, 1.25, 'SE', (1, 2, 3)]
+
+
+def test_decode_values_short_body():
+    with pytest.raises(struct.error):
+        DecodeValues(b"", (ArgType.Int,))
@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+
+from drift import DriftCorrector
+
+
+# tiles in a row, each registered to the previous one; the stage error grows by 'ramp' mm per tile
+def run_ramp(d, ramp, n = 40):
+    errors = []
+    prev = None
+    for k in range(n):
+        c = d.correction()
+        d.record_applied(k, c)
+        e = ramp * k + c            # actual error: drift + applied correction
+        d.observe(k, {} if prev is None else {k - 1: (prev - e, 1.0)})
+        prev = e
+        errors.append(e)
+    return np.array(errors)
+
+
+def test_reference_tile():
+    d = DriftCorrector()
+    assert np.array_equal(d.observe((0, 0), {}), [0, 0])
+    assert np.array_equal(d.correction(), [0, 0])
+
+
+def test_error_from_neighbour():
+    d = DriftCorrector(gain = 1.0, rate_gain = 0)
+    d.observe(0, {})
+    e = d.observe(1, {0: ((0.002, -0.001), 1.0)})
+    assert e == pytest.approx((-0.002, 0.001))
+    assert d.correction() == pytest.approx((0.002, -0.001))
+
+
+def test_ramp_followed_with_rate():
+    e = run_ramp(DriftCorrector(0.5, 0.05, 0.1), np.array([0.001, -0.0005]))
+    assert np.abs(e[-5:]).max() < 1e-5
+
+
+def test_ramp_lags_without_rate():
+    e = run_ramp(DriftCorrector(0.5, 0.05, 0.0), np.array([0.001, 0.0]))
+    assert e[-1][0] == pytest.approx(0.001 / 0.5)
+
+
+def test_max_correction():
+    d = DriftCorrector(gain = 1.0, max_correction = 0.01, rate_gain = 0, gate = None)
+    d.observe(0, {})
+    d.observe(1, {0: ((-0.5, 0.5), 1.0)})
+    assert d.correction() == pytest.approx((-0.01, 0.01))
+
+
+# neighbour error not known yet (other writer thread): observed as soon as it is
+def test_pending():
+    d = DriftCorrector()
+    d.record_applied(0, (0, 0))
+    assert d.observe(2, {1: ((0.001, 0), 1.0)}) is None
+    assert d.observe(1, {}) is None
+    assert d.unresolved() == [1, 2]
+    d.observe(0, {1: ((-0.001, 0), 1.0)})
+    assert not d.unresolved()
+    assert d.errors[2] == pytest.approx((-0.002, 0))
+
+
+# the pair is found by the tile added second, the first one gets it too
+def test_out_of_order():
+    d = DriftCorrector()
+    d.record_applied(0, (0, 0))
+    d.record_applied(1, (0, 0))
+    d.record_applied(2, (0, 0))
+    assert d.observe(2, {}) is None           # tile 2 saved first, its neighbours not yet
+    assert d.observe(1, {2: ((-0.001, 0), 1.0)}) is None
+    assert d.observe(0, {1: ((-0.001, 0), 1.0)}) == pytest.approx((0, 0))
+    assert d.errors[1] == pytest.approx((-0.001, 0))
+    assert d.errors[2] == pytest.approx((-0.002, 0))
+    assert not d.unresolved()
+
+
+def test_weak_peak_ignored():
+    d = DriftCorrector(min_peak = 0.3)
+    d.observe(0, {})
+    assert d.observe(1, {0: ((0.001, 0), 0.1)}) is None
+    assert d.unresolved() == [1]
+    assert d.correction() == pytest.approx((0, 0))
+
+
+def test_disagreeing_pairs_rejected():
+    d = DriftCorrector(agree = 0.002)
+    d.observe(0, {})
+    d.observe(1, {0: ((0.0, 0), 1.0)})
+    d.observe(2, {0: ((0.0, 0), 1.0)})
+    assert d.observe(3, {1: ((0.001, 0), 1.0), 2: ((-0.009, 0), 1.0)}) == pytest.approx((0, 0))
+    assert 3 in d.rejected
+    # neighbours are measured against the rejected tile
+    assert d.observe(6, {3: ((0.001, 0), 1.0)}) == pytest.approx((-0.001, 0))
+    # a third neighbour outvotes the outlier
+    d.observe(4, {0: ((0.0, 0), 1.0)})
+    assert d.observe(5, {1: ((0.001, 0), 1.0), 2: ((-0.009, 0), 1.0), 4: ((0.0012, 0), 1.0)}) == pytest.approx((-0.0011, 0))
+
+
+def test_gate():
+    d = DriftCorrector(gate = 0.01, max_rejects = 3)
+    d.observe(0, {})
+    assert d.observe(1, {0: ((0.03, 0), 1.0)}) == pytest.approx((0, 0))     # predicted
+    assert d.observe(2, {0: ((-0.02, 0), 1.0)}) == pytest.approx((0, 0))
+    assert d.observe(3, {0: ((0.03, 0), 1.0)}) == pytest.approx((0, 0))
+    assert d.correction() == pytest.approx((0, 0))
+    # a lasting step is accepted after max_rejects tiles with the same drift
+    assert d.observe(4, {0: ((0.03, 0), 1.0)}) == pytest.approx((0, 0))
+    assert d.observe(5, {0: ((0.03, 0), 1.0)}) == pytest.approx((-0.03, 0))
+    assert d.rejected == {1, 2, 3, 4}
+
+
+# no drift, some registrations are wrong by more than the gate (e.g. by a period of the sample
+# pattern): the correction stays small
+def test_outliers_do_not_steer():
+    rng = np.random.default_rng(1)
+    d = DriftCorrector()
+    prev = None
+    for k in range(200):
+        c = d.correction()
+        d.record_applied(k, c)
+        e = c + rng.normal(0, 0.0001, 2)        # actual error: no drift, applied correction + noise
+        if prev is None:
+            deltas = {}
+        elif rng.random() < 0.15:
+            deltas = {k - 1: (rng.choice([-1, 1], 2) * rng.uniform(0.015, 0.03, 2), rng.uniform(0.3, 1))}
+        else:
+            deltas = {k - 1: (prev - e, rng.uniform(0.3, 1))}
+        d.observe(k, deltas)
+        prev = e
+    assert np.abs(d.correction()).max() < 0.002
+    assert d.rejected
+    assert not d.unresolved()
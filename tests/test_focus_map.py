@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from focus_map import FocusMap, select_samples
+
+
+def plane(x, y):
+    return 10.0 + 0.01 * x - 0.02 * y
+
+
+@pytest.mark.parametrize('method', ['plane', 'poly', 'tps'])
+def test_fit_plane(method):
+    f = FocusMap(method, center = (1, 1), scale = 2)
+    rng = np.random.default_rng(1)
+    x, y = rng.uniform(0, 2, (2, 8))
+    for a, b in zip(x, y):
+        f.add(a, b, plane(a, b))
+    assert len(f) == 8
+    assert f.residual() == pytest.approx(0.0, abs = 1e-9)
+    assert f.predict(0.5, 1.5) == pytest.approx(plane(0.5, 1.5))
+
+
+def test_few_samples():
+    f = FocusMap('poly')
+    assert f.predict(0, 0) is None
+    f.add([0, 1], [0, 0], [10, 12])
+    assert f.predict(5, 5) == pytest.approx(11.0)       # mean WD
+    f.add(0, 1, 10)
+    assert f.predict(1, 1) == pytest.approx(12.0)       # plane
+
+
+def test_tps_interpolates():
+    f = FocusMap('tps')
+    xy = [(0, 0), (1, 0), (0, 1), (1, 1), (0.5, 0.5)]
+    wd = [10, 10, 10, 10, 10.2]
+    f.add(*np.array(xy).T, wd)
+    assert f.predict(0.5, 0.5) == pytest.approx(10.2)
+    assert np.allclose(f.predict(np.array([0, 1]), np.array([0, 1])), 10)
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        FocusMap('spline')
+
+
+def test_select_samples_spread():
+    y, x = np.mgrid[0:5, 0:5]
+    xy = np.stack((x.ravel(), y.ravel()), axis = -1)
+    idx = select_samples(xy, 4)
+    assert idx[0] == 0
+    assert {tuple(xy[i]) for i in idx[:4]} == {(0, 0), (4, 4), (4, 0), (0, 4)}
+
+
+def test_select_samples_known_corners():
+    y, x = np.mgrid[0:5, 0:5]
+    xy = np.stack((x.ravel(), y.ravel()), axis = -1)
+    corners = [(0, 0), (4, 0), (0, 4), (4, 4)]
+    idx = select_samples(xy, 5, known = corners)
+    assert len(idx) == 5 and len(set(idx)) == 5
+    assert not {tuple(xy[i]) for i in idx} & set(corners)
+    assert tuple(xy[idx[0]]) == (2, 2)
+
+
+def test_select_samples_all_known():
+    xy = [(0, 0), (1, 0)]
+    assert len(select_samples(xy, 3, known = xy)) == 0
+    assert len(select_samples([], 3)) == 0
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from image_metrics import SHARPNESS, fft_anisotropy, frame_stats, stig_score
+
+
+def texture(n = 128, seed = 0):
+    rng = np.random.default_rng(seed)
+    return rng.random((n, n)) * 100 + 50
+
+
+# box blur of size k along the given axes
+def blur(a, k, axes = (0, 1)):
+    for axis in axes:
+        a = sum(np.roll(a, s, axis) for s in range(k)) / k
+    return a
+
+
+@pytest.mark.parametrize('metric', sorted(SHARPNESS))
+def test_sharpness_decreases_with_blur(metric):
+    f = SHARPNESS[metric]
+    a = texture()
+    assert f(a) > f(blur(a, 3)) > f(blur(a, 7))
+
+
+@pytest.mark.parametrize('metric', sorted(SHARPNESS))
+def test_sharpness_brightness_invariant(metric):
+    f = SHARPNESS[metric]
+    a = blur(texture(), 2)
+    assert f(a * 3) == pytest.approx(f(a), rel = 1e-3)
+
+
+@pytest.mark.parametrize('metric', sorted(SHARPNESS))
+def test_sharpness_flat_image(metric):
+    assert SHARPNESS[metric](np.zeros((32, 32), np.uint8)) == 0
+
+
+def test_anisotropy():
+    a = blur(texture(), 2)
+    assert fft_anisotropy(a) < 0.1
+    assert fft_anisotropy(blur(a, 7, axes = (1,))) > 0.3
+    assert fft_anisotropy(np.zeros((32, 32))) == 0
+
+
+def test_stig_score():
+    a = blur(texture(), 2)
+    assert stig_score(a) > stig_score(blur(a, 5, axes = (1,)))
+
+
+def test_frame_stats():
+    a = np.arange(100 * 100, dtype = np.uint16).reshape(100, 100)
+    st = frame_stats(a, step = 1)
+    assert st['p1'] < st['p50'] < st['p99']
+    assert st['p50'] == pytest.approx(a.mean(), rel = 0.01)
+    assert st['sharpness'] > 0
+    assert frame_stats(a, step = 4)['p99'] <= a.max()
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from mosaic_store import MosaicStore
+
+
+@pytest.fixture(params = ['zarr', 'hdf5'])
+def path(request, tmp_path):
+    pytest.importorskip('zarr' if request.param == 'zarr' else 'h5py')
+    return str(tmp_path / ('m.zarr' if request.param == 'zarr' else 'm.h5'))
+
+
+def tile(k):
+    return np.full((40, 60), k, np.uint16)
+
+
+def test_write_read(path):
+    s = MosaicStore(path, 2, 3, 40, 60, chunk = 32, levels = 1)
+    assert s.write(1, 2, tile(5), {'wd_mm': 10.0}, [tile(5)[::2, ::2]]) is False
+    assert np.array_equal(s.read(1, 2), tile(5))
+    assert np.array_equal(s.levels[0][1, 2], tile(5)[::2, ::2])
+    assert s.metadata(1, 2) == {'wd_mm': 10.0}
+    assert s.metadata(0, 0) is None
+    assert s.written().tolist() == [[False, False, False], [False, False, True]]
+    s.close()
+
+
+def test_repeat(path):
+    s = MosaicStore(path, 2, 2, 40, 60)
+    s.write(0, 1, tile(1))
+    assert s.write(0, 1, tile(2), {'repeat': 1}) is True
+    assert np.array_equal(s.read(0, 1), tile(1))
+    assert np.array_equal(s.read(0, 1, repeat = True), tile(2))
+    assert s.metadata(0, 1, repeat = True) == {'repeat': 1}
+    s.close()
+
+
+def test_resume(path):
+    s = MosaicStore(path, 2, 2, 40, 60)
+    s.write(1, 1, tile(3))
+    s.set_attrs(view_field_mm = 0.1)
+    s.close()
+    s = MosaicStore(path, 2, 2, 40, 60)
+    assert s.written()[1, 1]
+    assert np.array_equal(s.read(1, 1), tile(3))
+    s.close()
+    with pytest.raises(ValueError):
+        MosaicStore(path, 3, 2, 40, 60)
+
+
+def test_shape_mismatch(path):
+    s = MosaicStore(path, 1, 1, 40, 60)
+    with pytest.raises(ValueError):
+        s.write(0, 0, np.zeros((40, 40)))
+    s.close()
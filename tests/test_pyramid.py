@@ -0,0 +1,55 @@
+import threading
+
+import numpy as np
+
+from pyramid import Overview, build_pyramid, downsample2
+
+
+def test_downsample2_integer():
+    a = np.array([[0, 1, 2], [3, 4, 5], [6, 7, 8]], dtype = np.uint8)
+    b = downsample2(a)
+    assert b.dtype == np.uint8 and b.shape == (1, 1)
+    assert b[0, 0] == 2         # (0 + 1 + 3 + 4 + 2) >> 2
+
+
+def test_downsample2_no_overflow():
+    a = np.full((4, 4), 65535, dtype = np.uint16)
+    assert np.all(downsample2(a) == 65535)
+
+
+def test_downsample2_float():
+    a = np.arange(16, dtype = np.float32).reshape(4, 4)
+    assert np.allclose(downsample2(a), [[2.5, 4.5], [10.5, 12.5]])
+
+
+def test_build_pyramid():
+    levels = build_pyramid(np.zeros((64, 48), dtype = np.uint16), 4)
+    assert [l.shape for l in levels] == [(32, 24), (16, 12), (8, 6), (4, 3)]
+    assert len(build_pyramid(np.zeros((4, 4)), 5)) == 2
+
+
+def test_overview():
+    ov = Overview(2, 3, 64, 64, level = 2, dtype = 'uint16')
+    data = np.full((64, 64), 7, dtype = np.uint16)
+    assert ov.add(1, 2, build_pyramid(data, 4), data) == 1
+    assert ov.add(0, 0, None, data * 2) == 2
+    img = ov.snapshot()
+    assert img.shape == (32, 48)
+    assert np.all(img[16:, 32:] == 7) and np.all(img[:16, :16] == 14)
+    assert np.all(img[:16, 16:] == 0)
+
+
+# each count is returned once, also with several threads
+def test_overview_count_threads():
+    ov = Overview(8, 8, 16, 16, level = 1)
+    data = np.zeros((16, 16), dtype = np.uint16)
+    counts = []
+    def add(r):
+        for c in range(8):
+            counts.append(ov.add(r, c, None, data))
+    threads = [threading.Thread(target = add, args = (r,)) for r in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(counts) == list(range(1, 65))
@@ -0,0 +1,83 @@
+import asyncio
+import struct
+
+import pytest
+
+from sem_async import AsyncSem, AsyncSemConnection
+from sem_conn import ArgType
+
+
+# control connection server: answers GetWD with 'wd', never answers Hang
+async def serve_control(reader, writer, wd = '10.5'):
+    try:
+        while True:
+            hdr = await reader.readexactly(32)
+            name = hdr[0:16].rstrip(b"\x00").decode()
+            body_size = struct.unpack_from("<I", hdr, 16)[0]
+            await reader.readexactly(body_size)
+            if name == 'GetWD':
+                s = (wd + "\x00\x00\x00\x00").encode()
+                body = struct.pack("<I", len(s) // 4 * 4) + s[:len(s) // 4 * 4]
+                writer.write(struct.pack("<16sIIHHI", b"GetWD", len(body), 0, 0, 0, 0) + body)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        writer.close()
+
+
+# run test coroutine 'body(conn)' with a connection to the control server
+def run(body):
+    async def main():
+        server = await asyncio.start_server(serve_control, '127.0.0.1', 0)
+        conn = AsyncSemConnection()
+        conn.lock_c = asyncio.Lock()
+        conn.reader_c, conn.writer_c = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+        try:
+            return await body(conn)
+        finally:
+            conn.Disconnect()
+            server.close()
+    return asyncio.run(main())
+
+
+def test_recv():
+    async def body(conn):
+        assert await conn.RecvFloat('GetWD') == 10.5
+        assert await conn.Recv('GetWD', (ArgType.Float,)) == [10.5]
+    run(body)
+
+
+# a cancelled request closes the connection, the next request raises instead of reading its response
+def test_cancelled_request_closes_connection():
+    async def body(conn):
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(conn.RecvInt('Hang'), 0.1)
+        assert conn.reader_c is None
+        with pytest.raises(ConnectionError):
+            await conn.RecvFloat('GetWD')
+    run(body)
+
+
+def test_connection_lost():
+    async def body(conn):
+        conn.writer_c.transport.abort()
+        with pytest.raises((OSError, asyncio.IncompleteReadError)):
+            await conn.RecvFloat('GetWD')
+        assert conn.reader_c is None
+    run(body)
+
+
+# image data are received while control requests go on, against the simulator
+def test_async_sem(sim):
+    async def main():
+        m = AsyncSem()
+        assert await m.Connect('127.0.0.1', sim.port) == 0
+        try:
+            m.DtEnable(0, 1, 8)
+            assert await m.ScScanXY(1, 64, 64, 0, 0, 63, 63, 1, 0) == 0
+            task = asyncio.create_task(m.FetchImageEx([0], 64 * 64, 64, 64))
+            polls = [await m.StgIsBusy(), await m.GetWD()]
+            img = (await task)[0]
+            assert img.shape == (64, 64)
+            assert polls == [0, 10.0]
+        finally:
+            m.Disconnect()
+    asyncio.run(main())
@@ -0,0 +1,177 @@
+import socket
+import struct
+import threading
+
+import numpy as np
+import pytest
+
+from sem_conn import ArgType, BufferPool, ImageAssembler, RequestBatch, SemConnection
+
+
+# SharkSEM message: header + body
+def message(fn_name, body, ident = 0):
+    return struct.pack("<16sIIHHI", fn_name.encode(), len(body), ident, 0, 0, 0) + body
+
+
+# ScData packet of 'data' (bytes) at pixel 'index'
+def sc_data(frame_id, channel, index, bpp, data):
+    pad = b"\x00" * ((-len(data)) % 4)
+    return message('ScData', struct.pack("<IIIII", frame_id, channel, index, bpp, len(data)) + data + pad)
+
+
+# packets of image 'img' (uint8 / uint16 array), 'step' pixels each, in the given order of packet numbers
+def packets(img, step, order = None, channel = 0, frame_id = 0):
+    flat = img.ravel()
+    starts = list(range(0, len(flat), step))
+    if order is not None:
+        starts = [starts[i] for i in order]
+    bpp = 8 * img.itemsize
+    return b"".join(sc_data(frame_id, channel, s, bpp, flat[s:s + step].astype('<u%d' % img.itemsize).tobytes()) for s in starts)
+
+
+# connection whose data (or control) socket is fed by the test through the returned socket
+def fed_connection(control = False):
+    conn = SemConnection()
+    a, b = socket.socketpair()
+    if control:
+        conn.socket_c = a
+    else:
+        conn.socket_d = a
+    return conn, b
+
+
+def test_buffer_pool():
+    pool = BufferPool(max_buffers = 2)
+    a = pool.Get(100)
+    pool.Release(a)
+    assert pool.Get(50) is a                # smallest suitable buffer is reused
+    pool.Release(a)
+    pool.Release(bytearray(10))
+    pool.Release(bytearray(200))
+    assert [len(b) for b in pool.free] == [100, 200]
+
+
+def test_recv_msg_pooled():
+    conn, peer = fed_connection(control = True)
+    peer.sendall(message('GetWD', b"x" * 12) + message('GetWD', b"y" * 8))
+    fn_name, body, buf = conn._RecvMsgC()
+    assert fn_name == 'GetWD' and bytes(body) == b"x" * 12
+    conn.pool.Release(buf)
+    fn_name, body, buf2 = conn._RecvMsgC()
+    assert bytes(body) == b"y" * 8 and buf2 is buf
+    peer.close()
+    with pytest.raises(ConnectionError):
+        conn._RecvMsgC()
+
+
+# packets out of order and sent twice give the same image
+def test_fetch_image_ex_reassembly():
+    img = (np.arange(64 * 32) * 7 % 251).astype(np.uint8).reshape(32, 64)
+    conn, peer = fed_connection()
+    order = [3, 0, 1, 1, 5, 2, 4, 7, 6, 7]
+    peer.sendall(packets(img, 256, order))
+    a = conn.FetchImageEx('ScData', [0], 64 * 32)[0]
+    assert bytes(a) == img.tobytes()
+
+
+def test_assembler_two_channels():
+    asm = ImageAssembler([0, 2], 8)
+    assert asm.Add(2, 0, 16, np.arange(8, dtype = '<u2').tobytes()) == 8
+    assert asm.IsComplete(2) and not asm.Done()
+    assert asm.Add(0, 4, 8, bytes(4)) == 4
+    assert asm.Prefix(0) == 0
+    asm.Add(0, 0, 8, bytes(4))
+    assert asm.Prefix(0) == 8 and asm.Done()
+
+
+def test_fetch_image_ex_arrays():
+    img = (np.arange(48 * 40) * 13).astype(np.uint16).reshape(40, 48)
+    conn, peer = fed_connection()
+    peer.sendall(packets(img, 100))
+    a = conn.FetchImageEx('ScData', [0], 48 * 40, 48, 40)[0]
+    assert a.dtype == np.uint16 and a.shape == (40, 48)
+    assert np.array_equal(a, img)
+    assert not a.flags.owndata              # view of the receive buffer
+
+
+def test_fetch_image_16bit():
+    img = (np.arange(32 * 16) * 301).astype(np.uint16).reshape(16, 32)
+    conn, peer = fed_connection()
+    peer.sendall(packets(img, 64) * 3)
+    assert bytes(conn.FetchImage('ScData', 0, 32 * 16, 16)) == img.tobytes()
+    assert bytes(conn.FetchImage('ScData', 0, 32 * 16, 8)) == (img >> 8).astype(np.uint8).tobytes()
+    a = conn.FetchImage('ScData', 0, 32 * 16, 8, 32, 16)
+    assert np.array_equal(a, (img >> 8).astype(np.uint8))
+
+
+def test_fetch_lines():
+    img = (np.arange(64 * 16) % 256).astype(np.uint8).reshape(16, 64)
+    conn, peer = fed_connection()
+    peer.sendall(packets(img, 96, [0, 2, 1, 3, 4, 5, 6, 7, 9, 10, 8]))
+    g = conn.FetchLines('ScData', [0], 64, 16)
+    blocks = []
+    while True:
+        try:
+            lines = next(g)
+        except StopIteration as e:
+            result = e.value
+            break
+        blocks.append((lines.row_start, lines.row_stop))
+        assert bytes(lines.data) == img[lines.row_start:lines.row_stop].tobytes()
+    assert blocks[0][0] == 0 and blocks[-1][1] == 16
+    assert all(b[0] == a[1] for a, b in zip(blocks, blocks[1:]))
+    assert bytes(result[0]) == img.tobytes()
+
+
+# control server: answers each request with its identification, in reverse order
+def reverse_server(peer, n, values):
+    requests = []
+    for i in range(n):
+        hdr = peer.recv(32, socket.MSG_WAITALL)
+        body_size, ident = struct.unpack_from("<II", hdr, 16)
+        if body_size:
+            peer.recv(body_size, socket.MSG_WAITALL)
+        requests.append(ident)
+    for ident, v in reversed(list(zip(requests, values))):
+        peer.sendall(message('GetWD', v, ident))
+
+
+def test_batch_matches_responses():
+    conn, peer = fed_connection(control = True)
+    values = [struct.pack("<i", 5), struct.pack("<i", -7), struct.pack("<I", 4) + b"1.5\x00"]
+    t = threading.Thread(target = reverse_server, args = (peer, 3, values))
+    t.start()
+    b = RequestBatch(conn)
+    r1 = b.RecvInt('A')
+    r2 = b.Recv('B', (ArgType.Int,))
+    r3 = b.RecvFloat('C')
+    assert b.Execute() == [5, [-7], 1.5]
+    t.join()
+    assert (r1.value, r2.value, r3.value) == (5, [-7], 1.5)
+    assert b.Execute() == []
+
+
+def test_batch_failed_response():
+    conn, peer = fed_connection(control = True)
+    values = [struct.pack("<i", 5), b"", struct.pack("<i", 6)]
+    t = threading.Thread(target = reverse_server, args = (peer, 3, values))
+    t.start()
+    b = RequestBatch(conn)
+    r1 = b.RecvInt('A')
+    r2 = b.RecvInt('B')
+    r3 = b.RecvInt('C')
+    with pytest.raises(struct.error):
+        b.Execute()
+    t.join()
+    assert r1.value == 5 and r3.value == 6
+    assert isinstance(r2.error, struct.error)
+
+
+def test_batch_connection_lost():
+    conn, peer = fed_connection(control = True)
+    b = RequestBatch(conn)
+    r = b.RecvInt('A')
+    peer.close()
+    with pytest.raises(OSError):
+        b.Execute()
+    assert isinstance(r.error, OSError)
@@ -0,0 +1,153 @@
+import socket
+import struct
+
+import numpy as np
+import pytest
+
+import sem
+from beam_scan import scan_points
+from sem_conn import ArgType
+from sem_sim import SemSimulator
+
+
+# test pattern of the simulator: byte j of channel 'channel' image data
+def pattern(channel, n_pixels, bytes_pp):
+    period = 4093 * bytes_pp
+    j = np.arange(n_pixels * bytes_pp) % period
+    p = ((j * 7 + channel * 64) & 0xFF).astype(np.uint8)
+    return p.view('<u2') if bytes_pp == 2 else p
+
+
+def test_fetch_image(m):
+    m.DtEnable(0, 1, 8)
+    m.ScScanXY(1, 64, 48, 0, 0, 63, 47, 1, 0)
+    img = m.FetchImage(0, 64 * 48)
+    assert bytes(img) == pattern(0, 64 * 48, 1).tobytes()
+
+
+def test_fetch_image_16bit_high_bytes(m):
+    m.DtEnable(0, 1, 16)
+    m.ScScanXY(1, 64, 48, 0, 0, 63, 47, 1, 0)
+    img = m.FetchImage(0, 64 * 48, 8, 64, 48)
+    assert img.shape == (48, 64)
+    assert np.array_equal(img.ravel(), (pattern(0, 64 * 48, 2) >> 8).astype(np.uint8))
+
+
+def test_fetch_image_ex(m):
+    m.DtEnable(0, 1, 16)
+    m.DtEnable(1, 1, 8)
+    m.ScScanXY(2, 64, 64, 0, 0, 63, 63, 1, 0)
+    a, b = m.FetchImageEx([0, 1], 64 * 64, 64, 64)
+    assert a.dtype == np.uint16 and b.dtype == np.uint8
+    assert np.array_equal(a.ravel(), pattern(0, 64 * 64, 2))
+    assert np.array_equal(b.ravel(), pattern(1, 64 * 64, 1))
+
+
+# resent and out of order packets give the same image
+def test_fetch_image_ex_lossy():
+    sim = SemSimulator(port = 0, time_scale = 0, packet_size = 1000, resend_prob = 0.2, reorder_prob = 0.2)
+    sim.start()
+    m = sem.Sem()
+    try:
+        assert m.Connect('127.0.0.1', sim.port) == 0
+        m.DtEnable(0, 1, 8)
+        m.ScScanXY(1, 128, 128, 0, 0, 127, 127, 1, 0)
+        img = m.FetchImageEx([0], 128 * 128, 128, 128)[0]
+        assert np.array_equal(img.ravel(), pattern(0, 128 * 128, 1))
+    finally:
+        m.Disconnect()
+        sim.stop()
+
+
+def test_fetch_lines(m):
+    m.DtEnable(0, 1, 16)
+    m.ScScanXY(3, 64, 64, 0, 0, 63, 63, 1, 0)
+    g = m.FetchLines([0], 64, 64)
+    rows = []
+    while True:
+        try:
+            lines = next(g)
+        except StopIteration as e:
+            img = e.value
+            break
+        assert lines.frame_id == 3 and lines.channel == 0
+        assert lines.row_start == (rows[-1][1] if rows else 0)
+        assert len(lines.data) == (lines.row_stop - lines.row_start) * 64 * 2
+        rows.append((lines.row_start, lines.row_stop))
+    assert rows[-1][1] == 64
+    assert bytes(img[0]) == pattern(0, 64 * 64, 2).tobytes()
+
+
+def test_batch(m, sim):
+    m.SetWD(7.5)
+    b = m.Batch()
+    wd = b.GetWD()
+    pos = b.StgGetPosition()
+    vf = b.GetViewField()
+    values = b.Execute()
+    assert wd.value == 7.5
+    assert len(pos.value) == 5
+    assert vf.value == sim.view_field
+    assert values == [wd.value, pos.value, vf.value]
+
+
+# a response which cannot be decoded raises after all responses are received, the connection stays usable
+def test_batch_error(m):
+    m.SetWD(5)
+    b = m.Batch()
+    wd = b.GetWD()
+    bad = b.connection.Recv('GetWD', (ArgType.Float,) * 3)
+    wd2 = b.GetWD()
+    with pytest.raises(struct.error):
+        b.Execute()
+    assert wd.value == 5.0 and wd2.value == 5.0
+    assert isinstance(bad.error, struct.error)
+    assert m.GetWD() == 5.0
+
+
+# unknown functions are dropped, the following responses stay in step
+def test_unknown_function(m):
+    m.connection.Send('NoSuchFunction', (ArgType.Int, 1))
+    assert m.GetWD() == 10.0
+
+
+def test_send_only_functions(m, sim):
+    m.ScSetExternal(1)
+    m.SetViewField(0.25)
+    assert m.GetViewField() == 0.25
+    assert sim.external == 1
+
+
+# a lost packet leaves the frame incomplete, the client times out
+def test_packet_loss():
+    sim = SemSimulator(port = 0, time_scale = 0, packet_size = 1000, loss_prob = 0.3)
+    sim.start()
+    m = sem.Sem()
+    try:
+        assert m.Connect('127.0.0.1', sim.port) == 0
+        m.DtEnable(0, 1, 8)
+        m.connection.socket_d.settimeout(0.3)
+        m.ScScanXY(1, 128, 128, 0, 0, 127, 127, 1, 0)
+        with pytest.raises(socket.timeout):
+            m.FetchImageEx([0], 128 * 128)
+        assert sim.n_lost > 0
+    finally:
+        m.Disconnect()
+        sim.stop()
+
+
+def test_stage_move(m):
+    m.StgMoveTo(1.5, -2.25)
+    assert m.StgGetPosition()[:2] == [1.5, -2.25]
+
+
+# the line data are read while the batch runs: much more data than the socket buffers hold
+def test_scan_points(m):
+    m.DtEnable(0, 1, 16)
+    n_lines = 2000
+    y, x = np.mgrid[0:n_lines, 0:4096]
+    segments, results, lines = scan_points(m, x.ravel() / 4096, y.ravel() / 4096, 100, chunk = 500)
+    assert len(segments) == n_lines and results == [0] * n_lines
+    assert sorted(lines) == list(range(n_lines))
+    assert bytes(lines[7][0]) == pattern(0, 4096, 2).tobytes()
+    assert m.GetWD() == 10.0
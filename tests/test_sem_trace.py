@@ -0,0 +1,67 @@
+import json
+import time
+
+import pytest
+
+from sem_trace import TracedConnection, Tracer
+
+
+def test_span(tmp_path):
+    fp = str(tmp_path / 'trace.jsonl')
+    t = Tracer(fp)
+    with t.span('stage.move', iR = 1) as s:
+        s.bytes = 100
+        time.sleep(0.01)
+    with pytest.raises(KeyError):
+        with t.span('stage.move'):
+            raise KeyError()
+    t.close()
+    lines = [json.loads(l) for l in open(fp)]
+    assert [l['name'] for l in lines] == ['stage.move'] * 2
+    assert lines[0]['args'] == {'iR': 1} and lines[0]['bytes'] == 100
+    assert lines[0]['dur'] >= 0.01
+    assert [l['error'] for l in lines] == [False, True]
+    assert t.stats['stage.move'][0] == 2
+
+
+def test_summary():
+    t = Tracer()
+    t.record('a', {}, 0, 0, 0.5)
+    t.record('b', {}, 2e6, 0, 1.0)
+    lines = t.summary().split('\n')
+    assert lines[1].startswith('b') and lines[2].startswith('a')
+    assert lines[-1].startswith('wall time')
+
+
+def test_traced_connection(m):
+    t = Tracer()
+    m.connection = TracedConnection(m.connection, t)
+    m.SetWaitFlags(0)
+    m.SetWD(12.0)
+    assert m.GetWD() == 12.0
+    m.DtEnable(0, 1, 8)
+    m.ScScanXY(1, 32, 32, 0, 0, 31, 31, 1, 0)
+    m.FetchImage(0, 32 * 32)
+    for name in ('SetWD', 'GetWD', 'ScScanXY', 'FetchImage'):
+        assert t.stats[name][0] == 1
+    assert t.stats['FetchImage'][3] >= 32 * 32
+    assert m.connection.wait_flags == 0
+
+
+def test_traced_batch(m, tmp_path):
+    fp = str(tmp_path / 'trace.jsonl')
+    t = Tracer(fp)
+    m.connection = TracedConnection(m.connection, t)
+    b = m.Batch()
+    b.SetWD(11.0)
+    b.GetWD()
+    b.GetViewField()
+    assert b.Execute() == [11.0, 0.4]
+    b.SetWD(12.0)
+    assert b.Execute() == []
+    assert m.GetWD() == 12.0
+    t.close()
+    batches = [json.loads(l) for l in open(fp) if '"Batch"' in l]
+    assert [b['args']['args'] for b in batches] == [['SetWD', 'GetWD', 'GetViewField'], ['SetWD']]
+    assert batches[0]['bytes'] > 0
+    assert m.connection.batch is None
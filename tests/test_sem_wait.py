@@ -0,0 +1,64 @@
+import time
+
+from sem_conn import wtflgB, wtflgC
+from sem_wait import wait_busy, wait_gui_scanning, wait_idle, wait_settled, wait_stage, wait_until
+
+
+def test_wait_until():
+    t = time.perf_counter() + 0.1
+    assert wait_until(lambda: time.perf_counter() >= t, timeout = 2)
+    assert time.perf_counter() - t < 0.1
+
+
+def test_wait_until_timeout():
+    start = time.perf_counter()
+    assert not wait_until(lambda: False, timeout = 0.1)
+    assert 0.1 <= time.perf_counter() - start < 0.3
+
+
+def test_wait_idle(m, sim):
+    sim.time_scale = 1
+    m.Delay(200)
+    m.GetWD()
+    assert wait_busy(m, wtflgC, 1)
+    start = time.perf_counter()
+    assert wait_idle(m, wtflgC, 2)
+    assert time.perf_counter() - start < 0.3
+    assert not wait_busy(m, wtflgC, 0.05)
+
+
+def test_wait_restores_flags(m, sim):
+    sim.time_scale = 1
+    m.SetWaitFlags(wtflgB)
+    m.Delay(1000)
+    m.GetWD()
+    assert not wait_idle(m, wtflgC, 0.05)
+    assert m.connection.wait_flags == wtflgB
+
+
+def test_wait_stage(m, sim):
+    sim.time_scale = 0.1
+    m.StgMoveTo(1.0, 2.0)
+    m.GetWD()
+    assert wait_stage(m, 5)
+    assert list(m.StgGetPosition()[:2]) == [1.0, 2.0]
+
+
+def test_wait_gui_scanning(m):
+    m.GUISetScanning(1)
+    assert wait_gui_scanning(m, 1, 1)
+    m.GUISetScanning(0)
+    assert wait_gui_scanning(m, 0, 1)
+    assert not wait_gui_scanning(m, 1, 0.05)
+
+
+def test_wait_settled():
+    start = time.perf_counter()
+    # changes at 0.1 s and 0.2 s, then stays
+    get = lambda: min(int((time.perf_counter() - start) / 0.1), 2)
+    assert wait_settled(get, 0, hold = 0.2, timeout = 2)
+    assert 0.4 <= time.perf_counter() - start < 0.8
+
+
+def test_wait_settled_unchanged():
+    assert not wait_settled(lambda: 0, 0, hold = 0.05, timeout = 0.1)
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from stitching import Stitcher, blend, overlap_slices, phase_correlation
+
+
+def texture(h, w, seed = 0):
+    rng = np.random.default_rng(seed)
+    a = rng.random((h + 8, w + 8))
+    # smooth a little, so the sub-pixel peak is well defined
+    return (a[:-8, :-8] + a[1:-7, :-8] + a[:-8, 1:-7] + a[1:-7, 1:-7]) * 1000
+
+
+def test_phase_correlation():
+    big = texture(80, 80)
+    a = big[10:74, 10:74]
+    b = big[13:77, 8:72]        # a(y, x) = b(y - 3, x + 2)
+    dy, dx, peak = phase_correlation(a, b)
+    assert (dy, dx) == pytest.approx((3, -2), abs = 0.3)
+    assert peak > 0.3
+
+
+def test_overlap_slices():
+    sa, sb = overlap_slices((100, 100), (0, 80))
+    assert sa == (slice(0, 100), slice(80, 100))
+    assert sb == (slice(0, 100), slice(0, 20))
+    assert overlap_slices((100, 100), (0, 90)) is None
+
+
+# 2 x 2 tiles cut from one image with offset errors, solve recovers the true positions
+def test_stitcher():
+    big = texture(200, 200, 1)
+    size = 96
+    true = {(0, 0): (0, 0), (0, 1): (2, 70), (1, 0): (71, -1), (1, 1): (69, 72)}
+    nominal = {(0, 0): (0, 0), (0, 1): (0, 70), (1, 0): (70, 0), (1, 1): (70, 70)}
+    s = Stitcher((size, size), max_error = 10)
+    for key in [(0, 0), (0, 1), (1, 1), (1, 0)]:
+        y, x = true[key]
+        img = big[y + 10:y + 10 + size, x + 10:x + 10 + size]
+        neighbours = {k: nominal[k] for k in nominal if k != key and abs(k[0] - key[0]) + abs(k[1] - key[1]) == 1}
+        s.add_tile(key, img, nominal[key], neighbours)
+    assert len(s.pairs) == 4
+    assert not s.strips
+    p = s.solve()
+    for key in true:
+        assert p[key] - p[(0, 0)] == pytest.approx(np.subtract(true[key], true[(0, 0)]), abs = 0.5)
+    assert s.residual(p) < 0.5
+
+
+def test_blend():
+    a = np.full((4, 4), 100, dtype = np.uint16)
+    b = np.full((4, 4), 200, dtype = np.uint16)
+    mosaic, origin = blend({0: a, 1: b}, {0: (0, 0), 1: (0, 2)})
+    assert mosaic.shape == (4, 6) and mosaic.dtype == np.uint16
+    assert origin == (0, 0)
+    assert mosaic[0, 0] == 100 and mosaic[0, 5] == 200
+    assert 100 < mosaic[1, 3] < 200
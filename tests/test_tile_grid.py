@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from tile_grid import TileGrid, mask_polygon, parse_polygon
+
+CORNERS = [(0, 0), (3, 0), (0, 2), (3, 2)]
+
+
+def test_positions_bilinear():
+    g = TileGrid(CORNERS, [10, 11, 12, 13], 3, 4)
+    assert g.position(0, 0) == (0.0, 0.0, 10.0)
+    assert g.position(2, 3) == (3.0, 2.0, 13.0)
+    assert g.position(1, 1) == pytest.approx((1.0, 1.0, 11.0 + 1 / 3))
+    assert g.steps() == pytest.approx((1.0, 1.0))
+    assert g.overlap(1.25) == pytest.approx((0.2, 0.2))
+
+
+def test_single_row():
+    g = TileGrid(CORNERS, [10] * 4, 1, 1)
+    assert g.position(0, 0) == (0.0, 0.0, 10.0)
+    assert g.steps() == (0.0, 0.0)
+
+
+def test_invalid_size():
+    with pytest.raises(ValueError):
+        TileGrid(CORNERS, [10] * 4, 0, 3)
+
+
+def test_from_overlap():
+    g = TileGrid.from_overlap(CORNERS, [10] * 4, 1.0, 0.1)
+    assert (g.nR, g.nC) == (4, 5)
+    ox, oy = g.overlap(1.0)
+    assert ox >= 0.1 and oy >= 0.1
+
+
+@pytest.mark.parametrize('overlap', [1.0, 1.5, -0.1])
+def test_from_overlap_invalid(overlap):
+    with pytest.raises(ValueError):
+        TileGrid.from_overlap(CORNERS, [10] * 4, 1.0, overlap)
+
+
+def test_mask():
+    g = TileGrid(CORNERS, [10] * 4, 3, 4)
+    mask = np.zeros((3, 4), dtype = bool)
+    mask[1, 2] = mask[0, 0] = True
+    g.set_mask(mask)
+    assert g.tiles().tolist() == [[0, 0], [1, 2]]
+    assert g.positions().tolist() == [[0.0, 0.0], [2.0, 1.0]]
+    with pytest.raises(ValueError):
+        g.set_mask(np.ones((2, 2)))
+
+
+def test_save_load(tmp_path):
+    g = TileGrid(CORNERS, [10, 11, 12, 13], 3, 4, mask_polygon(TileGrid(CORNERS, [10] * 4, 3, 4), [(-1, -1), (4, -1), (-1, 3)]))
+    fp = str(tmp_path / 'grid.npz')
+    g.save(fp)
+    h = TileGrid.load(fp)
+    assert np.array_equal(h.mask, g.mask)
+    assert np.array_equal(h.wd, g.wd)
+
+
+def test_parse_polygon():
+    assert parse_polygon('  ') is None
+    assert parse_polygon('0, 0; 1, 0;\n0, 1') == [(0.0, 0.0), (1.0, 0.0), (0.0, 1.0)]
+    with pytest.raises(ValueError):
+        parse_polygon('0, 0; 1, 0')
+    with pytest.raises(ValueError):
+        parse_polygon('0, 0; 1, 0; 1')
+
+
+def test_mask_polygon():
+    g = TileGrid([(0, 0), (3, 0), (0, 3), (3, 3)], [10] * 4, 4, 4)
+    mask = mask_polygon(g, [(-0.5, -0.5), (3.5, -0.5), (-0.5, 3.5)])
+    assert mask.sum() == 6
+    assert mask[0, 0] and mask[0, 2] and not mask[3, 3]
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from tile_path import PLANNERS, StageCostModel, hilbert_index, plan_tile_order
+
+
+# (row, col) of a nR x nC grid, 1 mm pitch
+def grid_tiles(nR, nC):
+    rc = np.argwhere(np.ones((nR, nC), dtype = bool))
+    return rc, rc[:, ::-1].astype(float)
+
+
+def test_serpentine():
+    rc, xy = grid_tiles(2, 3)
+    order, t = plan_tile_order(rc, xy, 'serpentine')
+    assert [tuple(rc[i]) for i in order] == [(0, 0), (0, 1), (0, 2), (1, 2), (1, 1), (1, 0)]
+    assert t > 0
+
+
+@pytest.mark.parametrize('method', sorted(PLANNERS))
+def test_planners_visit_all_tiles_once(method):
+    rc, xy = grid_tiles(5, 6)
+    order, t = plan_tile_order(rc, xy, method)
+    assert sorted(order) == list(range(len(rc)))
+
+
+def test_tsp_not_slower_than_serpentine():
+    rng = np.random.default_rng(0)
+    rc, xy = grid_tiles(6, 6)
+    keep = rng.random(len(rc)) < 0.5
+    keep[0] = True
+    rc, xy = rc[keep], xy[keep]
+    cost = StageCostModel()
+    order, t = plan_tile_order(rc, xy, 'tsp', cost)
+    assert order[0] == 0
+    assert t <= plan_tile_order(rc, xy, 'serpentine', cost)[1] + 1e-9
+
+
+def test_empty():
+    order, t = plan_tile_order(np.zeros((0, 2)), np.zeros((0, 2)))
+    assert len(order) == 0 and t == 0.0
+
+
+def test_hilbert_index_is_a_permutation():
+    n = 8
+    y, x = np.mgrid[0:n, 0:n]
+    d = hilbert_index(n, x.ravel(), y.ravel())
+    assert sorted(d) == list(range(n * n))
+
+
+def test_cost_model():
+    cost = StageCostModel(speed = 2.0, accel = 10.0, settle = 0.5, backlash = 0.3)
+    assert cost.move_time((0, 0), (0, 0)) == 0.0
+    # long move: cruise at speed plus the ramps, the slower axis counts
+    assert cost.move_time((0, 0), (10, 1)) == pytest.approx(10 / 2.0 + 2.0 / 10.0 + 0.5)
+    # one reversal of the x axis
+    xy = np.array([(0, 0), (1, 0), (0, 0)])
+    assert cost.path_time(xy, [0, 1, 2]) == pytest.approx(2 * cost.move_time((0, 0), (1, 0)) + 0.3)
+
+
+# planners which take a start tile begin the path there and still visit all tiles
+@pytest.mark.parametrize('method', ['tsp', 'hilbert'])
+def test_start(method):
+    rc, xy = grid_tiles(4, 5)
+    order, t = plan_tile_order(rc, xy, method, start = 13)
+    assert order[0] == 13
+    assert sorted(order) == list(range(len(rc)))
@@ -0,0 +1,57 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from tile_writer import TileWriter, write_tiff
+
+
+def test_save_in_background(tmp_path):
+    w = TileWriter(n_threads = 2, max_pending = 2)
+    saved = []
+    for k in range(8):
+        fp = str(tmp_path / '{}.bin'.format(k))
+        w.submit(fp, lambda fp, k: saved.append(k), fp, k)
+    w.close()
+    assert sorted(saved) == list(range(8))
+    assert w.pending == {}
+
+
+def test_exists_while_pending(tmp_path):
+    gate = threading.Event()
+    w = TileWriter(n_threads = 1)
+    fp = str(tmp_path / 'a.bin')
+    w.submit(fp, lambda: gate.wait(5))
+    assert w.exists(fp)
+    assert not os.path.exists(fp)
+    gate.set()
+    w.close()
+    assert not w.exists(fp)
+
+
+def test_errors(tmp_path):
+    def fail():
+        raise OSError("disk full")
+    w = TileWriter(n_threads = 1)
+    w.submit('a.bin', fail)
+    w.tasks.join()
+    errors = w.take_errors()
+    assert [fp for fp, e in errors] == ['a.bin']
+    assert isinstance(errors[0][1], OSError)
+    assert w.take_errors() == []
+    w.submit('b.bin', fail)
+    with pytest.raises(OSError):
+        w.close()
+
+
+def test_write_tiff(tmp_path):
+    tifffile = pytest.importorskip('tifffile')
+    data = np.arange(300 * 200, dtype = np.uint16).reshape(300, 200)
+    fp = str(tmp_path / 'a.ome.tiff')
+    write_tiff(fp, data, {'pixel_size_um': 0.5, 'stage_x_mm': 1.0, 'stage_y_mm': 2.0}, tile = 128,
+               levels = [data[::2, ::2]])
+    with tifffile.TiffFile(fp) as tif:
+        assert np.array_equal(tif.pages[0].asarray(), data)
+        assert tif.pages[0].is_tiled
+        assert np.array_equal(tif.series[0].levels[1].asarray(), data[::2, ::2])
@@ -0,0 +1,124 @@
+import math
+
+import numpy as np
+
+
+# fractional grid coordinate of index i = 0 .. n-1, 0.0 - 1.0 (0.0 for a single row / column)
+def _frac(n):
+    if n <= 1:
+        return np.zeros(max(n, 0))
+    return np.arange(n) / (n - 1)
+
+
+# tile grid of nR x nC tiles, stage positions and target WDs bilinearly interpolated from the 4 corners
+#   corners:    stage positions (x, y) of the upper left, upper right, lower left, lower right tiles (mm)
+#   wds:        WDs at the 4 corners, same order (mm)
+#   mask:       nR x nC bool array, tiles to image (None = all), e.g. from mask_polygon()
+# All positions are precomputed as arrays, indexed [iR, iC]:
+#   x, y, wd:   stage position and target WD of each tile
+# Tiles to image, in row-major order, are listed by tiles() / positions() / wds().
+class TileGrid:
+
+    def __init__(self, corners, wds, nR, nC, mask = None):
+        self.corners = np.asarray(corners, dtype = float).reshape(4, 2)
+        self.corner_wds = np.asarray(wds, dtype = float).reshape(4)
+        self.nR = int(nR)
+        self.nC = int(nC)
+        if self.nR < 1 or self.nC < 1:
+            raise ValueError("Tile grid needs at least 1 row and 1 column")
+
+        # bilinear weights of the 4 corners, shape (nR, nC, 4)
+        v = _frac(self.nR)[:, None]
+        u = _frac(self.nC)[None, :]
+        w = np.stack(np.broadcast_arrays((1 - v) * (1 - u), (1 - v) * u, v * (1 - u), v * u), axis = -1)
+        self.x = w @ self.corners[:, 0]
+        self.y = w @ self.corners[:, 1]
+        self.wd = w @ self.corner_wds
+
+        self.set_mask(mask)
+
+    # grid covering the area between the 4 corner tile positions with view field vf (mm),
+    # with at least 'overlap' (fraction, e.g. 0.1 = 10 %) overlap of neighbouring tiles
+    @classmethod
+    def from_overlap(cls, corners, wds, vf, overlap = 0.1, mask = None):
+        if not 0 <= overlap < 1:
+            raise ValueError("Tile overlap must be at least 0 and less than 1 (100 %), got {}".format(overlap))
+        c = np.asarray(corners, dtype = float).reshape(4, 2)
+        width = max(np.linalg.norm(c[1] - c[0]), np.linalg.norm(c[3] - c[2]))
+        height = max(np.linalg.norm(c[2] - c[0]), np.linalg.norm(c[3] - c[1]))
+        step = vf * (1 - overlap)
+        nC = int(math.ceil(width / step - 1e-9)) + 1
+        nR = int(math.ceil(height / step - 1e-9)) + 1
+        return cls(c, wds, nR, nC, mask)
+
+    # set tiles to image, nR x nC bool array (None = all)
+    def set_mask(self, mask):
+        if mask is None:
+            mask = np.ones((self.nR, self.nC), dtype = bool)
+        mask = np.asarray(mask, dtype = bool)
+        if mask.shape != (self.nR, self.nC):
+            raise ValueError("Tile mask shape {} does not match grid ({}, {})".format(mask.shape, self.nR, self.nC))
+        self.mask = mask
+        self.rc = np.argwhere(mask)
+
+    # (iR, iC) of the tiles to image, N x 2
+    def tiles(self):
+        return self.rc
+
+    # stage positions of the tiles to image, N x 2
+    def positions(self):
+        return np.stack((self.x[self.mask], self.y[self.mask]), axis = -1)
+
+    # target WDs of the tiles to image, N
+    def wds(self):
+        return self.wd[self.mask]
+
+    # (px, py, WD_target) of tile (iR, iC)
+    def position(self, iR, iC):
+        return (float(self.x[iR, iC]), float(self.y[iR, iC]), float(self.wd[iR, iC]))
+
+    # tile spacing (mm) along rows and columns, (step_x, step_y); 0 for a single column / row
+    def steps(self):
+        sx = np.hypot(*np.diff(np.stack((self.x, self.y)), axis = 2).reshape(2, -1)).mean() if self.nC > 1 else 0.0
+        sy = np.hypot(*np.diff(np.stack((self.x, self.y)), axis = 1).reshape(2, -1)).mean() if self.nR > 1 else 0.0
+        return (float(sx), float(sy))
+
+    # overlap fractions of neighbouring tiles (along rows, along columns) for view field vf (mm)
+    def overlap(self, vf):
+        sx, sy = self.steps()
+        return (1 - sx / vf if self.nC > 1 else 0.0, 1 - sy / vf if self.nR > 1 else 0.0)
+
+    # save to / load from .npz file, e.g. to resume a run with the same grid
+    def save(self, fp):
+        np.savez(fp, corners = self.corners, wds = self.corner_wds, nR = self.nR, nC = self.nC, mask = self.mask)
+
+    @classmethod
+    def load(cls, fp):
+        f = np.load(fp)
+        return cls(f['corners'], f['wds'], int(f['nR']), int(f['nC']), f['mask'])
+
+
+# polygon from text 'x1, y1; x2, y2; ...' (stage positions, mm), None if the text is blank
+def parse_polygon(text):
+    points = [p for p in text.replace('\n', ';').split(';') if p.strip()]
+    if not points:
+        return None
+    poly = [tuple(float(v) for v in p.split(',')) for p in points]
+    if len(poly) < 3 or any(len(p) != 2 for p in poly):
+        raise ValueError("Polygon needs at least 3 points 'x, y', separated by ';'")
+    return poly
+
+
+# mask of grid tiles whose centre is inside the polygon (list of stage positions (x, y), mm)
+def mask_polygon(grid, polygon):
+    poly = np.asarray(polygon, dtype = float).reshape(-1, 2)
+    x = grid.x
+    y = grid.y
+    inside = np.zeros(x.shape, dtype = bool)
+    # ray casting, toggle at each edge crossed by a ray towards +x
+    for (x0, y0), (x1, y1) in zip(poly, np.roll(poly, -1, axis = 0)):
+        if y0 == y1:
+            continue
+        cross = ((y0 > y) != (y1 > y)) & (x < x0 + (y - y0) * (x1 - x0) / (y1 - y0))
+        inside ^= cross
+    return inside
@@ -0,0 +1,178 @@
+import numpy as np
+
+
+# stage travel time model
+#   speed:      max stage speed per axis (mm/s)
+#   accel:      stage acceleration (mm/s^2)
+#   settle:     settling time after each move (s)
+#   backlash:   extra time when an axis reverses its direction of travel (s)
+# Axes move simultaneously with a trapezoidal velocity profile, a move takes
+# the time of the slower axis plus the settling time.
+class StageCostModel:
+
+    def __init__(self, speed = 2.0, accel = 10.0, settle = 0.5, backlash = 0.3):
+        self.speed = speed
+        self.accel = accel
+        self.settle = settle
+        self.backlash = backlash
+
+    # time (s) to travel distance d (mm, array) along one axis
+    def axis_time(self, d):
+        d = np.abs(np.asarray(d, dtype = float))
+        d_ramp = self.speed ** 2 / self.accel     # distance to accelerate to speed and stop again
+        t = np.where(d < d_ramp, 2 * np.sqrt(d / self.accel), d / self.speed + self.speed / self.accel)
+        return t
+
+    # move time (s) from p0 to p1, arrays of (x, y) stage positions (mm); no backlash
+    def move_time(self, p0, p1):
+        dp = np.asarray(p1, dtype = float) - np.asarray(p0, dtype = float)
+        t = np.maximum(self.axis_time(dp[..., 0]), self.axis_time(dp[..., 1]))
+        return np.where(np.any(dp != 0, axis = -1), t + self.settle, 0.0)
+
+    # matrix of move times between all pairs of positions xy (N x 2)
+    def matrix(self, xy):
+        xy = np.asarray(xy, dtype = float)
+        return self.move_time(xy[:, None, :], xy[None, :, :])
+
+    # total time (s) to visit xy[order] in order, including backlash
+    def path_time(self, xy, order):
+        p = np.asarray(xy, dtype = float)[np.asarray(order)]
+        if len(p) < 2:
+            return 0.0
+        t = self.move_time(p[:-1], p[1:]).sum()
+        # backlash: direction of travel changes sign on an axis, between consecutive moves on that axis
+        for k in range(2):
+            d = np.sign(np.diff(p[:, k]))
+            d = d[d != 0]
+            t += self.backlash * np.count_nonzero(d[1:] != d[:-1])
+        return float(t)
+
+
+# all planners take (rc, xy, cost, start) and return the visiting order as an index array
+#   rc:     (iR, iC) of each tile, N x 2 int
+#   xy:     stage position of each tile, N x 2 (mm)
+#   cost:   StageCostModel
+#   start:  index of the first tile, planners which follow a fixed pattern may ignore it
+
+# row by row, alternate column direction (the original SemControl order)
+def plan_serpentine(rc, xy, cost, start = 0):
+    rc = np.asarray(rc)
+    rows = np.unique(rc[:, 0])
+    order = []
+    for r in rows:
+        idx = np.flatnonzero(rc[:, 0] == r)
+        idx = idx[np.argsort(rc[idx, 1], kind = 'stable')]
+        order.append(idx if r % 2 == 0 else idx[::-1])
+    return np.concatenate(order)
+
+
+# column by column, alternate row direction
+def plan_column_serpentine(rc, xy, cost, start = 0):
+    rc = np.asarray(rc)
+    return plan_serpentine(rc[:, ::-1], xy, cost, start)
+
+
+# index of (x, y) along a Hilbert curve filling a n x n grid, n a power of 2
+def hilbert_index(n, x, y):
+    x = np.array(x, dtype = np.int64)
+    y = np.array(y, dtype = np.int64)
+    d = np.zeros_like(x)
+    s = n // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        swap = ~ry
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s //= 2
+    return d
+
+
+# order along a Hilbert curve, keeps the moves short in both directions
+# The curve is followed from 'start' to its end, then from its beginning up to 'start'.
+def plan_hilbert(rc, xy, cost, start = 0):
+    rc = np.asarray(rc)
+    n = 1
+    while n < max(rc[:, 0].max(), rc[:, 1].max()) + 1:
+        n *= 2
+    order = np.argsort(hilbert_index(n, rc[:, 1], rc[:, 0]), kind = 'stable')
+    return np.roll(order, -int(np.flatnonzero(order == start)[0]))
+
+
+# improve open path 'order' (first tile fixed) by 2-opt: reverse order[i:j+1] if it shortens the path
+def two_opt(d, order, max_passes = 20):
+    order = np.array(order)
+    n = len(order)
+    for p in range(max_passes):
+        improved = False
+        for i in range(1, n - 1):
+            a = order[i - 1]
+            b = order[i]
+            c = order[i + 1:]
+            e = np.r_[order[i + 2:], -1]
+            delta = d[a, c] - d[a, b]
+            has_e = e >= 0
+            delta[has_e] += d[b, e[has_e]] - d[c[has_e], e[has_e]]
+            j = np.argmin(delta)
+            if delta[j] < -1e-9:
+                order[i:i + j + 2] = order[i:i + j + 2][::-1].copy()
+                improved = True
+        if not improved:
+            break
+    return order
+
+
+# nearest neighbour tour from 'start', improved by 2-opt, for sparse or irregular tile sets
+# The serpentine order is improved too if it begins at 'start' (regular grids), the faster
+# path including backlash is returned.
+def plan_tsp(rc, xy, cost, start = 0, max_passes = 20):
+    d = cost.matrix(xy)
+    n = len(d)
+    if n < 3:
+        return np.r_[start, np.delete(np.arange(n), start)].astype(int)
+
+    order = [start]
+    left = np.ones(n, dtype = bool)
+    left[start] = False
+    for k in range(n - 1):
+        cand = np.flatnonzero(left)
+        nxt = cand[np.argmin(d[order[-1], cand])]
+        order.append(nxt)
+        left[nxt] = False
+    seeds = [order]
+    serp = plan_serpentine(rc, xy, cost)
+    if serp[0] == start:
+        seeds.append(serp)
+
+    paths = [two_opt(d, seed, max_passes) for seed in seeds]
+    return min(paths, key = lambda o: cost.path_time(xy, o))
+
+
+PLANNERS = {
+    'serpentine': plan_serpentine,
+    'column-serpentine': plan_column_serpentine,
+    'hilbert': plan_hilbert,
+    'tsp': plan_tsp,
+}
+
+
+# add a planner, fn(rc, xy, cost, start) -> order
+def register_planner(name, fn):
+    PLANNERS[name] = fn
+
+
+# visiting order of tiles (iR, iC) = rc at stage positions xy, see PLANNERS for the methods
+# Returns (order, estimated travel time (s)).
+def plan_tile_order(rc, xy, method = 'serpentine', cost = None, start = 0):
+    if cost is None:
+        cost = StageCostModel()
+    rc = np.asarray(rc, dtype = int).reshape(-1, 2)
+    xy = np.asarray(xy, dtype = float).reshape(-1, 2)
+    if len(rc) == 0:
+        return (np.zeros(0, dtype = int), 0.0)
+    order = np.asarray(PLANNERS[method](rc, xy, cost, start), dtype = int)
+    return (order, cost.path_time(xy, order))
@@ -0,0 +1,144 @@
+import functools
+import json
+import os
+import queue
+import threading
+
+
+# True if tifffile (for write_tiff) can be imported
+def tifffile_available():
+    try:
+        import tifffile
+        return True
+    except ImportError:
+        return False
+
+
+# write 2D array as internally tiled, losslessly compressed TIFF (requires tifffile)
+#   metadata:       dict of acquisition parameters (JSON serializable), embedded in the file;
+#                   keys pixel_size_um, stage_x_mm, stage_y_mm also fill the OME pixel size / plane position
+#   tile:           TIFF tile size (pxl), multiple of 16
+#   compression:    'zlib' (deflate), 'zstd', 'lzw' or None; zstd and lzw need imagecodecs
+#   ome:            write OME-TIFF (metadata as OME-XML, parameters in the image Description)
+#   workers:        threads compressing the tiles of one file in parallel
+#   levels:         reduced resolution images (see pyramid.build_pyramid), written as SubIFDs
+def write_tiff(fp, data, metadata = None, tile = 512, compression = 'zlib', ome = True, workers = 2, levels = ()):
+    import tifffile
+    metadata = dict(metadata or {})
+    options = {'maxworkers': workers}
+    if compression:
+        options['compression'] = compression
+    if ome:
+        md = {'axes': 'YX', 'Description': json.dumps(metadata)}
+        px = metadata.get('pixel_size_um')
+        if px:
+            md.update(PhysicalSizeX = px, PhysicalSizeXUnit = 'µm', PhysicalSizeY = px, PhysicalSizeYUnit = 'µm')
+        if 'stage_x_mm' in metadata and 'stage_y_mm' in metadata:
+            md['Plane'] = {'PositionX': [metadata['stage_x_mm']], 'PositionXUnit': ['mm'],
+                           'PositionY': [metadata['stage_y_mm']], 'PositionYUnit': ['mm']}
+    else:
+        md = metadata
+    with tifffile.TiffWriter(fp, ome = ome) as tif:
+        tif.write(data, metadata = md, tile = _tile_size(data, tile), subifds = len(levels), **options)
+        for a in levels:
+            tif.write(a, tile = _tile_size(a, tile), subfiletype = 1, **options)
+
+
+# TIFF tile size for image a: 'tile', or smaller for small images (multiple of 16)
+def _tile_size(a, tile):
+    t = min(tile, -(-min(a.shape[:2]) // 16) * 16)
+    return (t, t)
+
+
+class TileWriter:
+    """ Save acquired tiles in background threads
+
+    Tiles are put into a bounded queue and saved by a small pool of writer
+    threads, so the acquisition loop can move the stage and scan the next tile
+    while the previous one is encoded and written. If the queue is full,
+    submit() blocks until a writer is free (backpressure), so the memory used
+    by pending tiles is limited to max_pending frames.
+    A failed save does not stop the writers: the error is kept with the file
+    path, for take_errors() while running, and raised by wait() / close().
+    Each save is recorded as a 'stage.save' span if a sem_trace.Tracer is given.
+    """
+
+    def __init__(self, n_threads = 2, max_pending = 4, tracer = None):
+        self.tracer = tracer
+        self.tasks = queue.Queue(maxsize = max_pending)
+        self.lock = threading.Lock()
+        self.pending = {}       # file path -> number of pending saves
+        self.errors = []
+        self.threads = []
+        for i in range(n_threads):
+            t = threading.Thread(target = self._run, name = "TileWriter-{}".format(i), daemon = True)
+            t.start()
+            self.threads.append(t)
+
+    # worker loop, None in the queue stops the thread
+    def _run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                self.tasks.task_done()
+                break
+            fp, fn, args = task
+            try:
+                if self.tracer is not None:
+                    with self.tracer.span('stage.save', fp = fp):
+                        fn(*args)
+                else:
+                    fn(*args)
+            except Exception as e:
+                with self.lock:
+                    self.errors.append((fp, e))
+            finally:
+                with self.lock:
+                    self.pending[fp] -= 1
+                    if self.pending[fp] == 0:
+                        del self.pending[fp]
+                self.tasks.task_done()
+
+    # queue fn(*args), which writes file fp. Blocks when the queue is full
+    def submit(self, fp, fn, *args):
+        with self.lock:
+            self.pending[fp] = self.pending.get(fp, 0) + 1
+        self.tasks.put((fp, fn, args))
+
+    # queue PIL image to be saved as fp
+    def save(self, img, fp):
+        self.submit(fp, img.save, fp)
+
+    # queue 2D array to be saved as tiled, compressed TIFF, see write_tiff for metadata / options
+    def save_tiff(self, data, fp, metadata = None, **options):
+        self.submit(fp, functools.partial(write_tiff, **options), fp, data, metadata)
+
+    # True if fp exists on disk or is waiting to be written
+    def exists(self, fp):
+        with self.lock:
+            if fp in self.pending:
+                return True
+        return os.path.exists(fp)
+
+    # failed saves since the last call, list of (file path, exception)
+    def take_errors(self):
+        with self.lock:
+            errors = self.errors
+            self.errors = []
+        return errors
+
+    # block until all queued tiles are written, raise the first error if any
+    def wait(self):
+        self.tasks.join()
+        errors = self.take_errors()
+        if errors:
+            raise errors[0][1]
+
+    # write the remaining tiles and stop the threads
+    def close(self):
+        for t in self.threads:
+            self.tasks.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        self.wait()